@@ -158,6 +158,11 @@ def default_config():
         # into unicode, by default it is detected automatically
         document_charset=None,
 
+        # Memo of charsets of hosts (`grab.charset.CharsetMemo` instance),
+        # charset of the document is taken from the memo if the charset
+        # of the host is known. If True then the global memo is used
+        charset_memo=None,
+
         # Content type control how DOM are built
         # For html type HTML DOM builder is used
         # For xml type XML DOM builder is used
@@ -179,6 +184,14 @@ def default_config():
         # It does not affect `self.doc.body`
         strip_null_bytes=True,
 
+        # Build HTML DOM tree from chunks of the body while the body is being
+        # downloaded (supported only by pycurl transport)
+        incremental_dom=False,
+
+        # Options of lxml parser: name of profile from
+        # `grab.document.PARSER_PROFILES` or dict of options
+        parser_profile=None,
+
         # Internal object to store
         state={},
     )
@@ -603,7 +616,7 @@ class Grab(DeprecatedThings):
         doc.body = content
         doc.status = ''
         doc.head = b'HTTP/1.1 200 OK\r\n\r\n'
-        doc.parse(charset=kwargs.get('document_charset'))
+        doc.parse(charset=kwargs.pop('document_charset', None))
         doc.code = 200
         doc.total_time = 0
         doc.connect_time = 0
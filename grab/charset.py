@@ -0,0 +1,210 @@
+"""
+Detection of charset of the document.
+
+`detect_charset` scans the beginning of the body once and looks for (in
+order of priority):
+
+* byte order mark
+* charset of meta tag: both ``<meta charset="...">`` and
+  ``<meta http-equiv="Content-Type" content="...; charset=...">``
+* encoding of XML declaration
+* charset of Content-Type header
+
+Pages of one host almost always have same charset. `CharsetMemo` remembers
+charset detected for each host. When same charset has been detected for
+`min_confidence` pages in a row the memo is used instead of detection, each
+`verify_interval`-th page of the host is still checked so the memo is reset
+if the host changes its charset.
+"""
+import codecs
+import logging
+import re
+
+logger = logging.getLogger('grab.charset')
+RE_CHARSET = re.compile(
+    br'<meta[^>]+?charset\s*=\s*["\']?\s*([-\w.:]+)'
+    br'|<\?xml[^>]+?encoding\s*=\s*["\']([-\w.:]+)', re.I)
+RE_CONTENT_TYPE_CHARSET = re.compile(r'charset\s*=\s*["\']?([-\w.:]+)',
+                                     re.I)
+DEFAULT_MIN_CONFIDENCE = 10
+DEFAULT_VERIFY_INTERVAL = 100
+# Bom processing logic was copied from
+# https://github.com/scrapy/w3lib/blob/master/w3lib/encoding.py
+_BOM_TABLE = [
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF8, 'utf-8')
+]
+_FIRST_CHARS = set(char[0] for (char, name) in _BOM_TABLE)
+# Results of `codecs.lookup` calls
+_KNOWN_CHARSETS = {}
+# Charsets which encode ASCII characters with same single bytes and never
+# use bytes of ASCII range inside multi-byte sequences
+RE_ASCII_COMPATIBLE = re.compile(
+    r'^(ascii|utf-8|latin-1|iso8859-\d+|cp(125\d|437|85\d|86\d|874)'
+    r'|koi8-\w+|mac-\w+)$')
+_ASCII_COMPATIBLE_CHARSETS = {}
+
+
+def read_bom(data):
+    """Read the byte order mark in the text, if present, and
+    return the encoding represented by the BOM and the BOM.
+
+    If no BOM can be detected, (None, None) is returned.
+    """
+    # common case is no BOM, so this is fast
+    if data and data[0] in _FIRST_CHARS:
+        for bom, encoding in _BOM_TABLE:
+            if data.startswith(bom):
+                return encoding, bom
+    return None, None
+
+
+def is_known_charset(charset):
+    """
+    Check that python knows the charset. Results are cached.
+    """
+
+    try:
+        return _KNOWN_CHARSETS[charset]
+    except KeyError:
+        try:
+            codecs.lookup(charset)
+        except LookupError:
+            result = False
+        else:
+            result = True
+        _KNOWN_CHARSETS[charset] = result
+        return result
+
+
+def is_ascii_compatible(charset):
+    """
+    Check that ASCII text could be searched in the raw bytes of the body
+    encoded with the charset. Results are cached.
+    """
+
+    try:
+        return _ASCII_COMPATIBLE_CHARSETS[charset]
+    except KeyError:
+        try:
+            name = codecs.lookup(charset).name
+        except (LookupError, TypeError):
+            result = False
+        else:
+            result = bool(RE_ASCII_COMPATIBLE.match(name))
+        _ASCII_COMPATIBLE_CHARSETS[charset] = result
+        return result
+
+
+def find_body_charset(chunk):
+    """
+    Find charset declared in meta tag or in XML declaration.
+    """
+
+    xml_charset = None
+    for match in RE_CHARSET.finditer(chunk):
+        if match.group(1):
+            return match.group(1)
+        elif xml_charset is None and not chunk[:match.start()].strip():
+            # XML declaration is used only if it is the first thing
+            # in the document and there is no meta tag
+            xml_charset = match.group(2)
+    return xml_charset
+
+
+def detect_charset(chunk, content_type=None):
+    """
+    Detect charset of the document.
+
+    :param chunk: beginning of the body
+    :param content_type: value of Content-Type header
+    :returns: pair of lower-cased charset (None if nothing is found) and
+        byte order mark (None if there is no BOM)
+    """
+
+    charset = None
+    bom = None
+    if chunk:
+        charset, bom = read_bom(chunk)
+        if not charset:
+            charset = find_body_charset(chunk)
+            if charset is not None:
+                charset = charset.decode('ascii')
+    if not charset and content_type:
+        match = RE_CONTENT_TYPE_CHARSET.search(content_type)
+        if match:
+            charset = match.group(1)
+    if charset:
+        # Convert to unicode (py2.x) or string (py3.x)
+        charset = str(charset.lower())
+    return charset, bom
+
+
+class CharsetMemo(object):
+    """
+    Memo of charsets of hosts.
+
+    :param min_confidence: number of pages in a row with same charset
+        after which the charset of the host is taken from the memo
+    :param verify_interval: each `verify_interval`-th page of the host is
+        checked even if the charset is known
+    """
+
+    def __init__(self, min_confidence=DEFAULT_MIN_CONFIDENCE,
+                 verify_interval=DEFAULT_VERIFY_INTERVAL):
+        self.min_confidence = min_confidence
+        self.verify_interval = verify_interval
+        # host -> [charset, confidence, number of memo hits]
+        self.hosts = {}
+
+    def get(self, host):
+        """
+        Return charset of the host or None if the host is unknown, the
+        confidence is low or the page should be verified.
+        """
+
+        record = self.hosts.get(host)
+        if record is None or record[1] < self.min_confidence:
+            return None
+        record[2] += 1
+        if record[2] % self.verify_interval == 0:
+            return None
+        return record[0]
+
+    def update(self, host, charset):
+        """
+        Save charset detected for the page of the host.
+        """
+
+        record = self.hosts.get(host)
+        if record is None or record[0] != charset:
+            if record is not None:
+                logger.debug('Charset of %s has changed: %s -> %s'
+                             % (host, record[0], charset))
+            self.hosts[host] = [charset, 1, 0]
+        else:
+            record[1] += 1
+
+    def get_confidence(self, host):
+        record = self.hosts.get(host)
+        return record[1] if record else 0
+
+    def clear(self):
+        self.hosts = {}
+
+
+# Memo which is used by Grab instances with `charset_memo=True` option
+DEFAULT_CHARSET_MEMO = CharsetMemo()
+
+
+def get_charset_memo(option):
+    """
+    Return memo for value of `charset_memo` option of Grab config.
+    """
+
+    if option is True:
+        return DEFAULT_CHARSET_MEMO
+    return option or None
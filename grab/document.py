@@ -8,18 +8,20 @@ from __future__ import absolute_import
 import weakref
 import re
 from copy import copy
-import email
 import os
+import itertools
 import json
+import mmap
+import gzip
+from contextlib import contextmanager
 import tempfile
 import webbrowser
-import codecs
+from hashlib import sha1
 from datetime import datetime
 import time
-from lxml.etree import ParserError
+from lxml.etree import ParserError, LxmlError
 from lxml.html import HTMLParser
-from lxml.etree import XMLParser, parse
-from selection import XpathSelector
+from lxml.etree import XMLParser, parse, iterparse
 import six
 from six.moves.urllib.parse import urlsplit, parse_qs, urljoin
 import threading
@@ -28,50 +30,212 @@ from weblib.http import smart_urlencode
 import weblib.encoding
 from weblib.files import hashed_path
 from weblib.structured import TreeInterface
+from weblib.etree import get_node_text
 from weblib.text import normalize_space
 from weblib.html import decode_entities, find_refresh_url
-from weblib.rex import normalize_regexp
 import logging
 
+from grab.charset import (detect_charset, is_known_charset, read_bom,
+                          is_ascii_compatible)
 from grab.cookie import CookieManager
+from grab.headers import HeaderDict
 from grab.error import GrabMisuseError, DataNotFound
 from grab.const import NULL
+from grab.util.files import copy_file
+from grab.util.jsonstream import iter_json_items
+from grab.util.rex import compile_regexp
 from grab.util.warning import warn
+from grab.util.xpath import (CachedXpathSelector, CachedCssTranslator,
+                             compile_xpath, css_to_xpath)
 
 NULL_BYTE = chr(0)
 RE_XML_DECLARATION = re.compile(br'^[^<]{,100}<\?xml[^>]+\?>', re.I)
-RE_DECLARATION_ENCODING = re.compile(br'encoding\s*=\s*["\']([^"\']+)["\']')
-RE_META_CHARSET =\
-    re.compile(br'<meta[^>]+content\s*=\s*[^>]+charset=([-\w]+)', re.I)
 RE_UNICODE_XML_DECLARATION =\
     re.compile(RE_XML_DECLARATION.pattern.decode('utf-8'), re.I)
-
-# Bom processing logic was copied from
-# https://github.com/scrapy/w3lib/blob/master/w3lib/encoding.py
-_BOM_TABLE = [
-    (codecs.BOM_UTF32_BE, 'utf-32-be'),
-    (codecs.BOM_UTF32_LE, 'utf-32-le'),
-    (codecs.BOM_UTF16_BE, 'utf-16-be'),
-    (codecs.BOM_UTF16_LE, 'utf-16-le'),
-    (codecs.BOM_UTF8, 'utf-8')
-]
-_FIRST_CHARS = set(char[0] for (char, name) in _BOM_TABLE)
+RE_NOT_SPACE = re.compile(br'\S')
+# Printable ASCII string without leading and trailing spaces (the unicode
+# body is stripped) and without "&" (special entities are fixed in the
+# unicode body)
+RE_ASCII_ANCHOR = re.compile(
+    r'[\x21-\x25\x27-\x7e]([\x20-\x25\x27-\x7e]*[\x21-\x25\x27-\x7e])?\Z')
+# Entities which are fixed by `weblib.encoding.fix_special_entities`
+RE_SPECIAL_ENTITY = re.compile(br'&#1[2-6]\d;')
+# Charsets in which null bytes are parts of other characters
+WIDE_CHARSETS = ('utf-16', 'utf-32', 'utf_16', 'utf_32', 'utf16', 'utf32')
+# Size of the beginning of the body which is used to detect the charset
+CHARSET_CHUNK_SIZE = 4096
+# Max length of the entity fixed by `fix_special_entities`, e.g. "&#151;"
+SPECIAL_ENTITY_LENGTH = 6
+# Options of lxml parsers, the profile is chosen with `parser_profile`
+# option of Grab config
+PARSER_PROFILES = {
+    'default': {},
+    # Drop parts of the document which are rarely used by scrapers
+    'lean': {
+        'remove_comments': True,
+        'remove_pis': True,
+        'remove_blank_text': True,
+        'collect_ids': False,
+    },
+    # Allow very deep trees and very long text nodes
+    'huge': {'huge_tree': True},
+}
+# Options of parser profiles which are supported by `lxml.etree.iterparse`
+ITERPARSE_OPTIONS = ('remove_blank_text', 'remove_comments', 'remove_pis',
+                     'huge_tree')
+GZIP_MAGIC = b'\x1f\x8b'
 THREAD_STORAGE = threading.local()
 logger = logging.getLogger('grab.document')
 
 
-def read_bom(data):
-    """Read the byte order mark in the text, if present, and
-    return the encoding represented by the BOM and the BOM.
+def get_parser_options(profile):
+    """
+    Return options of lxml parser for the name of the profile or for the
+    dict of options.
+    """
 
-    If no BOM can be detected, (None, None) is returned.
+    if profile is None:
+        return {}
+    elif isinstance(profile, dict):
+        return profile
+    try:
+        return PARSER_PROFILES[profile]
+    except KeyError:
+        raise GrabMisuseError('Unknown parser profile: %s' % profile)
+
+
+def get_parser(parser_class, storage_key, encoding=None, profile=None):
+    options = get_parser_options(profile)
+    parsers = getattr(THREAD_STORAGE, storage_key, None)
+    if parsers is None:
+        parsers = {}
+        setattr(THREAD_STORAGE, storage_key, parsers)
+    key = (encoding, tuple(sorted(options.items())))
+    try:
+        return parsers[key]
+    except KeyError:
+        parser = parsers[key] = parser_class(encoding=encoding, **options)
+        return parser
+
+
+def get_html_parser(encoding=None, profile=None):
     """
-    # common case is no BOM, so this is fast
-    if data and data[0] in _FIRST_CHARS:
-        for bom, encoding in _BOM_TABLE:
-            if data.startswith(bom):
-                return encoding, bom
-    return None, None
+    Return HTML parser of current thread for given encoding and profile.
+    """
+
+    return get_parser(HTMLParser, 'html_parsers', encoding, profile)
+
+
+def get_xml_parser(profile=None):
+    """
+    Return XML parser of current thread for given profile.
+    """
+
+    return get_parser(XMLParser, 'xml_parsers', profile=profile)
+
+
+class IncrementalTreeBuilder(object):
+    """
+    Build HTML DOM tree from chunks of the body while the body is being
+    downloaded.
+
+    Chunks are buffered until first `CHARSET_CHUNK_SIZE` bytes are received,
+    the charset is detected from them in same way as
+    `Document.detect_charset` does. Then chunks are fed to lxml feed parser
+    as they arrive. Fix-ups of `Document.build_html_tree` are applied to each
+    chunk.
+
+    :param head: raw head of the response
+    :param charset: charset of the document, by default it is detected
+    """
+
+    def __init__(self, head, charset=None, strip_null_bytes=True,
+                 fix_special_entities=True, parser_profile=None):
+        self.head = head
+        self.parser_options = get_parser_options(parser_profile)
+        self.charset = charset.lower() if charset else None
+        self.bom = None
+        self.strip_null_bytes = strip_null_bytes
+        self.fix_special_entities = fix_special_entities
+        self.parser = None
+        self.failed = False
+        self.buffer = []
+        self.buffer_size = 0
+        # Part of the chunk which could be the beginning of the entity
+        self.tail = b''
+
+    def feed(self, chunk):
+        if self.failed:
+            return
+        if self.parser is None:
+            self.buffer.append(chunk)
+            self.buffer_size += len(chunk)
+            if self.buffer_size >= CHARSET_CHUNK_SIZE:
+                self.start()
+        else:
+            self.feed_parser(chunk)
+
+    def start(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        if self.charset is None:
+            charset, self.bom = detect_charset(
+                data[:CHARSET_CHUNK_SIZE],
+                HeaderDict(self.head).get('Content-Type'))
+            if charset and is_known_charset(charset):
+                self.charset = charset
+            else:
+                self.charset = 'utf-8'
+        if self.charset.startswith(WIDE_CHARSETS):
+            self.failed = True
+            return
+        if self.bom and data.startswith(self.bom):
+            data = data[len(self.bom):]
+        try:
+            self.parser = HTMLParser(encoding=self.charset,
+                                     **self.parser_options)
+        except LookupError:
+            self.failed = True
+            return
+        self.feed_parser(data)
+
+    def feed_parser(self, data):
+        if self.tail:
+            data = self.tail + data
+            self.tail = b''
+        if self.fix_special_entities:
+            pos = data.rfind(b'&', max(len(data) - SPECIAL_ENTITY_LENGTH, 0))
+            if pos > -1 and b';' not in data[pos:]:
+                self.tail = data[pos:]
+                data = data[:pos]
+            if RE_SPECIAL_ENTITY.search(data):
+                data = weblib.encoding.fix_special_entities(data)
+        if self.strip_null_bytes and b'\x00' in data:
+            data = data.replace(b'\x00', b'')
+        try:
+            self.parser.feed(data)
+        except (LxmlError, TypeError, ValueError):
+            self.failed = True
+
+    def close(self):
+        """
+        Return the root of DOM tree or None if the tree could not be built.
+        """
+
+        if self.parser is None and not self.failed:
+            if not self.buffer_size:
+                return None
+            self.start()
+        if self.failed:
+            return None
+        try:
+            if self.tail:
+                self.parser.feed(self.tail)
+                self.tail = b''
+            return self.parser.close()
+        except (LxmlError, TypeError, ValueError):
+            self.failed = True
+            return None
 
 
 class TextExtension(object):
@@ -88,24 +252,39 @@ class TextExtension(object):
             and search will be performed in `response.body`
 
         If substring is found return True else False.
+
+        ASCII anchor is searched in the raw bytes of the body if the body
+        has not been decoded yet and its charset encodes ASCII characters
+        with same bytes (utf-8, cp1251, etc).
         """
 
         if isinstance(anchor, six.text_type):
             if byte:
                 raise GrabMisuseError('The anchor should be bytes string in '
                                       'byte mode')
+            elif (self._unicode_body is None
+                  and self.can_search_ascii_bytes(anchor)):
+                return self.get_body_buffer().find(
+                    anchor.encode('ascii')) > -1
             else:
                 return anchor in self.unicode_body()
 
         if not isinstance(anchor, six.text_type):
             if byte:
-                # if six.PY3:
-                    # return anchor in self.body_as_bytes()
-                return anchor in self.body
+                return self.get_body_buffer().find(anchor) > -1
             else:
                 raise GrabMisuseError('The anchor should be byte string in '
                                       'non-byte mode')
 
+    def can_search_ascii_bytes(self, anchor):
+        """
+        Check that searching of the unicode anchor in the raw bytes of the
+        body gives same result as searching in `unicode_body()`.
+        """
+
+        return (RE_ASCII_ANCHOR.match(anchor) is not None
+                and is_ascii_compatible(self.charset))
+
     def text_assert(self, anchor, byte=False):
         """
         If `anchor` is not found then raise `DataNotFound` exception.
@@ -165,15 +344,11 @@ class RegexpExtension(object):
 
         """
 
-        regexp = normalize_regexp(regexp, flags)
+        regexp = compile_regexp(regexp, flags)
         match = None
         if byte:
             if not isinstance(regexp.pattern, six.text_type) or not six.PY3:
-                # if six.PY3:
-                    # body = self.body_as_bytes()
-                # else:
-                    # body = self.body
-                match = regexp.search(self.body)
+                match = regexp.search(self.get_body_buffer())
         else:
             if isinstance(regexp.pattern, six.text_type) or not six.PY3:
                 ubody = self.unicode_body()
@@ -206,7 +381,8 @@ class PyqueryExtension(object):
         if not self._pyquery:
             from pyquery import PyQuery
 
-            self._pyquery = PyQuery(self.body)
+            self._pyquery = PyQuery(self.body,
+                                    css_translator=CachedCssTranslator())
         return self._pyquery
 
 
@@ -216,10 +392,9 @@ class BodyExtension(object):
     def get_body_chunk(self):
         body_chunk = None
         if self.body_path:
-            with open(self.body_path, 'rb') as inp:
-                body_chunk = inp.read(4096)
-        elif self._bytes_body:
-            body_chunk = self._bytes_body[:4096]
+            body_chunk = self.get_body_buffer()[:CHARSET_CHUNK_SIZE]
+        elif self.body:
+            body_chunk = self._bytes_body[:CHARSET_CHUNK_SIZE]
         return body_chunk
 
     def convert_body_to_unicode(self, body, bom, charset,
@@ -241,6 +416,61 @@ class BodyExtension(object):
         with open(self.body_path, 'rb') as inp:
             return inp.read()
 
+    @contextmanager
+    def open_body(self, decompress=True):
+        """
+        Open the body (the file of the body or the body in memory) as
+        binary file object.
+
+        :param decompress: decompress gzip-compressed body on the fly
+            e.g. sitemap.xml.gz file
+        """
+
+        if self.body_path:
+            inp = open(self.body_path, 'rb')
+        else:
+            inp = BytesIO(self.body or b'')
+        try:
+            if decompress and inp.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+                inp.seek(0)
+                with gzip.GzipFile(fileobj=inp, mode='rb') as gzip_inp:
+                    yield gzip_inp
+            else:
+                inp.seek(0)
+                yield inp
+        finally:
+            inp.close()
+
+    def get_body_buffer(self):
+        """
+        Return the body as object which supports buffer protocol, `find`
+        method and slicing: the body itself or, if the body is stored in
+        the file, read-only mmap of the file. The file is mapped once, the
+        data is not copied into the memory of the process.
+        """
+
+        if self.body_path:
+            if self._body_mmap is None:
+                with open(self.body_path, 'rb') as inp:
+                    try:
+                        self._body_mmap = mmap.mmap(inp.fileno(), 0,
+                                                    access=mmap.ACCESS_READ)
+                    except ValueError:
+                        # Empty file could not be mapped
+                        return b''
+            return self._body_mmap
+        else:
+            return self.body
+
+    def close_body_buffer(self):
+        """
+        Unmap the file of the body.
+        """
+
+        if self._body_mmap is not None:
+            self._body_mmap.close()
+            self._body_mmap = None
+
     def unicode_body(self, ignore_errors=True, fix_special_entities=True):
         """
         Return response body as unicode string.
@@ -260,21 +490,61 @@ class BodyExtension(object):
         if self.body_path:
             return self.read_body_from_file()
         else:
+            if self._body_loader is not None:
+                self._bytes_body = self._body_loader()
+                self._body_loader = None
             return self._bytes_body
 
     def _write_body(self, body):
         if isinstance(body, six.text_type):
             raise GrabMisuseError('Document.body could be only byte string.')
         elif self.body_path:
+            self.close_body_buffer()
             with open(self.body_path, 'wb') as out:
                 out.write(body)
             self._bytes_body = None
         else:
             self._bytes_body = body
+        self._body_loader = None
         self._unicode_body = None
+        self._body_digest = None
 
     body = property(_read_body, _write_body)
 
+    def set_body_loader(self, loader):
+        """
+        Set function which returns the body. It is called on first access
+        to the body e.g. to decompress cached body only if it is needed.
+        """
+
+        self.close_body_buffer()
+        self._bytes_body = None
+        self._body_loader = loader
+        self._unicode_body = None
+        self._body_digest = None
+
+    def _read_body_digest(self):
+        if self._body_digest is None:
+            body = self.body
+            if body is not None:
+                self._body_digest = sha1(body).hexdigest()
+        return self._body_digest
+
+    def _write_body_digest(self, digest):
+        self._body_digest = digest
+
+    body_digest = property(_read_body_digest, _write_body_digest)
+
+    @property
+    def body_unchanged(self):
+        """
+        Return True if the body is same as the body of document which
+        was stored in the cache for same URL before the request.
+        """
+
+        return (self.previous_body_digest is not None and
+                self.previous_body_digest == self.body_digest)
+
 
 class DomTreeExtension(object):
     __slots__ = ()
@@ -290,68 +560,128 @@ class DomTreeExtension(object):
         else:
             return self.build_html_tree()
 
-    def _build_dom(self, content, mode):
+    def _build_dom(self, content, mode, encoding=None):
+        """
+        :param content: unicode string, byte string or binary file object
+        """
 
         assert mode in ('html', 'xml')
+        profile = self.grab.config['parser_profile']
+        if isinstance(content, six.text_type):
+            content = StringIO(content)
+        elif isinstance(content, six.binary_type):
+            content = BytesIO(content)
         if mode == 'html':
-            if not hasattr(THREAD_STORAGE, 'html_parser'):
-                THREAD_STORAGE.html_parser = HTMLParser()
-            dom = parse(StringIO(content),
-                        parser=THREAD_STORAGE.html_parser)
+            dom = parse(content, parser=get_html_parser(encoding, profile))
             return dom.getroot()
         else:
-            if not hasattr(THREAD_STORAGE, 'xml_parser'):
-                THREAD_STORAGE.xml_parser = XMLParser()
-            dom = parse(BytesIO(content),
-                        parser=THREAD_STORAGE.xml_parser)
+            dom = parse(content, parser=get_xml_parser(profile))
             return dom.getroot()
 
+    def _build_html_tree_from_bytes(self):
+        """
+        Build DOM tree from the body without decoding it: lxml decodes
+        the body itself. Fix-ups of the body are applied only if the body
+        needs them.
+
+        Returns None if the tree could not be built in this way.
+        """
+
+        config = self.grab.config
+        charset = self.charset
+        if (config['lowercased_tree'] or not charset
+                or charset.startswith(WIDE_CHARSETS)):
+            return None
+        body = self.get_body_buffer()
+        if not body or not RE_NOT_SPACE.search(body):
+            return None
+        has_bom = self.bom and body[:len(self.bom)] == self.bom
+        has_null_bytes = (config['strip_null_bytes']
+                          and body.find(b'\x00') > -1)
+        has_entities = (config['fix_special_entities']
+                        and RE_SPECIAL_ENTITY.search(body))
+        try:
+            if self.body_path and not (has_bom or has_null_bytes
+                                       or has_entities):
+                # lxml reads the file itself
+                with open(self.body_path, 'rb') as inp:
+                    return self._build_dom(inp, 'html', encoding=charset)
+            body = body[:]
+            if has_bom:
+                body = body[len(self.bom):]
+            if has_null_bytes:
+                body = body.replace(b'\x00', b'')
+            if has_entities:
+                body = weblib.encoding.fix_special_entities(body)
+            return self._build_dom(body, 'html', encoding=charset)
+        except (LookupError, ParserError, TypeError, ValueError):
+            # Unknown encoding or the body which lxml could not parse
+            # without fixes of `build_html_tree`
+            return None
+
+    def _build_html_tree_from_unicode(self):
+        """
+        Build DOM tree from the decoded body.
+        """
+
+        fix_setting = self.grab.config['fix_special_entities']
+        body = self.unicode_body(fix_special_entities=fix_setting).strip()
+        if self.grab.config['lowercased_tree']:
+            body = body.lower()
+        if self.grab.config['strip_null_bytes']:
+            body = body.replace(NULL_BYTE, '')
+        # py3 hack
+        if six.PY3:
+            body = RE_UNICODE_XML_DECLARATION.sub('', body)
+        else:
+            body = RE_XML_DECLARATION.sub('', body)
+        if not body:
+            # Generate minimal empty content
+            # which will not break lxml parser
+            body = '<html></html>'
+
+        try:
+            tree = self._build_dom(body, 'html')
+        except Exception as ex:
+            if (isinstance(ex, ParserError)
+                    and 'Document is empty' in str(ex)
+                    and '<html' not in body):
+                # Fix for "just a string" body
+                body = '<html>%s</html>'.format(body)
+                tree = self._build_dom(body, 'html')
+
+            elif (isinstance(ex, TypeError)
+                  and "object of type 'NoneType' has no len" in str(ex)
+                  and '<html' not in body):
+
+                # Fix for smth like "<frameset></frameset>"
+                body = '<html>%s</html>'.format(body)
+                tree = self._build_dom(body, 'html')
+            else:
+                raise
+
+        return tree
 
     def build_html_tree(self):
 
         from grab.base import GLOBAL_STATE
 
         if self._lxml_tree is None:
-            fix_setting = self.grab.config['fix_special_entities']
-            body = self.unicode_body(fix_special_entities=fix_setting).strip()
-            if self.grab.config['lowercased_tree']:
-                body = body.lower()
-            if self.grab.config['strip_null_bytes']:
-                body = body.replace(NULL_BYTE, '')
-            # py3 hack
-            if six.PY3:
-                body = RE_UNICODE_XML_DECLARATION.sub('', body)
-            else:
-                body = RE_XML_DECLARATION.sub('', body)
-            if not body:
-                # Generate minimal empty content
-                # which will not break lxml parser
-                body = '<html></html>'
             start = time.time()
-
-            try:
-                self._lxml_tree = self._build_dom(body, 'html')
-            except Exception as ex:
-                if (isinstance(ex, ParserError)
-                        and 'Document is empty' in str(ex)
-                        and '<html' not in body):
-                    # Fix for "just a string" body
-                    body = '<html>%s</html>'.format(body)
-                    self._lxml_tree = self._build_dom(body, 'html')
-
-                elif (isinstance(ex, TypeError)
-                      and "object of type 'NoneType' has no len" in str(ex)
-                      and '<html' not in body):
-
-                    # Fix for smth like "<frameset></frameset>"
-                    body = '<html>%s</html>'.format(body)
-                    self._lxml_tree = self._build_dom(body, 'html')
-                else:
-                    raise
-
+            self._lxml_tree = self._build_html_tree_from_bytes()
+            if self._lxml_tree is None:
+                self._lxml_tree = self._build_html_tree_from_unicode()
             GLOBAL_STATE['dom_build_time'] += (time.time() - start)
         return self._lxml_tree
 
+    def set_tree(self, tree):
+        """
+        Set HTML DOM tree of the document e.g. the tree which has been
+        built while the body was being downloaded.
+        """
+
+        self._lxml_tree = tree
+
     @property
     def xml_tree(self):
         """
@@ -364,9 +694,42 @@ class DomTreeExtension(object):
 
     def build_xml_tree(self):
         if self._strict_lxml_tree is None:
-            self._strict_lxml_tree = self._build_dom(self.body, 'xml')
+            if self.body_path:
+                with open(self.body_path, 'rb') as inp:
+                    self._strict_lxml_tree = self._build_dom(inp, 'xml')
+            else:
+                self._strict_lxml_tree = self._build_dom(self.body, 'xml')
         return self._strict_lxml_tree
 
+    def iter_elements(self, tag=None):
+        """
+        Parse XML body incrementally and yield elements as they are closed.
+
+        Each element is cleared (and removed from its parent) after it has
+        been processed, so memory usage does not depend on the size of the
+        document. Extract the data you need from the element before
+        requesting next one. Gzip-compressed body is decompressed on the fly.
+
+        :param tag: name of element or list of names, use "{*}url" to match
+            element in any namespace
+        """
+
+        options = dict(
+            (key, value) for key, value
+            in get_parser_options(self.grab.config['parser_profile']).items()
+            if key in ITERPARSE_OPTIONS)
+        options.setdefault('huge_tree', True)
+        with self.open_body() as inp:
+            for event, elem in iterparse(inp, events=('end',), tag=tag,
+                                         **options):
+                # Remove processed elements which are not matched by `tag`
+                # too, e.g. parents of previous elements
+                for node in itertools.chain((elem,), elem.iterancestors()):
+                    while node.getprevious() is not None:
+                        del node.getparent()[0]
+                yield elem
+                elem.clear()
+
 
 class FormExtension(object):
     __slots__ = ()
@@ -506,7 +869,7 @@ class FormExtension(object):
         xpath = './/*[@id="%s"]' % _id
         if self._lxml_form is None:
             self.choose_form_by_element(xpath)
-        sel = XpathSelector(self.form)
+        sel = CachedXpathSelector(self.form)
         elem = sel.select(xpath).node()
         return self.set_input(elem.get('name'), value)
 
@@ -518,7 +881,7 @@ class FormExtension(object):
         :param value: value which should be set to element
         """
 
-        sel = XpathSelector(self.form)
+        sel = CachedXpathSelector(self.form)
         elem = sel.select('.//input[@type="text"]')[number].node()
         return self.set_input(elem.get('name'), value)
 
@@ -734,6 +1097,8 @@ class Document(TextExtension, RegexpExtension, PyqueryExtension,
                  'error_code', 'error_msg', 'grab', 'remote_ip',
                  '_lxml_tree', '_strict_lxml_tree', '_pyquery',
                  '_lxml_form', '_file_fields', 'from_cache',
+                 '_body_digest', 'previous_body_digest', '_body_loader',
+                 '_body_mmap',
                  )
 
     def __init__(self, grab=None):
@@ -767,7 +1132,11 @@ class Document(TextExtension, RegexpExtension, PyqueryExtension,
         # Body
         self.body_path = None
         self._bytes_body = None
+        self._body_loader = None
+        self._body_mmap = None
         self._unicode_body = None
+        self._body_digest = None
+        self.previous_body_digest = None
 
         # DOM Tree
         self._lxml_tree = None
@@ -784,105 +1153,85 @@ class Document(TextExtension, RegexpExtension, PyqueryExtension,
         return self.select(query)
 
     def select(self, *args, **kwargs):
-        return XpathSelector(self.tree).select(*args, **kwargs)
+        return CachedXpathSelector(self.tree).select(*args, **kwargs)
 
     def structure(self, *args, **kwargs):
         return TreeInterface(self.tree).structured_xpath(*args, **kwargs)
 
-    def parse(self, charset=None, headers=None):
+    def parse(self, charset=None, headers=None, charset_memo=None):
         """
         Parse headers.
 
         This method is called after Grab instance performes network request.
+
+        :param charset_memo: `grab.charset.CharsetMemo` instance, charset
+            of the document is taken from the memo when the charset of the
+            host is known
         """
 
         if headers:
             self.headers = headers
         else:
-            # Parse headers only from last response
-            # There could be multiple responses in `self.head`
-            # in case of 301/302 redirect
-            # Separate responses
-            if self.head:
-                responses = self.head.rsplit(b'\nHTTP/', 1)
-                # Cut off the 'HTTP/*' line from the last response
-                _, response = responses[-1].split(b'\n', 1)
-                response = response.decode('ascii', 'ignore')
-            else:
-                response = ''
-            self.headers = email.message_from_string(response)
+            # Headers are parsed on first access, only headers of last
+            # response are used. There could be multiple responses in
+            # `self.head` in case of 301/302 redirect
+            self.headers = HeaderDict(self.head)
 
         if charset is None:
             if isinstance(self.body, six.text_type):
                 self.charset = 'utf-8'
             else:
-                self.detect_charset()
+                self.detect_charset(memo=charset_memo)
         else:
             self.charset = charset.lower()
 
         self._unicode_body = None
 
-    def detect_charset(self):
+    def detect_charset(self, memo=None):
         """
         Detect charset of the response.
 
         Try following methods:
-        * meta[name="Http-Equiv"]
+        * BOM
+        * meta[charset] and meta[http-equiv="Content-Type"]
         * XML declaration
         * HTTP Content-Type header
 
         Ignore unknown charsets.
 
         Use utf-8 as fallback charset.
-        """
 
-        charset = None
+        :param memo: `grab.charset.CharsetMemo` instance
+        """
 
         body_chunk = self.get_body_chunk()
+        host = None
+        if memo is not None and self.url:
+            host = urlsplit(self.url).netloc
+            charset = memo.get(host)
+            if charset is not None:
+                # BOM is more reliable than the memo
+                bom_enc, bom = read_bom(body_chunk)
+                if bom_enc:
+                    self.charset, self.bom = bom_enc, bom
+                else:
+                    self.charset = charset
+                return
 
-        if body_chunk:
-            # Try to extract charset from http-equiv meta tag
-            try:
-                charset = RE_META_CHARSET.search(body_chunk).group(1)
-            except AttributeError:
-                pass
-
-            # TODO: <meta charset="utf-8" />
-            bom_enc, bom = read_bom(body_chunk)
-            if bom_enc:
-                charset = bom_enc
-                self.bom = bom
-
-            # Try to process XML declaration
-            if not charset:
-                if body_chunk.startswith(b'<?xml'):
-                    match = RE_XML_DECLARATION.search(body_chunk)
-                    if match:
-                        enc_match = RE_DECLARATION_ENCODING.search(
-                            match.group(0))
-                        if enc_match:
-                            charset = enc_match.group(1)
-
-        if not charset:
-            if 'Content-Type' in self.headers:
-                pos = self.headers['Content-Type'].find('charset=')
-                if pos > -1:
-                    charset = self.headers['Content-Type'][(pos + 8):]
-
+        charset, bom = detect_charset(body_chunk,
+                                      self.headers.get('Content-Type'))
+        if bom:
+            self.bom = bom
         if charset:
-            charset = charset.lower()
-            if not isinstance(charset, str):
-                # Convert to unicode (py2.x) or string (py3.x)
-                charset = charset.decode('utf-8')
             # Check that python knows such charset
-            try:
-                codecs.lookup(charset)
-            except LookupError:
+            if is_known_charset(charset):
+                self.charset = charset
+            else:
                 logger.error('Unknown charset found: %s.'
                              ' Using utf-8 istead.' % charset)
                 self.charset = 'utf-8'
-            else:
-                self.charset = charset
+        if host is not None and not bom:
+            memo.update(host, self.charset)
 
     def copy(self, new_grab=None):
         """
@@ -906,9 +1255,15 @@ class Document(TextExtension, RegexpExtension, PyqueryExtension,
 
         return obj
 
-    def save(self, path, create_dirs=False):
+    def save(self, path, create_dirs=False, link=False):
         """
         Save response body to file.
+
+        If the body has been saved to the disk (see `body_inmemory`
+        option) the file is copied without reading it into memory.
+
+        :param link: create hard link to the file of the body instead of
+            copying it, if it is possible
         """
 
         path_dir, path_fname = os.path.split(path)
@@ -918,10 +1273,16 @@ class Document(TextExtension, RegexpExtension, PyqueryExtension,
             except OSError:
                 pass
 
-        with open(path, 'wb') as out:
-            out.write(self._bytes_body)
+        if (self.body_path and self._bytes_body is None
+                and self._body_loader is None):
+            if not (os.path.exists(path)
+                    and os.path.samefile(self.body_path, path)):
+                copy_file(self.body_path, path, link=link)
+        else:
+            with open(path, 'wb') as out:
+                out.write(self.body)
 
-    def save_hash(self, location, basedir, ext=None):
+    def save_hash(self, location, basedir, ext=None, link=False):
         """
         Save response body into file with special path
         builded from hash. That allows to lower number of files
@@ -934,6 +1295,7 @@ class Document(TextExtension, RegexpExtension, PyqueryExtension,
             some sub-directory of `basedir`
         :param ext: extension which should be appended to file name. The
             dot is inserted automatically between filename and extension.
+        :param link: see `save` method
         :returns: path to saved file relative to `basedir`
 
         Example::
@@ -953,13 +1315,7 @@ class Document(TextExtension, RegexpExtension, PyqueryExtension,
         rel_path = hashed_path(location, ext=ext)
         path = os.path.join(basedir, rel_path)
         if not os.path.exists(path):
-            path_dir, path_fname = os.path.split(path)
-            try:
-                os.makedirs(path_dir)
-            except OSError:
-                pass
-            with open(path, 'wb') as out:
-                out.write(self._bytes_body)
+            self.save(path, link=link)
         return rel_path
 
     @property
@@ -969,10 +1325,28 @@ class Document(TextExtension, RegexpExtension, PyqueryExtension,
         """
 
         if six.PY3:
-            return json.loads(self.body.decode(self.charset))
+            return json.loads(str(self.get_body_buffer(), self.charset))
         else:
             return json.loads(self.body)
 
+    def iter_json(self, path=None):
+        """
+        Decode items of JSON array incrementally and yield them one by one.
+
+        The body (or the file of the body) is read in chunks, so memory
+        usage depends on the size of the item, not on the size of the
+        document. Gzip-compressed body is decompressed on the fly.
+
+        :param path: keys of nested objects which lead to the array e.g.
+            "data.items" or ["data", "items"], None if the whole document
+            is the array
+        """
+
+        with self.open_body() as inp:
+            for item in iter_json_items(inp, path,
+                                        charset=self.charset or 'utf-8'):
+                yield item
+
     def url_details(self):
         """
         Return result of urlsplit function applied to response url.
@@ -1016,11 +1390,138 @@ class Document(TextExtension, RegexpExtension, PyqueryExtension,
         state['_lxml_tree'] = None
         state['_strict_lxml_tree'] = None
         state['_lxml_form'] = None
+        state['_body_mmap'] = None
+        # Body loader could not be pickled
+        if state.get('_body_loader') is not None:
+            state['_bytes_body'] = self.body
+            state['_body_loader'] = None
         return state
 
     def __setstate__(self, state):
         for slot, value in state.items():
             setattr(self, slot, value)
 
+    def dispose(self):
+        """
+        Release DOM trees, pyquery object, unicode body and mapped body file
+        of the document. They are built again on next access. The spider
+        calls this method when the handler of the document returns.
+        """
+
+        self._lxml_tree = None
+        self._strict_lxml_tree = None
+        self._pyquery = None
+        self._lxml_form = None
+        self._unicode_body = None
+        self.close_body_buffer()
+
     def get_meta_refresh_url(self):
         return find_refresh_url(self.unicode_body())
+
+
+class Field(object):
+    """
+    Field of extraction schema, see `Schema`.
+
+    :param xpath: XPath query, it is evaluated relative to the context node
+    :param css: CSS selector which is used if `xpath` is not set
+    :param attr: extract the value of the attribute instead of the text
+    :param converter: function which is applied to each extracted value
+    :param many: extract the list of values of all found nodes, by default
+        only the first node is used
+    :param schema: nested `Schema`, each found node becomes the context
+        node of nested record
+    :param default: value of the field if no nodes are found, by default
+        `DataNotFound` is raised (`many` field is empty list in such case)
+    :param smart: `smart` option of text extraction
+    :param normalize_space: `normalize_space` option of text extraction
+    """
+
+    def __init__(self, xpath=None, css=None, attr=None, converter=None,
+                 many=False, schema=None, default=NULL, smart=False,
+                 normalize_space=True):
+        if xpath is None:
+            if css is None:
+                raise GrabMisuseError('Field requires xpath or css argument')
+            xpath = css_to_xpath(css)
+        self.query = xpath
+        self.compiled_query = compile_xpath(xpath)
+        self.attr = attr
+        self.converter = converter
+        self.many = many
+        self.schema = schema
+        self.default = default
+        self.smart = smart
+        self.normalize_space = normalize_space
+
+    def extract_value(self, node):
+        if self.schema is not None:
+            value = self.schema.extract(node)
+        elif self.attr is not None:
+            value = node.get(self.attr)
+        else:
+            value = get_node_text(node, smart=self.smart,
+                                  normalize_space=self.normalize_space)
+        if self.converter is not None:
+            value = self.converter(value)
+        return value
+
+    def extract(self, node):
+        result = self.compiled_query(node)
+        if not isinstance(result, list):
+            # Result of XPath function e.g. count() or string()
+            if self.converter is not None:
+                result = self.converter(result)
+            return result
+        if self.many:
+            return [self.extract_value(x) for x in result]
+        elif result:
+            return self.extract_value(result[0])
+        elif self.default is NULL:
+            raise DataNotFound(u'Nothing found for query: %s' % self.query)
+        else:
+            return self.default
+
+
+class Schema(object):
+    """
+    Declarative extraction schema.
+
+    Fields are compiled once when the schema is created, so define schemas
+    as attributes of the spider class. The value of the field could be
+    `Field` instance or XPath query. `extract` method returns plain dict
+    which could be passed to `Data`.
+
+    Example::
+
+        class ExampleSpider(Spider):
+            product_schema = Schema(
+                title='//h1',
+                price=Field('//span[@class="price"]', converter=float),
+                tags=Field(css='a[rel=tag]', many=True),
+                offers=Field('//div[@class="offer"]', many=True,
+                             schema=Schema(shop='./b',
+                                           url=Field('./a', attr='href'))),
+            )
+
+            def task_product(self, grab, task):
+                yield Data('product', **self.product_schema.extract(grab.doc))
+    """
+
+    def __init__(self, **fields):
+        self.fields = []
+        for name, field in sorted(fields.items()):
+            if isinstance(field, six.string_types):
+                field = Field(field)
+            self.fields.append((name, field))
+
+    def extract(self, source):
+        """
+        Extract the record from `Document` or from lxml node.
+        """
+
+        if isinstance(source, Document):
+            node = source.tree
+        else:
+            node = source
+        return dict((name, field.extract(node)) for name, field in self.fields)
@@ -0,0 +1,179 @@
+"""
+Headers of HTTP response.
+
+Headers are stored as raw bytes and parsed on first access. Parsing follows
+HTTP rules rather than RFC 822 rules of `email` package: header block is
+split into lines, each line is split by first colon, names are
+case-insensitive, values are decoded from latin-1 and stripped. Obsolete
+line folding (line starting with space or tab) continues the value of the
+previous header.
+
+`HeaderDict` supports the API of `email.message.Message` which is used for
+response headers: `headers['name']` (returns None for missing header),
+`headers.get`, `headers.get_all`, `in`, `keys`, `values` and `items`.
+"""
+from copy import copy
+
+__all__ = ('HeaderDict',)
+
+
+def find_last_response(head):
+    """
+    Return header lines of the last response of the raw head.
+
+    Head could contain multiple responses in case of redirects or
+    "100 Continue" responses. Status line of the response is cut off.
+    """
+
+    pos = head.rfind(b'\nHTTP/')
+    if pos > -1:
+        head = head[pos + 1:]
+    if head.startswith(b'HTTP/'):
+        pos = head.find(b'\n')
+        head = head[pos + 1:] if pos > -1 else b''
+    return head
+
+
+def parse_header_lines(data):
+    """
+    Parse raw header block into list of (name, value) pairs.
+    """
+
+    items = []
+    for line in data.split(b'\n'):
+        line = line.rstrip(b'\r')
+        if not line:
+            if items:
+                # Empty line closes the header block
+                break
+            continue
+        if line[:1] in (b' ', b'\t'):
+            if items:
+                name, value = items[-1]
+                items[-1] = (name, value + ' ' +
+                             line.strip().decode('latin-1'))
+            continue
+        name, sep, value = line.partition(b':')
+        if not sep:
+            continue
+        items.append((name.strip().decode('latin-1'),
+                      value.strip().decode('latin-1')))
+    return items
+
+
+class HeaderDict(object):
+    """
+    Case-insensitive multi-dict of HTTP headers.
+
+    :param head: raw head of the response (bytes), it could contain
+        heads of several responses, only the last one is used
+    :param items: list of (name, value) pairs or dict
+    """
+
+    def __init__(self, head=None, items=None):
+        self._head = head
+        self._items = None
+        self._index = None
+        if items is not None:
+            if isinstance(items, dict):
+                items = items.items()
+            self._items = list(items)
+
+    def _get_items(self):
+        if self._items is None:
+            if self._head:
+                self._items = parse_header_lines(
+                    find_last_response(self._head))
+            else:
+                self._items = []
+            self._head = None
+        return self._items
+
+    def _get_index(self):
+        if self._index is None:
+            index = {}
+            for name, value in self._get_items():
+                index.setdefault(name.lower(), []).append(value)
+            self._index = index
+        return self._index
+
+    def _reset_index(self):
+        self._index = None
+
+    def get(self, name, failobj=None):
+        """
+        Return the value of first header with given name.
+        """
+
+        values = self._get_index().get(name.lower())
+        return values[0] if values else failobj
+
+    def get_all(self, name, failobj=None):
+        """
+        Return list of values of all headers with given name.
+        """
+
+        values = self._get_index().get(name.lower())
+        return list(values) if values else failobj
+
+    def add(self, name, value):
+        """
+        Add header without removing existing headers with same name.
+        """
+
+        self._get_items().append((name, value))
+        self._reset_index()
+
+    def keys(self):
+        return [x[0] for x in self._get_items()]
+
+    def values(self):
+        return [x[1] for x in self._get_items()]
+
+    def items(self):
+        return list(self._get_items())
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __setitem__(self, name, value):
+        del self[name]
+        self.add(name, value)
+
+    def __delitem__(self, name):
+        name = name.lower()
+        self._items = [x for x in self._get_items()
+                       if x[0].lower() != name]
+        self._reset_index()
+
+    def __contains__(self, name):
+        return name.lower() in self._get_index()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._get_items())
+
+    def __eq__(self, other):
+        if isinstance(other, HeaderDict):
+            return self.items() == other.items()
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __copy__(self):
+        obj = self.__class__()
+        obj._head = self._head
+        obj._items = copy(self._items)
+        return obj
+
+    def __repr__(self):
+        return '<HeaderDict %r>' % self.items()
+
+    def as_string(self):
+        return ''.join('%s: %s\n' % x for x in self.items())
+
+    __str__ = as_string
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 import types
 import logging
+import re
 import time
 try:
     from urlparse import urljoin
@@ -22,10 +23,11 @@ import threading
 from datetime import datetime
 
 from grab.base import Grab
+from grab.document import Document
 from grab.error import GrabInvalidUrl
 from grab.spider.error import (SpiderError, SpiderMisuseError, FatalError,
                                NoTaskHandler, NoDataHandler,
-                               SpiderConfigurationError)
+                               SpiderConfigurationError, CacheBodyNotFound)
 from grab.spider.task import Task
 from grab.spider.data import Data
 from grab.spider.transport.multicurl import MulticurlTransport
@@ -35,6 +37,9 @@ from weblib.encoding import make_str, make_unicode
 from grab.base import GLOBAL_STATE
 from grab.stat import Stat, Timer
 from grab.spider.parser_pipeline import ParserPipeline
+from grab.spider.cache_backend.sweeper import (DEFAULT_SWEEP_INTERVAL,
+                                               DEFAULT_SWEEP_BATCH_SIZE)
+from grab.spider.cache_backend.key import CacheKeyBuilder
 from grab.spider.deprecated import DeprecatedThingsSpiderMixin
 from grab.util.warning import warn
 
@@ -42,8 +47,11 @@ DEFAULT_TASK_PRIORITY = 100
 DEFAULT_NETWORK_STREAM_NUMBER = 3
 DEFAULT_TASK_TRY_LIMIT = 3
 DEFAULT_NETWORK_TRY_LIMIT = 3
+DEFAULT_REPLAY_BATCH_SIZE = 1000
 RANDOM_TASK_PRIORITY_RANGE = (50, 100)
 NULL = object()
+# Matches "spider:task-<name>-cache" and "spider:task-<name>-cache-miss"
+RE_TASK_CACHE_COUNTER = re.compile(r'^spider:task-(.+)-cache(-miss)?$')
 
 logger = logging.getLogger('grab.spider.base')
 logger_verbose = logging.getLogger('grab.spider.base.verbose')
@@ -52,6 +60,14 @@ logger_verbose = logging.getLogger('grab.spider.base.verbose')
 logger_verbose.setLevel(logging.FATAL)
 
 
+def get_ratio(value, total):
+    return float(value) / total if total else None
+
+
+def format_ratio(ratio):
+    return 'NA' if ratio is None else '%.2f' % ratio
+
+
 class SpiderMetaClass(type):
     """
     This meta class does following things::
@@ -228,6 +244,7 @@ class Spider(DeprecatedThingsSpiderMixin):
 
         self.task_generator_enabled = False
         self.only_cache = only_cache
+        self.replay_mode = False
 
         self.thread_number = (
             thread_number or
@@ -251,6 +268,9 @@ class Spider(DeprecatedThingsSpiderMixin):
         # Initial cache-subsystem values
         self.cache_enabled = False
         self.cache = None
+        self.cache_config = None
+        self.cache_sweeper_config = None
+        self.cache_key_builder = None
 
         self.work_allowed = True
         if request_pause is not NULL:
@@ -264,16 +284,42 @@ class Spider(DeprecatedThingsSpiderMixin):
         self.interrupted = False
 
     def setup_cache(self, backend='mongo', database=None, use_compression=True,
+                    ttl=None, sweep_interval=DEFAULT_SWEEP_INTERVAL,
+                    sweep_batch_size=DEFAULT_SWEEP_BATCH_SIZE, cache_key=None,
                     **kwargs):
+        """
+        Configure the cache.
+
+        :param ttl: if not None then cache items older than `ttl` seconds
+            are removed by background sweeper
+        :param sweep_interval: how often (in seconds) sweeper removes
+            expired items and evicts items which exceed `max_items` limit
+        :param sweep_batch_size: how many items are removed in one
+            transaction
+        :param cache_key: `CacheKeyBuilder` instance which decides which
+            requests are cached and builds keys of cache items, by default
+            only GET requests are cached under their URLs
+
+        Other options go to the constructor of the cache backend.
+        """
+
         if database is None:
             raise SpiderMisuseError('setup_cache method requires database '
                                     'option')
         self.cache_enabled = True
-        mod = __import__('grab.spider.cache_backend.%s' % backend,
+        self.cache_config = dict(backend=backend, database=database,
+                                 use_compression=use_compression, **kwargs)
+        self.cache_sweeper_config = dict(ttl=ttl, interval=sweep_interval,
+                                         batch_size=sweep_batch_size)
+        self.cache_key_builder = cache_key or CacheKeyBuilder()
+        self.cache = self.create_cache_backend()
+
+    def create_cache_backend(self):
+        config = dict(self.cache_config)
+        mod = __import__('grab.spider.cache_backend.%s'
+                         % config.pop('backend'),
                          globals(), locals(), ['foo'])
-        self.cache = mod.CacheBackend(database=database,
-                                      use_compression=use_compression,
-                                      spider=self, **kwargs)
+        return mod.CacheBackend(spider=self, **config)
 
     def setup_queue(self, backend='memory', **kwargs):
         logger.debug('Using %s backend for task queue' % backend)
@@ -293,6 +339,11 @@ class Spider(DeprecatedThingsSpiderMixin):
             self.parser_result_queue.put((task, None))
             return
 
+        # Replay mode handles only documents which are in the cache
+        if self.replay_mode:
+            self.stat.inc('spider:replay-task-ignored')
+            return False
+
         if self.task_queue is None:
             raise SpiderMisuseError('You should configure task queue before '
                                     'adding tasks. Use `setup_queue` method.')
@@ -428,11 +479,82 @@ class Spider(DeprecatedThingsSpiderMixin):
         out.append('End time: %s' % 
                    datetime.utcnow().strftime('%d %b %Y, %H:%M:%S UTC'))
 
+        if self.cache_enabled:
+            out.append('')
+            out.append(self.render_cache_stats())
+
         if timing:
             out.append('')
             out.append(self.render_timing())
         return '\n'.join(out) + '\n'
 
+    def get_cache_stats(self):
+        """
+        Build summary of cache statistics: hits and misses (total and by
+        task name), bytes read from and written into the cache before and
+        after compression, network traffic which has been saved by
+        the cache.
+        """
+
+        counters = self.stat.counters
+        tasks = {}
+        for key, value in counters.items():
+            match = RE_TASK_CACHE_COUNTER.match(key)
+            if match:
+                task_stat = tasks.setdefault(match.group(1),
+                                             {'hits': 0, 'misses': 0})
+                field = 'misses' if match.group(2) else 'hits'
+                task_stat[field] = value
+        for task_stat in tasks.values():
+            task_stat['hit_ratio'] = get_ratio(
+                task_stat['hits'], task_stat['hits'] + task_stat['misses'])
+        hits = counters.get('spider:request-cache', 0)
+        misses = (counters.get('spider:request-cache-miss', 0)
+                  + counters.get('spider:request-cache-expired', 0))
+        result = {
+            'hits': hits,
+            'misses': misses,
+            'expired': counters.get('spider:request-cache-expired', 0),
+            'revalidated': counters.get('spider:request-cache-revalidated',
+                                        0),
+            'hit_ratio': get_ratio(hits, hits + misses),
+            'tasks': tasks,
+            'traffic_saved': counters.get('spider:download-size-with-cache',
+                                          0),
+        }
+        for direction in ('read', 'written'):
+            size = counters.get('spider:cache-bytes-%s' % direction, 0)
+            packed = counters.get('spider:cache-bytes-%s-packed' % direction,
+                                  0)
+            result['bytes_%s' % direction] = size
+            result['bytes_%s_packed' % direction] = packed
+            result['compression_ratio_%s' % direction] = get_ratio(size,
+                                                                   packed)
+        return result
+
+    def render_cache_stats(self):
+        info = self.get_cache_stats()
+        out = ['Cache:']
+        out.append('  Hits: %d, misses: %d (expired: %d), hit ratio: %s' % (
+            info['hits'], info['misses'], info['expired'],
+            format_ratio(info['hit_ratio'])))
+        for name, task_stat in sorted(info['tasks'].items()):
+            out.append('  Task %s: hits: %d, misses: %d, hit ratio: %s' % (
+                name, task_stat['hits'], task_stat['misses'],
+                format_ratio(task_stat['hit_ratio'])))
+        for direction in ('read', 'written'):
+            out.append('  Bytes %s: %s (packed: %s, compression ratio: %s)'
+                       % (direction,
+                          metric.format_traffic_value(
+                              info['bytes_%s' % direction]),
+                          metric.format_traffic_value(
+                              info['bytes_%s_packed' % direction]),
+                          format_ratio(
+                              info['compression_ratio_%s' % direction])))
+        out.append('  Network traffic saved: %s' %
+                   metric.format_traffic_value(info['traffic_saved']))
+        return '\n'.join(out) + '\n'
+
     def render_timing(self):
         out = ['Timers:']
         out.append('  DOM: %.3f' % GLOBAL_STATE['dom_build_time'])
@@ -440,6 +562,12 @@ class Spider(DeprecatedThingsSpiderMixin):
         time_items = sorted(time_items, key=lambda x: x[1])
         for time_item in time_items:
             out.append('  %s: %.03f' % time_item)
+        if self.stat.histograms:
+            out.append('Latency (count, p50, p90, p99, max):')
+            for key, hist in sorted(self.stat.histograms.items()):
+                out.append('  %s: %d, %.4f, %.4f, %.4f, %.4f' % (
+                    key, hist.count, hist.percentile(50),
+                    hist.percentile(90), hist.percentile(99), hist.max))
         return '\n'.join(out) + '\n'
 
     # ********************************
@@ -473,6 +601,21 @@ class Spider(DeprecatedThingsSpiderMixin):
 
         pass
 
+    def create_replay_task(self, cache_item, task_name=None):
+        """
+        Build the task which handles cached document in replay mode.
+
+        By default the task named `task_name` is created. Redefine this
+        method to choose the task by URL or other fields of the cache
+        item. Return None to skip the document.
+        """
+
+        if task_name is None:
+            raise SpiderMisuseError('Method `run_replay` requires `task_name`'
+                                    ' option or custom `create_replay_task`'
+                                    ' method')
+        return Task(task_name, url=cache_item['url'])
+
     def update_grab_instance(self, grab):
         """
         Use this method to automatically update config of any
@@ -609,11 +752,20 @@ class Spider(DeprecatedThingsSpiderMixin):
         else:
             grab.setup(url=task.url)
 
+        if task.get('parser_profile') is not None:
+            grab.config['parser_profile'] = task.parser_profile
+
         # Generate new common headers
         grab.config['common_headers'] = grab.common_headers()
         self.update_grab_instance(grab)
         return grab
 
+    def get_cache_key_builder(self, task):
+        return task.get('cache_key') or self.cache_key_builder
+
+    def build_cache_key(self, task, grab_config):
+        return self.get_cache_key_builder(task).build_key(grab_config)
+
     def is_task_cacheable(self, task, grab):
         if (    # cache is disabled for all tasks
                 not self.cache_enabled
@@ -622,23 +774,73 @@ class Spider(DeprecatedThingsSpiderMixin):
                 # cache could not be used
                 or task.get('disable_cache', False)
                 # request type is not cacheable
-                or grab.detect_request_method() != 'GET'):
+                or not self.get_cache_key_builder(task).is_cacheable(
+                    grab.config)):
             return False
         else:
             return True
 
+    def is_cache_item_fresh(self, cache_item, timeout):
+        if timeout is None:
+            return True
+        else:
+            return cache_item['timestamp'] > int(time.time()) - timeout
+
+    def setup_cache_revalidation(self, task, grab, cache_item):
+        """
+        Configure conditional request with validators (ETag,
+        Last-Modified) of expired cache item.
+
+        Returns True if cache item has any validators.
+        """
+
+        doc = Document()
+        doc.head = cache_item['head']
+        doc.parse(charset='utf-8')
+        validators = {}
+        if doc.headers.get('ETag'):
+            validators['If-None-Match'] = doc.headers['ETag']
+        if doc.headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = doc.headers['Last-Modified']
+        if validators:
+            headers = dict(grab.config['headers'])
+            headers.update(validators)
+            grab.setup(headers=headers)
+            task.cache_revalidation = True
+            return True
+        else:
+            return False
+
     def load_task_from_cache(self, task, grab, grab_config_backup):
         with self.timer.log_time('cache'):
             with self.timer.log_time('cache.read'):
-                cache_item = self.cache.get_item(
-                    grab.config['url'], timeout=task.cache_timeout)
+                with self.stat.measure_time('cache.get_item'):
+                    cache_item = self.cache.get_item(
+                        self.build_cache_key(task, grab_config_backup))
                 if cache_item is None:
+                    self.stat.inc('spider:request-cache-miss')
+                    self.stat.inc('spider:task-%s-cache-miss' % task.name)
+                    return None
+                elif not self.is_cache_item_fresh(cache_item,
+                                                  task.cache_timeout):
+                    self.stat.inc('spider:request-cache-expired')
+                    self.stat.inc('spider:task-%s-cache-miss' % task.name)
+                    self.setup_cache_revalidation(task, grab, cache_item)
                     return None
                 else:
                     with self.timer.log_time('cache.read.prepare_request'):
                         grab.prepare_request()
                     with self.timer.log_time('cache.read.load_response'):
-                        self.cache.load_response(grab, cache_item)
+                        with self.stat.measure_time('cache.load_response'):
+                            try:
+                                self.cache.load_response(grab, cache_item)
+                            except CacheBodyNotFound:
+                                # The body has been removed after the item
+                                # has been loaded
+                                self.stat.inc('spider:request-cache-miss')
+                                self.stat.inc('spider:task-%s-cache-miss'
+                                              % task.name)
+                                return None
 
                     grab.log_request('CACHED')
                     self.stat.inc('spider:request-cache')
@@ -647,6 +849,49 @@ class Spider(DeprecatedThingsSpiderMixin):
                             'grab_config_backup': grab_config_backup,
                             'task': task, 'emsg': None}
 
+    def process_cache_revalidation(self, res):
+        """
+        Process the response to conditional request. If the document
+        has not been modified then load it from the cache and mark cache
+        item as fresh.
+
+        Returns True if the document has been loaded from the cache.
+
+        If the cache item has been removed since the request was sent (e.g.
+        it has expired or has been evicted) then the result is marked as
+        failed, so the task is sent again without conditional headers.
+        """
+
+        if (res['ok'] and res['task'].get('cache_revalidation')
+                and res['grab'].response.code == 304):
+            with self.timer.log_time('cache'):
+                with self.timer.log_time('cache.read'):
+                    key = self.build_cache_key(res['task'],
+                                               res['grab_config_backup'])
+                    cache_item = self.cache.get_item(key)
+                    if cache_item is not None:
+                        # Network transport of the grab object has been
+                        # released, so the cached document is loaded
+                        # into the clone
+                        grab = res['grab'].clone()
+                        grab.prepare_request()
+                        try:
+                            self.cache.load_response(grab, cache_item)
+                        except CacheBodyNotFound:
+                            cache_item = None
+                    if cache_item is not None:
+                        res['grab'] = grab
+                        self.cache.touch_item(key)
+                        self.stat.inc('spider:request-cache-revalidated')
+                        return True
+                    else:
+                        self.stat.inc('spider:request-cache-revalidation-miss')
+                        res['ok'] = False
+                        res['emsg'] = ('Cache item of not modified document '
+                                       'is missing')
+                        res['error_abbr'] = 'cache-revalidation-miss'
+        return False
+
     def is_valid_network_response_code(self, code, task):
         """
         Answer the question: if the response could be handled via
@@ -787,6 +1032,10 @@ class Spider(DeprecatedThingsSpiderMixin):
         except Exception as ex:
             ex.tb = format_exc()
             self.parser_result_queue.put((ex, result['task']))
+        finally:
+            # Free memory of DOM tree before next document is parsed
+            if result['grab'] is not None:
+                result['grab'].doc.dispose()
 
     def find_task_handler(self, task):
         if task.origin_task_generator is not None:
@@ -911,13 +1160,23 @@ class Spider(DeprecatedThingsSpiderMixin):
 
         if res['ok']:
             if self.cache_enabled:
-                if res['grab'].request_method == 'GET':
+                if self.get_cache_key_builder(res['task']).is_cacheable(
+                        res['grab_config_backup']):
                     if not res['task'].get('disable_cache'):
                         if self.is_valid_network_response_code(
                                 res['grab'].response.code, res['task']):
                             return True
         return False
 
+    def start_cache_sweeper_thread(self):
+        from grab.spider.cache_backend.sweeper import CacheSweeperThread
+
+        # The sweeper uses separate connection to the cache storage
+        proc = CacheSweeperThread(self, self.create_cache_backend(),
+                                  **self.cache_sweeper_config)
+        proc.start()
+        return proc
+
     def start_api_thread(self):
         from grab.spider.http_api import HttpApiThread
 
@@ -957,6 +1216,13 @@ class Spider(DeprecatedThingsSpiderMixin):
         else:
             http_api_proc = None
 
+        if self.cache_enabled and (
+                self.cache_sweeper_config['ttl'] is not None
+                or getattr(self.cache, 'max_items', None) is not None):
+            cache_sweeper_proc = self.start_cache_sweeper_thread()
+        else:
+            cache_sweeper_proc = None
+
         self.parser_pipeline = ParserPipeline(
             bot=self,
             mp_mode=self.mp_mode,
@@ -1025,6 +1291,7 @@ class Spider(DeprecatedThingsSpiderMixin):
                             grab_config_backup = grab.dump_config()
 
                             result_from_cache = None
+                            task.cache_revalidation = False
                             if self.is_task_cacheable(task, grab):
                                 result_from_cache = self.load_task_from_cache(
                                     task, grab, grab_config_backup)
@@ -1075,12 +1342,22 @@ class Spider(DeprecatedThingsSpiderMixin):
                                 time.sleep(0.1)
 
                 for result, from_cache in results:
+                    if not from_cache:
+                        from_cache = self.process_cache_revalidation(result)
                     if not from_cache:
                         if self.is_valid_for_cache(result):
+                            key = self.build_cache_key(
+                                result['task'], result['grab_config_backup'])
                             with self.timer.log_time('cache'):
                                 with self.timer.log_time('cache.write'):
-                                    self.cache.save_response(
-                                        result['task'].url, result['grab'])
+                                    with self.stat.measure_time(
+                                            'cache.save_response'):
+                                        prev_digest = self.cache.save_response(
+                                            key, result['grab'])
+                            doc = result['grab'].doc
+                            doc.previous_body_digest = prev_digest
+                            if doc.body_unchanged:
+                                self.stat.inc('spider:cache-body-unchanged')
                     self.log_network_result_stats(
                         result, from_cache=from_cache)
                     if self.is_valid_network_result(result):
@@ -1099,19 +1376,13 @@ class Spider(DeprecatedThingsSpiderMixin):
                                 result['grab_config_backup'])
                             self.add_task(result['task'])
                     if from_cache:
-                        self.stat.inc('spider:task-%s-cache' % task.name)
+                        self.stat.inc('spider:task-%s-cache'
+                                      % result['task'].name)
                     self.stat.inc('spider:request')
 
                 # MP:
                 # ***
-                while True:
-                    try:
-                        p_res, p_task = self.parser_pipeline.get_result()
-                    except queue.Empty:
-                        break
-                    else:
-                        self.stat.inc('spider:parser-result')
-                        self.process_handler_result(p_res, p_task)
+                self.process_parser_results()
 
                 if not self.shutdown_event.is_set():
                     self.parser_pipeline.check_pool_health()
@@ -1133,6 +1404,10 @@ class Spider(DeprecatedThingsSpiderMixin):
                 http_api_proc.server.shutdown()
                 http_api_proc.join()
 
+            if cache_sweeper_proc:
+                cache_sweeper_proc.stop()
+                cache_sweeper_proc.join()
+
             if self.task_queue:
                 self.task_queue.clear()
 
@@ -1141,6 +1416,104 @@ class Spider(DeprecatedThingsSpiderMixin):
             self.parser_pipeline.shutdown()
             logger.debug('Main process [pid=%s]: work done' % os.getpid())
 
+    def run_replay(self, task_name=None,
+                   batch_size=DEFAULT_REPLAY_BATCH_SIZE):
+        """
+        Process all documents stored in the cache without network requests.
+
+        Cache items are loaded in batches in the order they are stored in
+        the database. Each document is passed to the handler of the task
+        built with `create_replay_task` method. Use `mp_mode=True` to run
+        handlers in all CPU cores. New tasks which are yielded by handlers
+        are ignored.
+        """
+
+        if not self.cache_enabled:
+            raise SpiderMisuseError('Method `run_replay` requires configured '
+                                    'cache. Use `setup_cache` method.')
+        self.replay_mode = True
+        self.timer.start('total')
+        self.parser_pipeline = ParserPipeline(
+            bot=self,
+            mp_mode=self.mp_mode,
+            pool_size=self.parser_pool_size,
+            shutdown_event=self.shutdown_event,
+            network_result_queue=self.network_result_queue,
+            requests_per_process=self.parser_requests_per_process,
+        )
+        network_result_queue_limit = self.parser_pipeline.pool_size * 10
+
+        try:
+            self.prepare()
+            items = self.cache.iterate_items(batch_size=batch_size)
+            while self.work_allowed:
+                with self.timer.log_time('cache'):
+                    with self.timer.log_time('cache.read'):
+                        cache_item = next(items, None)
+                if cache_item is None:
+                    break
+                task = self.create_replay_task(cache_item,
+                                               task_name=task_name)
+                if task is None:
+                    self.stat.inc('spider:replay-item-skipped')
+                    continue
+                task.network_try_count += 1
+                grab = self.setup_grab_for_task(task)
+                grab_config_backup = grab.dump_config()
+                with self.timer.log_time('cache'):
+                    with self.timer.log_time('cache.read.load_response'):
+                        grab.prepare_request()
+                        try:
+                            self.cache.load_response(grab, cache_item)
+                        except CacheBodyNotFound:
+                            self.stat.inc('spider:replay-item-skipped')
+                            continue
+                result = {'ok': True, 'grab': grab,
+                          'grab_config_backup': grab_config_backup,
+                          'task': task, 'emsg': None}
+                self.log_network_result_stats(result, from_cache=True)
+                self.stat.inc('spider:task-%s-cache' % task.name)
+                self.network_result_queue.put(result)
+                # Do not load cache items faster than parsers handle them
+                while True:
+                    self.process_parser_results()
+                    if (self.network_result_queue.qsize()
+                            < network_result_queue_limit):
+                        break
+                    time.sleep(0.01)
+                if not self.shutdown_event.is_set():
+                    self.parser_pipeline.check_pool_health()
+
+            while self.work_allowed and not (
+                    self.parser_pipeline.is_waiting_shutdown()
+                    and not self.network_result_queue.qsize()):
+                self.process_parser_results()
+                time.sleep(0.1)
+            self.process_parser_results()
+            logger_verbose.debug('Replay done')
+        except KeyboardInterrupt:
+            logger.info('\nGot ^C signal in process %d. Stopping.'
+                        % os.getpid())
+            self.interrupted = True
+            raise
+        finally:
+            self.timer.stop('total')
+            self.stat.print_progress_line()
+            self.shutdown()
+            self.shutdown_event.set()
+            self.parser_pipeline.shutdown()
+            self.replay_mode = False
+
+    def process_parser_results(self):
+        while True:
+            try:
+                p_res, p_task = self.parser_pipeline.get_result()
+            except queue.Empty:
+                break
+            else:
+                self.stat.inc('spider:parser-result')
+                self.process_handler_result(p_res, p_task)
+
     def log_failed_network_result(self, res):
         # Log the error
         if res['ok']:
@@ -1194,6 +1567,11 @@ class Spider(DeprecatedThingsSpiderMixin):
                                            task)
         elif result is None:
             pass
+        elif isinstance(result, CacheBodyNotFound):
+            # The body of cached document has been removed before the
+            # handler accessed it
+            self.stat.inc('spider:cache-body-missing')
+            self.add_task(task.clone(refresh_cache=True))
         elif isinstance(result, Exception): 
             handler = self.find_task_handler(task)
             handler_name = getattr(handler, '__name__', 'NONE')
@@ -0,0 +1,291 @@
+"""
+Compression codecs for cache records.
+
+Each packed value starts with a one-byte tag which tells which codec was
+used to build it. The tag of "zlib_dict" value is followed by 4-byte id of
+preset dictionary. Values written by older versions of grab have no tag:
+they are plain zlib streams (or raw data if compression was disabled).
+
+Supported codecs:
+* None - no compression
+* "zlib" - zlib compression
+* "zlib_dict" - zlib compression with preset dictionary (zdict) trained
+    per domain from sampled responses. Dictionaries are stored by the
+    cache backend, their ids are stored in each packed value.
+* "lzma" - slow but strong compression, useful for cold data
+"""
+import zlib
+import struct
+import logging
+from hashlib import sha1
+from collections import defaultdict, OrderedDict
+import six
+from six.moves.urllib.parse import urlsplit
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from grab.spider.error import SpiderConfigurationError
+
+TAG_NONE = b'\x01'
+TAG_ZLIB = b'\x02'
+TAG_ZLIB_DICT = b'\x03'
+TAG_LZMA = b'\x04'
+CODEC_TAGS = {
+    None: TAG_NONE,
+    'zlib': TAG_ZLIB,
+    'zlib_dict': TAG_ZLIB_DICT,
+    'lzma': TAG_LZMA,
+}
+# zlib could use only last 32KB of preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+DICTIONARY_SAMPLE_LIMIT = 20
+# Max size of one sample: its head and tail are kept, boilerplate of the
+# page is usually there
+DICTIONARY_SAMPLE_SIZE = 64 * 1024
+# Max number of domains which are waiting for enough samples
+DICTIONARY_MAX_DOMAINS = 1000
+DICTIONARY_MIN_CHUNK = 8
+STREAM_CHUNK_SIZE = 256 * 1024
+ZDICT_SUPPORTED = six.PY3
+logger = logging.getLogger('grab.spider.cache_backend.codec')
+
+
+def build_dictionary_id(dictionary):
+    return struct.unpack('>I', sha1(dictionary).digest()[:4])[0]
+
+
+def get_url_domain(url):
+    try:
+        return urlsplit(url).hostname or ''
+    except ValueError:
+        return ''
+
+
+class DictionaryTrainer(object):
+    """
+    Collects samples of cached documents and builds zlib preset
+    dictionary for each domain.
+
+    The dictionary consists of chunks (lines) which are found in more
+    than one sample. Most common chunks are placed at the end of the
+    dictionary because zlib encodes short distances more efficiently.
+
+    Samples are kept for at most `max_domains` domains, samples of least
+    recently seen domain are dropped when new domain appears.
+    """
+
+    def __init__(self, sample_limit=DICTIONARY_SAMPLE_LIMIT,
+                 dictionary_size=DICTIONARY_SIZE,
+                 sample_size=DICTIONARY_SAMPLE_SIZE,
+                 max_domains=DICTIONARY_MAX_DOMAINS):
+        self.sample_limit = sample_limit
+        self.dictionary_size = dictionary_size
+        self.sample_size = sample_size
+        self.max_domains = max_domains
+        self.samples = OrderedDict()
+
+    def add_sample(self, domain, data):
+        """
+        Remember the sample. Return the dictionary when enough samples
+        for the domain have been collected else return None.
+        """
+
+        if len(data) > self.sample_size:
+            half = self.sample_size // 2
+            data = data[:half] + data[-half:]
+        samples = self.samples.pop(domain, None)
+        if samples is None:
+            samples = []
+            if len(self.samples) >= self.max_domains:
+                self.samples.popitem(last=False)
+        self.samples[domain] = samples
+        samples.append(data)
+        if len(samples) >= self.sample_limit:
+            del self.samples[domain]
+            return self.build_dictionary(samples)
+        else:
+            return None
+
+    def build_dictionary(self, samples):
+        freq = defaultdict(int)
+        for sample in samples:
+            for chunk in set(sample.splitlines(True)):
+                if len(chunk) >= DICTIONARY_MIN_CHUNK:
+                    freq[chunk] += 1
+        chunks = sorted((x for x in freq.items() if x[1] > 1),
+                        key=lambda x: (x[1], len(x[0])))
+        dictionary = b''.join(x[0] for x in chunks)
+        return dictionary[-self.dictionary_size:]
+
+
+class CacheCodec(object):
+    """
+    Packs and unpacks values stored in the cache.
+
+    :param compression: name of codec used to pack new values
+    :param backend: cache backend, it is used to load and save preset
+        dictionaries of "zlib_dict" codec
+    :param legacy_compression: how to unpack values which have been
+        written by older versions of grab: if True then they are
+        decompressed with zlib
+    :param stat: `Stat` instance which counts raw and packed sizes of
+        values in "spider:cache-bytes-*" counters
+    """
+
+    def __init__(self, compression='zlib', backend=None,
+                 legacy_compression=True, compression_level=6,
+                 trainer=None, stat=None):
+        if compression not in CODEC_TAGS:
+            raise SpiderConfigurationError('Unknown cache compression: %s'
+                                           % compression)
+        if compression == 'lzma' and lzma is None:
+            raise SpiderConfigurationError('Cache compression "lzma" requires'
+                                           ' lzma module')
+        if compression == 'zlib_dict':
+            if not ZDICT_SUPPORTED:
+                raise SpiderConfigurationError(
+                    'Cache compression "zlib_dict" requires python 3')
+            if backend is None:
+                raise SpiderConfigurationError(
+                    'Cache compression "zlib_dict" requires cache backend '
+                    'to store dictionaries')
+        self.compression = compression
+        self.backend = backend
+        self.legacy_compression = legacy_compression
+        self.compression_level = compression_level
+        self.trainer = trainer or DictionaryTrainer()
+        self.stat = stat
+        self.dictionaries = None
+        self.domain_dictionaries = None
+
+    def load_dictionaries(self):
+        self.dictionaries = {}
+        self.domain_dictionaries = {}
+        if self.backend is not None:
+            for dict_id, domain, data in self.backend.load_dictionaries():
+                self.dictionaries[dict_id] = bytes(data)
+                self.domain_dictionaries[domain] = dict_id
+
+    def register_dictionary(self, domain, dictionary):
+        dict_id = build_dictionary_id(dictionary)
+        self.backend.save_dictionary(dict_id, domain, dictionary)
+        self.dictionaries[dict_id] = dictionary
+        self.domain_dictionaries[domain] = dict_id
+        logger.debug('Trained compression dictionary %d for %s (%d bytes)'
+                     % (dict_id, domain, len(dictionary)))
+        return dict_id
+
+    def get_dictionary(self, dict_id):
+        if self.dictionaries is None or dict_id not in self.dictionaries:
+            # The dictionary could be trained by another spider
+            # process after we have loaded dictionaries
+            self.load_dictionaries()
+        return self.dictionaries[dict_id]
+
+    def count_bytes(self, direction, size, packed_size):
+        if self.stat is not None:
+            self.stat.inc('spider:cache-bytes-%s' % direction, size)
+            self.stat.inc('spider:cache-bytes-%s-packed' % direction,
+                          packed_size)
+
+    def encode(self, data, url=None):
+        if self.compression is None:
+            packed = TAG_NONE + data
+        elif self.compression == 'zlib':
+            packed = TAG_ZLIB + zlib.compress(data, self.compression_level)
+        elif self.compression == 'lzma':
+            packed = TAG_LZMA + lzma.compress(data)
+        else:
+            packed = self.encode_with_dictionary(data, url)
+        self.count_bytes('written', len(data), len(packed))
+        return packed
+
+    def encode_with_dictionary(self, data, url):
+        if self.dictionaries is None:
+            self.load_dictionaries()
+        domain = get_url_domain(url) if url else ''
+        dict_id = self.domain_dictionaries.get(domain)
+        if dict_id is None:
+            dictionary = self.trainer.add_sample(domain, data)
+            if dictionary:
+                dict_id = self.register_dictionary(domain, dictionary)
+        if dict_id is None:
+            return TAG_ZLIB + zlib.compress(data, self.compression_level)
+        else:
+            cobj = zlib.compressobj(self.compression_level, zlib.DEFLATED,
+                                    zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                    zlib.Z_DEFAULT_STRATEGY,
+                                    self.dictionaries[dict_id])
+            return (TAG_ZLIB_DICT + struct.pack('>I', dict_id) +
+                    cobj.compress(data) + cobj.flush())
+
+    def decode(self, data):
+        data = bytes(data)
+        result = self.decode_value(data)
+        self.count_bytes('read', len(result), len(data))
+        return result
+
+    def decode_value(self, data):
+        tag = data[:1]
+        if tag == TAG_NONE:
+            return data[1:]
+        elif tag == TAG_ZLIB:
+            return zlib.decompress(data[1:])
+        elif tag == TAG_ZLIB_DICT:
+            dict_id = struct.unpack('>I', data[1:5])[0]
+            dobj = zlib.decompressobj(zlib.MAX_WBITS,
+                                      self.get_dictionary(dict_id))
+            return dobj.decompress(data[5:]) + dobj.flush()
+        elif tag == TAG_LZMA:
+            if lzma is None:
+                raise SpiderConfigurationError('Could not unpack cache value'
+                                               ' without lzma module')
+            return lzma.decompress(data[1:])
+        elif self.legacy_compression:
+            return zlib.decompress(data)
+        else:
+            return data
+
+    def decode_stream(self, stream, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Unpack value which is read from file-like object chunk by chunk
+        so the whole packed value is never held in memory.
+        """
+
+        header = stream.read(5)
+        tag = header[:1]
+        if tag == TAG_NONE:
+            result = header[1:] + stream.read()
+            self.count_bytes('read', len(result), len(result) + 1)
+            return result
+        elif tag == TAG_ZLIB:
+            dobj = zlib.decompressobj()
+            rest = header[1:]
+        elif tag == TAG_ZLIB_DICT:
+            dict_id = struct.unpack('>I', header[1:5])[0]
+            dobj = zlib.decompressobj(zlib.MAX_WBITS,
+                                      self.get_dictionary(dict_id))
+            rest = b''
+        elif tag == TAG_LZMA:
+            if lzma is None:
+                raise SpiderConfigurationError('Could not unpack cache value'
+                                               ' without lzma module')
+            dobj = lzma.LZMADecompressor()
+            rest = header[1:]
+        else:
+            return self.decode(header + stream.read())
+        parts = [dobj.decompress(rest)]
+        packed_size = len(header)
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            packed_size += len(chunk)
+            parts.append(dobj.decompress(chunk))
+        if hasattr(dobj, 'flush'):
+            parts.append(dobj.flush())
+        result = b''.join(parts)
+        self.count_bytes('read', len(result), packed_size)
+        return result
@@ -0,0 +1,120 @@
+"""
+Keys of cache items.
+
+Cache backends store items under SHA1 hash of the key. The key of GET
+request without extra options is the URL itself, so caches built by older
+versions of grab remain valid. Other parts of the key (request method,
+digest of the request body and selected headers) are appended to the URL
+on separate lines.
+"""
+from hashlib import sha1
+from six.moves.urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from grab.upload import UploadContent, UploadFile
+from grab.util.misc import make_bytes
+
+
+def normalize_post_value(value):
+    if isinstance(value, UploadContent):
+        digest = sha1(make_bytes(value.content)).hexdigest()
+        return b'content:' + make_bytes(digest)
+    elif isinstance(value, UploadFile):
+        return b'file:' + make_bytes(value.path)
+    else:
+        return make_bytes(value)
+
+
+def normalize_post(post):
+    """
+    Convert POST data into byte string which does not depend on the order
+    of fields.
+    """
+
+    if post is None:
+        return None
+    elif isinstance(post, dict):
+        items = post.items()
+    elif isinstance(post, (list, tuple)):
+        items = post
+    else:
+        return make_bytes(post)
+    return b'&'.join(sorted(make_bytes(key) + b'=' + normalize_post_value(val)
+                            for key, val in items))
+
+
+def get_key_url(key):
+    """
+    Return URL which the key has been built from.
+    """
+
+    return key.split('\n', 1)[0]
+
+
+def get_request_method(config):
+    """
+    Find request method of Grab config. Works like
+    `Grab.detect_request_method` but could be used for config dumps
+    made before the request.
+    """
+
+    if config['method']:
+        return config['method'].upper()
+    elif config['post'] or config['multipart_post']:
+        return 'POST'
+    else:
+        return 'GET'
+
+
+class CacheKeyBuilder(object):
+    """
+    Builds the key of cache item from the config of Grab instance.
+    Use config made before the request: Grab resets request method
+    and POST data after the request.
+
+    :param methods: request methods which responses could be cached
+    :param include_method: add request method to the key of non-GET
+        request
+    :param include_body: add digest of normalized request body (POST data)
+        to the key
+    :param headers: names of request headers which are added to the key
+    :param ignore_query_params: names of query string parameters which are
+        removed from the URL before it is added to the key e.g.
+        session ids or tracking parameters
+    """
+
+    def __init__(self, methods=('GET',), include_method=True,
+                 include_body=True, headers=None, ignore_query_params=None):
+        self.methods = set(x.upper() for x in methods)
+        self.include_method = include_method
+        self.include_body = include_body
+        self.headers = [x.lower() for x in headers or ()]
+        self.ignore_query_params = set(ignore_query_params or ())
+
+    def is_cacheable(self, config):
+        return get_request_method(config) in self.methods
+
+    def normalize_url(self, url):
+        if not self.ignore_query_params:
+            return url
+        parts = urlsplit(url)
+        query = [x for x in parse_qsl(parts.query, keep_blank_values=True)
+                 if x[0] not in self.ignore_query_params]
+        return urlunsplit((parts.scheme, parts.netloc, parts.path,
+                           urlencode(query), parts.fragment))
+
+    def build_key(self, config):
+        parts = [self.normalize_url(config['url'])]
+        method = get_request_method(config)
+        if self.include_method and method != 'GET':
+            parts.append(method)
+        if self.include_body:
+            body = normalize_post(config['post'] or config['multipart_post'])
+            if body:
+                parts.append('body:%s' % sha1(body).hexdigest())
+        if self.headers:
+            request_headers = dict((x.lower(), y) for x, y in
+                                   (config['headers'] or {}).items())
+            for name in self.headers:
+                if name in request_headers:
+                    parts.append('%s: %s' % (name, request_headers[name]))
+        return '\n'.join(parts)
@@ -1,35 +1,89 @@
 """
 CacheItem interface:
 '_id': string,
+'key': string, # key of the item, starts with the URL
 'url': string,
+'timestamp': int, # time when the item was saved
+'access_time': int, # time when the item was read (used by "lru" eviction)
 'response_url': string,
-'body': string,
+'body_digest': string, # SHA1 of body, the body is stored in `cache_body`
+'body_size': int, # size of decompressed body
 'head': string,
 'response_code': int,
+'charset': string, # charset of the document
+'bom': string,
 'cookies': None,#grab.response.cookies,
 
+Items are stored as binary records, see `grab.spider.cache_backend.record`,
+in `data` field of the document. Fields which are used in queries are
+also stored in the document: `_id`, `timestamp`, `access_time`,
+`body_digest`.
+
 TODO: WTF with cookies???
+
+Bodies are stored in `cache_body` collection:
+'_id': string, # SHA1 of body
+'body': string, # missing if the body is stored in GridFS
+'gridfs': bool, # True if the body is stored in `cache_body_fs` GridFS
+'refs': int, # number of cache items which point to the body
 """
+from collections import Counter
 from hashlib import sha1
-import zlib
 import logging
+import gridfs
+from gridfs.errors import FileExists, NoFile
 import pymongo
+from pymongo import UpdateOne, ReplaceOne
 from bson import Binary
 import time
-import six
 from weblib.encoding import make_str
 
-from grab.response import Response
-from grab.cookie import CookieManager
+from grab.spider.cache_backend.codec import CacheCodec
+from grab.spider.cache_backend.record import (
+    pack_record, unpack_record, build_response_item, load_cached_response)
+from grab.spider.cache_backend.sweeper import get_eviction_field
+from grab.spider.error import CacheBodyNotFound
 
 logger = logging.getLogger('grab.spider.cache_backend.mongo')
+# Packed bodies larger than this are stored in GridFS because
+# the maximum BSON document size is 16 megabytes
+DEFAULT_GRIDFS_THRESHOLD = 15 * 1024 * 1024
+# Fields of cache item which are not loaded by `get_item`
+GET_ITEM_PROJECTION = {'body': 0, 'cookies': 0}
 
 
 class CacheBackend(object):
-    def __init__(self, database, use_compression=True, spider=None, **kwargs):
+    """
+    Cache backend which stores items in MongoDB database.
+
+    :param gridfs_threshold: packed bodies larger than `gridfs_threshold`
+        bytes are stored in GridFS
+    """
+
+    def __init__(self, database, use_compression=True, spider=None,
+                 compression='zlib', max_items=None,
+                 eviction_policy='oldest',
+                 gridfs_threshold=DEFAULT_GRIDFS_THRESHOLD, **kwargs):
         self.spider = spider
+        self.max_items = max_items
+        self.eviction_policy = eviction_policy
+        self.eviction_field = get_eviction_field(eviction_policy)
+        self.gridfs_threshold = gridfs_threshold
         self.db = pymongo.MongoClient(**kwargs)[database]
+        self.fs = gridfs.GridFS(self.db, collection='cache_body_fs')
+        self.db.cache.create_index('timestamp')
+        if self.eviction_policy == 'lru':
+            self.db.cache.create_index('access_time')
         self.use_compression = use_compression
+        self.codec = CacheCodec(compression if use_compression else None,
+                                backend=self,
+                                stat=spider.stat if spider else None,
+                                legacy_compression=use_compression)
+
+    def build_query(self, query, timeout):
+        if timeout is not None:
+            query['timestamp'] = {'$gt': int(time.time()) - timeout}
+        return query
 
     def get_item(self, url, timeout=None):
         """
@@ -37,12 +91,57 @@ class CacheBackend(object):
         """
 
         _hash = self.build_hash(url)
-        if timeout is not None:
-            ts = int(time.time()) - timeout
-            query = {'_id': _hash, 'timestamp': {'$gt': ts}}
-        else:
-            query = {'_id': _hash}
-        return self.db.cache.find_one(query)
+        doc = self.db.cache.find_one(self.build_query({'_id': _hash},
+                                                      timeout),
+                                     GET_ITEM_PROJECTION)
+        if doc is None:
+            return None
+        if self.eviction_policy == 'lru':
+            self.db.cache.update_one(
+                {'_id': _hash}, {'$set': {'access_time': int(time.time())}})
+        return self.unpack_document(doc)
+
+    def get_items(self, urls, timeout=None):
+        """
+        Load many items with one query.
+
+        Returns dict which maps URL to cache item. URLs which are not found
+        in the cache are not included into the dict.
+        """
+
+        hashes = dict((self.build_hash(x), x) for x in urls)
+        if not hashes:
+            return {}
+        docs = list(self.db.cache.find(
+            self.build_query({'_id': {'$in': list(hashes)}}, timeout),
+            GET_ITEM_PROJECTION))
+        if docs and self.eviction_policy == 'lru':
+            self.db.cache.update_many(
+                {'_id': {'$in': [x['_id'] for x in docs]}},
+                {'$set': {'access_time': int(time.time())}})
+        return dict((hashes[x['_id']], self.unpack_document(x))
+                    for x in docs)
+
+    def unpack_document(self, doc):
+        """
+        Build cache item from the document of `cache` collection.
+        """
+
+        if 'data' not in doc:
+            # Item saved by older version of grab
+            return doc
+        item = unpack_record(doc['data'])
+        item['_id'] = doc['_id']
+        item['timestamp'] = doc['timestamp']
+        return item
+
+    def touch_item(self, url):
+        """
+        Update the timestamp of cache item i.e. mark it as fresh.
+        """
+
+        self.db.cache.update_one({'_id': self.build_hash(url)},
+                                 {'$set': {'timestamp': int(time.time())}})
 
     def build_hash(self, url):
         utf_url = make_str(url)
@@ -50,72 +149,276 @@ class CacheBackend(object):
 
     def remove_cache_item(self, url):
         _hash = self.build_hash(url)
-        self.db.cache.remove({'_id': _hash})
+        item = self.db.cache.find_one({'_id': _hash}, {'body_digest': 1})
+        self.db.cache.delete_one({'_id': _hash})
+        if item and item.get('body_digest'):
+            self.release_bodies([item['body_digest']])
+
+    def get_body_digest(self, url):
+        item = self.db.cache.find_one({'_id': self.build_hash(url)},
+                                      {'body_digest': 1})
+        return item.get('body_digest') if item else None
+
+    def iterate_items(self, batch_size=1000):
+        """
+        Iterate over all cache items in the order they are stored
+        on the disk. Items are loaded in batches, bodies of each batch
+        are loaded with one query.
+        """
+
+        cursor = (self.db.cache.find({}, batch_size=batch_size)
+                               .sort('$natural', pymongo.ASCENDING))
+        batch = []
+        for doc in cursor:
+            batch.append(self.unpack_document(doc))
+            if len(batch) >= batch_size:
+                self.preload_bodies(batch)
+                for batch_item in batch:
+                    yield batch_item
+                batch = []
+        if batch:
+            self.preload_bodies(batch)
+            for batch_item in batch:
+                yield batch_item
+
+    def preload_bodies(self, items):
+        """
+        Load packed bodies of many items with one query. Body is saved
+        into `packed_body` key of the item. Bodies stored in GridFS are
+        not preloaded.
+        """
+
+        digests = set(x['body_digest'] for x in items
+                      if x.get('body_digest'))
+        if digests:
+            bodies = dict((x['_id'], x['body']) for x in
+                          self.db.cache_body.find(
+                              {'_id': {'$in': list(digests)},
+                               'gridfs': {'$ne': True}}))
+            for item in items:
+                if item.get('body_digest') in bodies:
+                    item['packed_body'] = bodies[item['body_digest']]
+
+    def load_body(self, cache_item):
+        if 'packed_body' in cache_item:
+            return self.codec.decode(cache_item['packed_body'])
+        elif cache_item.get('body_digest'):
+            digest = cache_item['body_digest']
+            body_item = self.db.cache_body.find_one({'_id': digest})
+            if body_item is None:
+                raise CacheBodyNotFound('Body %s is not found' % digest)
+            if body_item.get('gridfs'):
+                try:
+                    return self.codec.decode_stream(self.fs.get(digest))
+                except NoFile:
+                    raise CacheBodyNotFound('Body %s is not found' % digest)
+            else:
+                return self.codec.decode(body_item['body'])
+        elif 'body' in cache_item:
+            # Cache item saved by older version of grab
+            return self.codec.decode(cache_item['body'])
+        else:
+            # `get_item` does not load body of old cache item
+            item = self.db.cache.find_one({'_id': cache_item['_id']},
+                                          {'body': 1})
+            if item is None:
+                raise CacheBodyNotFound('Cache item %s is not found'
+                                        % cache_item['_id'])
+            return self.codec.decode(item['body'])
+
+    def acquire_bodies(self, bodies):
+        """
+        Increase reference counters of the bodies. Save the bodies which
+        do not exist yet.
+
+        :param bodies: list of (digest, body, url) tuples, same digest
+            could occur many times
+        """
+
+        refs = Counter(x[0] for x in bodies)
+        existing = set(x['_id'] for x in self.db.cache_body.find(
+            {'_id': {'$in': list(refs)}}, {'_id': 1}))
+        ops = [UpdateOne({'_id': x}, {'$inc': {'refs': refs[x]}})
+               for x in existing]
+        for digest, body, url in bodies:
+            if digest in existing:
+                continue
+            existing.add(digest)
+            data = self.codec.encode(body, url)
+            if len(data) > self.gridfs_threshold:
+                try:
+                    self.fs.put(data, _id=digest)
+                except FileExists:
+                    # Same body has been saved by another writer
+                    pass
+                fields = {'gridfs': True}
+            else:
+                fields = {'body': Binary(data)}
+            # Upsert because the body could be saved by another process
+            # after we have checked it
+            ops.append(UpdateOne({'_id': digest},
+                                 {'$inc': {'refs': refs[digest]},
+                                  '$setOnInsert': fields},
+                                 upsert=True))
+        if ops:
+            self.db.cache_body.bulk_write(ops, ordered=False)
+
+    def release_bodies(self, digests):
+        """
+        Decrease reference counters of the bodies. Remove the bodies if
+        there are no more cache items which use them.
+
+        :param digests: list of digests, same digest could occur many times
+        """
+
+        refs = Counter(digests)
+        self.db.cache_body.bulk_write(
+            [UpdateOne({'_id': x}, {'$inc': {'refs': -count}})
+             for x, count in refs.items()], ordered=False)
+        unused = self.db.cache_body.find(
+            {'_id': {'$in': list(refs)}, 'refs': {'$lte': 0}}, {'_id': 1})
+        for digest in [x['_id'] for x in unused]:
+            # The body could be acquired again by another writer after
+            # it has been found, so it is removed only if it is still unused
+            body_item = self.db.cache_body.find_one_and_delete(
+                {'_id': digest, 'refs': {'$lte': 0}}, {'gridfs': 1})
+            if body_item is not None and body_item.get('gridfs'):
+                self.fs.delete(digest)
 
     def load_response(self, grab, cache_item):
-        grab.setup_document(cache_item['body'])
-
-        body = cache_item['body']
-        if self.use_compression:
-            body = zlib.decompress(body)
-
-        def custom_prepare_response_func(transport, grab):
-            response = Response()
-            response.head = cache_item['head']
-            response.body = body
-            response.code = cache_item['response_code']
-            response.download_size = len(body)
-            response.upload_size = 0
-            response.download_speed = 0
-            response.url = cache_item['response_url']
-            response.parse(charset=grab.config['document_charset'])
-            response.cookies = CookieManager(transport.extract_cookiejar())
-            response.from_cache = True
-            return response
-
-        grab.process_request_result(custom_prepare_response_func)
+        load_cached_response(grab, cache_item,
+                             lambda: self.load_body(cache_item),
+                             stat=self.codec.stat)
 
     def save_response(self, url, grab):
-        body = grab.response.body
-        if self.use_compression:
-            body = zlib.compress(body)
+        """
+        Save the response into the cache.
 
-        _hash = self.build_hash(url)
-        item = {
-            '_id': _hash,
-            'timestamp': int(time.time()),
-            'url': url,
-            'response_url': grab.response.url,
-            'body': Binary(body),
-            'head': Binary(grab.response.head),
-            'response_code': grab.response.code,
-            'cookies': None,
-        }
-        try:
-            self.db.cache.save(item, w=1)
-        except Exception as ex:
-            if 'document too large' in six.text_type(ex):
-                logging.error('Document too large. It was not saved into mongo'
-                              ' cache. Url: %s' % url)
-            else:
-                raise
+        Returns digest of the body which had been saved for same URL
+        before or None.
+        """
+
+        return self.save_responses([(url, grab)])[url]
+
+    def save_responses(self, responses, timestamps=None):
+        """
+        Save many responses. Bodies and cache items are written with
+        unordered `bulk_write` calls.
+
+        :param responses: list of (url, grab) pairs
+        :param timestamps: dict which maps URL to the time when the response
+            has been received, default is current time
+        Returns dict which maps URL to digest of the body which had been
+        saved for the URL before.
+        """
+
+        # Last response wins if same URL is saved many times
+        responses = dict((self.build_hash(url), (url, grab))
+                         for url, grab in responses)
+        if not responses:
+            return {}
+        old_digests = dict(
+            (x['_id'], x.get('body_digest')) for x in self.db.cache.find(
+                {'_id': {'$in': list(responses)}}, {'body_digest': 1}))
+        now = int(time.time())
+        ops = []
+        acquired = []
+        released = []
+        result = {}
+        for _hash, (url, grab) in responses.items():
+            digest = grab.response.body_digest
+            old_digest = old_digests.get(_hash)
+            if old_digest != digest:
+                acquired.append((digest, grab.response.body, url))
+                if old_digest is not None:
+                    released.append(old_digest)
+            item = build_response_item(url, grab)
+            ts = timestamps.get(url, now) if timestamps else now
+            item['timestamp'] = ts
+            ops.append(ReplaceOne({'_id': _hash}, {
+                '_id': _hash,
+                'timestamp': ts,
+                'access_time': ts,
+                'body_digest': digest,
+                'data': Binary(pack_record(item)),
+            }, upsert=True))
+            result[url] = old_digest
+        if acquired:
+            self.acquire_bodies(acquired)
+        self.db.cache.bulk_write(ops, ordered=False)
+        if released:
+            self.release_bodies(released)
+        return result
+
+    def remove_items(self, order_field, limit, max_timestamp=None):
+        """
+        Remove `limit` items with lowest value of `order_field`.
+
+        Returns number of removed items.
+        """
+
+        if max_timestamp is None:
+            query = {}
+        else:
+            query = {'timestamp': {'$lt': max_timestamp}}
+        items = list(self.db.cache.find(query, {'body_digest': 1})
+                                  .sort(order_field, pymongo.ASCENDING)
+                                  .limit(limit))
+        if items:
+            self.db.cache.delete_many(
+                {'_id': {'$in': [x['_id'] for x in items]}})
+            digests = [x['body_digest'] for x in items
+                       if x.get('body_digest')]
+            if digests:
+                self.release_bodies(digests)
+        return len(items)
+
+    def remove_expired_items(self, timeout, batch_size=1000):
+        """
+        Remove batch of items which are older than `timeout` seconds.
+        """
+
+        return self.remove_items('timestamp', batch_size,
+                                 max_timestamp=int(time.time()) - timeout)
+
+    def evict_items(self, batch_size=1000):
+        """
+        Remove batch of items which exceed `max_items` limit.
+        """
+
+        if self.max_items is None:
+            return 0
+        excess = self.size() - self.max_items
+        if excess > 0:
+            return self.remove_items(self.eviction_field,
+                                     min(excess, batch_size))
+        else:
+            return 0
 
     def clear(self):
-        self.db.cache.remove()
+        self.db.cache.delete_many({})
+        self.db.cache_body.delete_many({})
+        self.db.cache_body_fs.files.delete_many({})
+        self.db.cache_body_fs.chunks.delete_many({})
+
+    def load_dictionaries(self):
+        for item in self.db.cache_dictionary.find():
+            yield item['_id'], item['domain'], item['data']
+
+    def save_dictionary(self, dict_id, domain, data):
+        self.db.cache_dictionary.replace_one({'_id': dict_id}, {
+            '_id': dict_id,
+            'domain': domain,
+            'data': Binary(data),
+        }, upsert=True)
 
     def size(self):
-        return self.db.cache.count()
+        return self.db.cache.count_documents({})
 
     def has_item(self, url, timeout=None):
         """
         Test if required item exists in the cache.
         """
 
-        _hash = self.build_hash(url)
-        if timeout is not None:
-            ts = int(time.time()) - timeout
-            query = {'_id': _hash, 'timestamp': {'$gt': ts}}
-        else:
-            query = {'_id': _hash}
-        doc = self.db.cache.find_one(query, {'id': 1})
-        return doc is not None
+        query = self.build_query({'_id': self.build_hash(url)}, timeout)
+        return self.db.cache.find_one(query, {'_id': 1}) is not None
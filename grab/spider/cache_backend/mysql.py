@@ -1,73 +1,282 @@
 """
 CacheItem interface:
 '_id': string,
+'key': string, # key of the item, starts with the URL
 'url': string,
+'timestamp': int, # time when the item was saved
+'access_time': int, # time when the item was read (used by "lru" eviction)
 'response_url': string,
-'body': string,
+'body_digest': string, # SHA1 of body, the body is stored in `cache_body`
+'body_size': int, # size of decompressed body
 'head': string,
 'response_code': int,
+'charset': string, # charset of the document
+'bom': string,
 'cookies': None,#grab.response.cookies,
 
+Items are stored as binary records, see `grab.spider.cache_backend.record`.
+
 TODO: WTF with cookies???
 """
+from binascii import unhexlify
+from collections import Counter
+from contextlib import contextmanager
 from hashlib import sha1
-import zlib
 import logging
 import MySQLdb
 import marshal
+import threading
 import time
+from six.moves.queue import Queue, Empty
 from weblib.encoding import make_str
 
-from grab.response import Response
-from grab.cookie import CookieManager
+from grab.spider.cache_backend.codec import CacheCodec
+from grab.spider.cache_backend.record import (
+    is_record, pack_record, unpack_record, build_response_item,
+    load_cached_response)
+from grab.spider.cache_backend.sweeper import get_eviction_field
+from grab.spider.error import CacheBodyNotFound
 
 logger = logging.getLogger('grab.spider.cache_backend.mysql')
+# Statements which write many rows are executed with `executemany`.
+# MySQLdb turns such INSERT into one multi-row INSERT only if all
+# placeholders are plain `%s` so ids are passed as binary strings
+# instead of hex literals.
+UPSERT_ITEM_SQL = '''
+    INSERT INTO cache (id, timestamp, data, body_id, access_time)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE timestamp = VALUES(timestamp),
+    data = VALUES(data), body_id = VALUES(body_id),
+    access_time = VALUES(access_time)
+'''
+INSERT_BODY_SQL = '''
+    INSERT INTO cache_body (id, refs, data)
+    VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE refs = refs + VALUES(refs)
+'''
+
+
+def encode_digest(value):
+    if value is None:
+        return None
+    else:
+        return unhexlify(value)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of MySQL connections.
+
+    Idle connections are checked with `ping` before they are given away,
+    dead connections are replaced with new ones.
+    """
+
+    def __init__(self, size, connect):
+        self.connect = connect
+        self.idle = Queue()
+        self.semaphore = threading.BoundedSemaphore(size)
+
+    def getconn(self):
+        self.semaphore.acquire()
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except Empty:
+                return self.connect()
+            try:
+                conn.ping()
+            except (MySQLdb.OperationalError, MySQLdb.InterfaceError):
+                self.close_connection(conn)
+                return self.connect()
+            else:
+                return conn
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        if close:
+            self.close_connection(conn)
+        else:
+            self.idle.put(conn)
+        self.semaphore.release()
+
+    def close_connection(self, conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+    def closeall(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Empty:
+                break
+            else:
+                self.close_connection(conn)
 
 
 class CacheBackend(object):
+    """
+    Cache backend which stores items in MySQL database.
+
+    :param pool_size: max. number of connections opened by the backend,
+        connections are shared by all threads which use the backend.
+    """
+
     def __init__(self, database, use_compression=True,
-                 mysql_engine='innodb', spider=None, **kwargs):
+                 mysql_engine='innodb', spider=None, compression='zlib',
+                 max_items=None, eviction_policy='oldest', pool_size=4,
+                 **kwargs):
         self.spider = spider
+        self.max_items = max_items
+        self.eviction_policy = eviction_policy
+        self.eviction_field = get_eviction_field(eviction_policy)
         self.database = database
         self.connection_config = kwargs
         self.mysql_engine = mysql_engine
+        self.codec = CacheCodec(compression if use_compression else None,
+                                backend=self,
+                                stat=spider.stat if spider else None)
+        self.pool = ConnectionPool(pool_size, self.connect)
+        # Cursor of the transaction which is open in the current thread
+        self.local = threading.local()
 
-        self.connect()
-        self.execute('SET TRANSACTION ISOLATION LEVEL READ COMMITTED')
-        self.execute('show tables')
-        found = False
-        for row in self.cursor:
-            if row[0] == 'cache':
-                found = True
-                break
-        if not found:
+        with self.cursor() as cursor:
+            cursor.execute('show tables')
+            tables = set(row[0] for row in cursor)
+            if 'cache' in tables:
+                cursor.execute("SHOW COLUMNS FROM cache LIKE 'body_id'")
+                if not cursor.fetchone():
+                    cursor.execute('ALTER TABLE cache '
+                                   'ADD COLUMN body_id binary(20)')
+                cursor.execute("SHOW COLUMNS FROM cache LIKE 'access_time'")
+                if not cursor.fetchone():
+                    cursor.execute('''
+                        ALTER TABLE cache
+                        ADD COLUMN access_time int not null default 0,
+                        ADD INDEX access_time_idx(access_time)
+                    ''')
+        if 'cache' not in tables:
             self.create_cache_table(self.mysql_engine)
+        if 'cache_body' not in tables:
+            self.create_body_table(self.mysql_engine)
+        if 'cache_dictionary' not in tables:
+            self.create_dictionary_table(self.mysql_engine)
 
     def connect(self):
-        self.conn = MySQLdb.connect(**self.connection_config)
-        self.conn.select_db(self.database)
-        self.cursor = self.conn.cursor()
+        conn = MySQLdb.connect(**self.connection_config)
+        conn.select_db(self.database)
+        conn.autocommit(True)
+        conn.cursor().execute('SET SESSION TRANSACTION ISOLATION LEVEL '
+                              'READ COMMITTED')
+        return conn
 
-    def execute(self, *args):
+    @contextmanager
+    def cursor(self):
+        """
+        Cursor of pooled connection in autocommit mode i.e. each statement
+        is executed in its own transaction.
+
+        Connection which failed with OperationalError is closed and is not
+        returned to the pool. The failed statement is not retried: it is
+        not known if it has been applied.
+
+        Inside of `transaction` (e.g. when the codec saves new dictionary
+        while the response is being saved) the cursor of the transaction is
+        used, so one thread never holds two connections of the pool.
+        """
+
+        current = getattr(self.local, 'cursor', None)
+        if current is not None:
+            yield current
+            return
+        conn = self.pool.getconn()
+        broken = False
         try:
-            self.cursor.execute(*args)
-        except (AttributeError, MySQLdb.OperationalError):
-            self.connect()
-            self.cursor.execute(*args)
-        return self.cursor
+            yield conn.cursor()
+        except MySQLdb.OperationalError:
+            broken = True
+            raise
+        finally:
+            self.pool.putconn(conn, close=broken)
+
+    @contextmanager
+    def transaction(self):
+        with self.cursor() as cursor:
+            if getattr(self.local, 'cursor', None) is not None:
+                # Nested transaction is a part of the outer one
+                yield cursor
+                return
+            cursor.execute('BEGIN')
+            self.local.cursor = cursor
+            try:
+                yield cursor
+            except MySQLdb.OperationalError:
+                # connection is closed by `cursor`, the server rolls back
+                # transaction of closed connection
+                self.codec.dictionaries = None
+                raise
+            except Exception:
+                cursor.execute('ROLLBACK')
+                # Dictionary which has been saved in the transaction is
+                # lost, reload dictionaries from the database
+                self.codec.dictionaries = None
+                raise
+            else:
+                cursor.execute('COMMIT')
+            finally:
+                self.local.cursor = None
 
     def create_cache_table(self, engine):
-        self.execute('begin')
-        self.execute('''
-            create table cache (
-                id binary(20) not null,
-                timestamp int not null,
-                data mediumblob not null,
-                primary key (id),
-                index timestamp_idx(timestamp)
-            ) engine = %s
-        ''' % engine)
-        self.execute('commit')
+        with self.cursor() as cursor:
+            cursor.execute('''
+                create table cache (
+                    id binary(20) not null,
+                    timestamp int not null,
+                    data mediumblob not null,
+                    body_id binary(20),
+                    access_time int not null default 0,
+                    primary key (id),
+                    index timestamp_idx(timestamp),
+                    index access_time_idx(access_time)
+                ) engine = %s
+            ''' % engine)
+
+    def create_body_table(self, engine):
+        with self.cursor() as cursor:
+            cursor.execute('''
+                create table cache_body (
+                    id binary(20) not null,
+                    refs int not null,
+                    data longblob not null,
+                    primary key (id)
+                ) engine = %s
+            ''' % engine)
+
+    def create_dictionary_table(self, engine):
+        with self.cursor() as cursor:
+            cursor.execute('''
+                create table cache_dictionary (
+                    id int unsigned not null,
+                    domain varchar(255) not null,
+                    data blob not null,
+                    primary key (id)
+                ) engine = %s
+            ''' % engine)
+
+    def load_dictionaries(self):
+        with self.cursor() as cursor:
+            cursor.execute('SELECT id, domain, data FROM cache_dictionary')
+            return cursor.fetchall()
+
+    def save_dictionary(self, dict_id, domain, data):
+        with self.cursor() as cursor:
+            cursor.execute('''
+                INSERT IGNORE INTO cache_dictionary (id, domain, data)
+                VALUES (%s, %s, %s)
+                ''', (dict_id, domain, data))
 
     def get_item(self, url, timeout=None):
         """
@@ -76,30 +285,86 @@ class CacheBackend(object):
 
         _hash = self.build_hash(url)
         with self.spider.timer.log_time('cache.read.mysql_query'):
-            self.execute('BEGIN')
-            if timeout is None:
-                query = ""
-            else:
-                ts = int(time.time()) - timeout
-                query = " AND timestamp > %d" % ts
-            sql = '''
-                  SELECT data
-                  FROM cache
-                  WHERE id = x%%s %(query)s
-                  ''' % {'query': query}
-            self.execute(sql, (_hash,))
-            row = self.cursor.fetchone()
-            self.execute('COMMIT')
+            with self.cursor() as cursor:
+                cursor.execute('''
+                    SELECT data, timestamp
+                    FROM cache
+                    WHERE id = x%s AND timestamp > %s
+                    ''', (_hash, self.get_min_timestamp(timeout)))
+                row = cursor.fetchone()
+                if row and self.eviction_policy == 'lru':
+                    cursor.execute('UPDATE cache SET access_time = %s '
+                                   'WHERE id = x%s', (int(time.time()), _hash))
         if row:
-            data = row[0]
-            return self.unpack_database_value(data)
+            item = self.unpack_database_value(row[0])
+            item['timestamp'] = row[1]
+            return item
         else:
             return None
 
+    def get_items(self, urls, timeout=None):
+        """
+        Load many items with one query.
+
+        Returns dict which maps URL to cache item. URLs which are not found
+        in the cache are not included into the dict.
+        """
+
+        hashes = dict((self.build_hash(x), x) for x in urls)
+        if not hashes:
+            return {}
+        with self.spider.timer.log_time('cache.read.mysql_query'):
+            with self.cursor() as cursor:
+                sql = '''
+                    SELECT LOWER(HEX(id)), data, timestamp
+                    FROM cache
+                    WHERE id IN (%s) AND timestamp > %%s
+                    ''' % ', '.join(['x%s'] * len(hashes))
+                cursor.execute(sql, list(hashes) +
+                               [self.get_min_timestamp(timeout)])
+                rows = cursor.fetchall()
+                if rows and self.eviction_policy == 'lru':
+                    sql = '''
+                        UPDATE cache SET access_time = %%s
+                        WHERE id IN (%s)
+                        ''' % ', '.join(['x%s'] * len(rows))
+                    cursor.execute(sql, [int(time.time())] +
+                                   [x[0] for x in rows])
+        result = {}
+        for _hash, data, timestamp in rows:
+            item = self.unpack_database_value(data)
+            item['timestamp'] = timestamp
+            result[hashes[_hash]] = item
+        return result
+
+    def get_min_timestamp(self, timeout):
+        """
+        Returns timestamp which fresh items are newer than.
+        """
+
+        if timeout is None:
+            return -1
+        else:
+            return int(time.time()) - timeout
+
+    def touch_item(self, url):
+        """
+        Update the timestamp of cache item i.e. mark it as fresh.
+        """
+
+        _hash = self.build_hash(url)
+        with self.cursor() as cursor:
+            cursor.execute('UPDATE cache SET timestamp = %s WHERE id = x%s',
+                           (int(time.time()), _hash))
+
     def unpack_database_value(self, val):
         with self.spider.timer.log_time('cache.read.unpack_data'):
-            dump = zlib.decompress(val)
-            return marshal.loads(dump)
+            if is_record(val):
+                return unpack_record(val)
+            else:
+                # Item saved by older version of grab
+                dump = self.codec.decode(val)
+                return marshal.loads(dump)
 
     def build_hash(self, url):
         with self.spider.timer.log_time('cache.read.build_hash'):
@@ -108,67 +373,276 @@ class CacheBackend(object):
 
     def remove_cache_item(self, url):
         _hash = self.build_hash(url)
-        self.execute('begin')
-        self.execute('''
-            delete from cache where id = x%s
-        ''', (_hash,))
-        self.execute('commit')
+        with self.transaction() as cursor:
+            old_digest = self.select_body_digest(cursor, _hash)
+            cursor.execute('''
+                delete from cache where id = x%s
+            ''', (_hash,))
+            if old_digest is not None:
+                self.release_bodies(cursor, [old_digest])
+
+    def select_body_digest(self, cursor, _hash):
+        return self.select_body_digests(cursor, [_hash]).get(_hash)
+
+    def select_body_digests(self, cursor, hashes):
+        """
+        Lock cache items and return dict which maps hash of item to
+        digest of its body.
+        """
+
+        cursor.execute('''
+            SELECT LOWER(HEX(id)), LOWER(HEX(body_id))
+            FROM cache
+            WHERE id IN (%s)
+            FOR UPDATE
+            ''' % ', '.join(['x%s'] * len(hashes)), list(hashes))
+        return dict(cursor.fetchall())
+
+    def get_body_digest(self, url):
+        with self.transaction() as cursor:
+            return self.select_body_digest(cursor, self.build_hash(url))
+
+    def iterate_items(self, batch_size=1000):
+        """
+        Iterate over all cache items in the order they are stored
+        on the disk: InnoDB stores rows in primary key order. Items are
+        loaded in batches, bodies of each batch are loaded with one query.
+        """
+
+        last_hash = None
+        while True:
+            with self.cursor() as cursor:
+                if last_hash is None:
+                    query, args = '', ()
+                else:
+                    query, args = 'WHERE id > x%s', (last_hash,)
+                cursor.execute('''
+                    SELECT LOWER(HEX(id)), data, timestamp
+                    FROM cache %s
+                    ORDER BY id
+                    LIMIT %d
+                    ''' % (query, batch_size), args)
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                items = []
+                for _hash, data, timestamp in rows:
+                    item = self.unpack_database_value(data)
+                    item['timestamp'] = timestamp
+                    items.append(item)
+                self.preload_bodies(cursor, items)
+            last_hash = rows[-1][0]
+            for item in items:
+                yield item
+
+    def preload_bodies(self, cursor, items):
+        """
+        Load packed bodies of many items with one query. Body is saved
+        into `packed_body` key of the item.
+        """
+
+        digests = set(x['body_digest'] for x in items
+                      if x.get('body_digest'))
+        if digests:
+            cursor.execute('''
+                SELECT LOWER(HEX(id)), data FROM cache_body
+                WHERE id IN (%s)
+                ''' % ', '.join(['x%s'] * len(digests)), list(digests))
+            bodies = dict(cursor.fetchall())
+            for item in items:
+                if item.get('body_digest') in bodies:
+                    item['packed_body'] = bodies[item['body_digest']]
+
+    def load_body(self, cache_item):
+        if 'packed_body' in cache_item:
+            return self.codec.decode(cache_item['packed_body'])
+        elif cache_item.get('body_digest'):
+            with self.cursor() as cursor:
+                cursor.execute('SELECT data FROM cache_body WHERE id = x%s',
+                               (cache_item['body_digest'],))
+                row = cursor.fetchone()
+            if row is None:
+                raise CacheBodyNotFound('Body %s is not found'
+                                        % cache_item['body_digest'])
+            return self.codec.decode(row[0])
+        else:
+            # Cache item saved by older version of grab
+            return cache_item['body']
+
+    def acquire_bodies(self, cursor, bodies):
+        """
+        Increase reference counters of the bodies. Save the bodies which
+        do not exist yet.
+
+        :param bodies: list of (digest, body, url) tuples, same digest
+            could occur many times
+        """
+
+        refs = Counter(x[0] for x in bodies)
+        cursor.execute('''
+            SELECT LOWER(HEX(id)) FROM cache_body WHERE id IN (%s)
+            FOR UPDATE
+            ''' % ', '.join(['x%s'] * len(refs)), list(refs))
+        existing = set(x[0] for x in cursor.fetchall())
+        if existing:
+            cursor.executemany(
+                'UPDATE cache_body SET refs = refs + %s WHERE id = x%s',
+                [(refs[x], x) for x in existing])
+        new_bodies = {}
+        for digest, body, url in bodies:
+            if digest not in existing and digest not in new_bodies:
+                new_bodies[digest] = (encode_digest(digest), refs[digest],
+                                      self.codec.encode(body, url))
+        if new_bodies:
+            cursor.executemany(INSERT_BODY_SQL, list(new_bodies.values()))
+
+    def release_bodies(self, cursor, digests):
+        """
+        Decrease reference counters of the bodies. Remove the bodies if
+        there are no more cache items which use them.
+
+        :param digests: list of digests, same digest could occur many times
+        """
+
+        refs = Counter(digests)
+        cursor.executemany(
+            'UPDATE cache_body SET refs = refs - %s WHERE id = x%s',
+            [(count, x) for x, count in refs.items()])
+        cursor.execute('DELETE FROM cache_body WHERE id IN (%s) AND refs <= 0'
+                       % ', '.join(['x%s'] * len(refs)), list(refs))
 
     def load_response(self, grab, cache_item):
-        grab.setup_document(cache_item['body'])
-
-        body = cache_item['body']
-
-        def custom_prepare_response_func(transport, grab):
-            response = Response()
-            response.head = cache_item['head']
-            response.body = body
-            response.code = cache_item['response_code']
-            response.download_size = len(body)
-            response.upload_size = 0
-            response.download_speed = 0
-            response.url = cache_item['response_url']
-            response.parse(charset=grab.config['document_charset'])
-            response.cookies = CookieManager(transport.extract_cookiejar())
-            response.from_cache = True
-            return response
-
-        grab.process_request_result(custom_prepare_response_func)
+        load_cached_response(grab, cache_item,
+                             lambda: self.load_body(cache_item),
+                             stat=self.codec.stat)
 
     def save_response(self, url, grab):
-        body = grab.response.body
-
-        item = {
-            'url': url,
-            'response_url': grab.response.url,
-            'body': body,
-            'head': grab.response.head,
-            'response_code': grab.response.code,
-            'cookies': None,
-        }
-        self.set_item(url, item)
+        """
+        Save the response into the cache.
+
+        Returns digest of the body which had been saved for same URL
+        before or None.
+        """
+
+        return self.save_responses([(url, grab)])[url]
+
+    def save_responses(self, responses, timestamps=None):
+        """
+        Save many responses in one transaction. Cache items and bodies
+        are written with `executemany` i.e. with multi-row statements.
+
+        :param responses: list of (url, grab) pairs
+        :param timestamps: dict which maps URL to the time when the response
+            has been received, default is current time
+        Returns dict which maps URL to digest of the body which had been
+        saved for the URL before.
+        """
+
+        # Last response wins if same URL is saved many times
+        responses = dict((self.build_hash(url), (url, grab))
+                         for url, grab in responses)
+        if not responses:
+            return {}
+        now = int(time.time())
+        result = {}
+        with self.transaction() as cursor:
+            old_digests = self.select_body_digests(cursor, responses)
+            rows = []
+            acquired = []
+            released = []
+            for _hash, (url, grab) in responses.items():
+                digest = grab.response.body_digest
+                old_digest = old_digests.get(_hash)
+                if old_digest != digest:
+                    acquired.append((digest, grab.response.body, url))
+                    if old_digest is not None:
+                        released.append(old_digest)
+                data = self.pack_database_value(
+                    build_response_item(url, grab), url)
+                ts = timestamps.get(url, now) if timestamps else now
+                rows.append((encode_digest(_hash), ts, data,
+                             encode_digest(digest), ts))
+                result[url] = old_digest
+            if acquired:
+                self.acquire_bodies(cursor, acquired)
+            cursor.executemany(UPSERT_ITEM_SQL, rows)
+            if released:
+                self.release_bodies(cursor, released)
+        return result
 
     def set_item(self, url, item):
         _hash = self.build_hash(url)
-        data = self.pack_database_value(item)
-        self.execute('BEGIN')
         ts = int(time.time())
-        sql = '''
-              INSERT INTO cache (id, timestamp, data)
-              VALUES(x%s, %s, %s)
-              ON DUPLICATE KEY UPDATE timestamp = %s, data = %s
-              '''
-        self.execute(sql, (_hash, ts, data, ts, data))
-        self.execute('COMMIT')
-
-    def pack_database_value(self, val):
-        dump = marshal.dumps(val)
-        return zlib.compress(dump)
+        with self.transaction() as cursor:
+            old_digest = self.select_body_digest(cursor, _hash)
+            cursor.execute(UPSERT_ITEM_SQL,
+                           (encode_digest(_hash), ts,
+                            self.pack_database_value(item, url), None, ts))
+            if old_digest is not None:
+                self.release_bodies(cursor, [old_digest])
+
+    def pack_database_value(self, val, url=None):
+        if 'body' in val:
+            packed_body = self.codec.encode(val['body'], url)
+        else:
+            packed_body = None
+        return pack_record(val, packed_body=packed_body)
+
+    def remove_items(self, order_field, limit, max_timestamp=None):
+        """
+        Remove `limit` items with lowest value of `order_field`.
+
+        Returns number of removed items.
+        """
+
+        if max_timestamp is None:
+            query = ''
+        else:
+            query = 'WHERE timestamp < %d' % max_timestamp
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT LOWER(HEX(id)), LOWER(HEX(body_id))
+                FROM cache %(query)s
+                ORDER BY %(field)s
+                LIMIT %(limit)d
+                FOR UPDATE
+                ''' % {'query': query, 'field': order_field, 'limit': limit})
+            rows = cursor.fetchall()
+            if rows:
+                cursor.execute('DELETE FROM cache WHERE id IN (%s)'
+                               % ', '.join(['x%s'] * len(rows)),
+                               [x[0] for x in rows])
+                digests = [x[1] for x in rows if x[1] is not None]
+                if digests:
+                    self.release_bodies(cursor, digests)
+        return len(rows)
+
+    def remove_expired_items(self, timeout, batch_size=1000):
+        """
+        Remove batch of items which are older than `timeout` seconds.
+        """
+
+        return self.remove_items('timestamp', batch_size,
+                                 max_timestamp=int(time.time()) - timeout)
+
+    def evict_items(self, batch_size=1000):
+        """
+        Remove batch of items which exceed `max_items` limit.
+        """
+
+        if self.max_items is None:
+            return 0
+        excess = self.size() - self.max_items
+        if excess > 0:
+            return self.remove_items(self.eviction_field,
+                                     min(excess, batch_size))
+        else:
+            return 0
 
     def clear(self):
-        self.execute('BEGIN')
-        self.execute('TRUNCATE cache')
-        self.execute('COMMIT')
+        with self.cursor() as cursor:
+            cursor.execute('TRUNCATE cache')
+            cursor.execute('TRUNCATE cache_body')
 
     def has_item(self, url, timeout=None):
         """
@@ -177,26 +651,17 @@ class CacheBackend(object):
 
         _hash = self.build_hash(url)
         with self.spider.timer.log_time('cache.read.mysql_query'):
-            if timeout is None:
-                query = ""
-            else:
-                ts = int(time.time()) - timeout
-                query = " AND timestamp > %d" % ts
-            self.execute('BEGIN')
-            self.execute('''
-                SELECT id
-                FROM cache
-                WHERE id = x%%s %(query)s
-                LIMIT 1
-                ''' % {'query': query},
-                (_hash,))
-            row = self.cursor.fetchone()
-            self.execute('COMMIT')
-        return True if row else False
+            with self.cursor() as cursor:
+                cursor.execute('SELECT 1 FROM cache '
+                               'WHERE id = x%s AND timestamp > %s',
+                               (_hash, self.get_min_timestamp(timeout)))
+                row = cursor.fetchone()
+        return bool(row)
 
     def size(self):
-        self.execute('BEGIN')
-        self.execute('SELECT COUNT(*) from cache')
-        row = self.cursor.fetchone()
-        self.execute('COMMIT')
-        return row[0]
+        with self.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) from cache')
+            return cursor.fetchone()[0]
+
+    def close(self):
+        self.pool.closeall()
@@ -1,63 +1,316 @@
 """
 CacheItem interface:
 '_id': string,
+'key': string, # key of the item, starts with the URL
 'url': string,
+'timestamp': int, # time when the item was saved
+'access_time': int, # time when the item was read (used by "lru" eviction)
 'response_url': string,
-'body': string,
+'body_digest': string, # SHA1 of body, the body is stored in `cache_body`
+'body_size': int, # size of decompressed body
 'head': string,
 'response_code': int,
+'charset': string, # charset of the document
+'bom': string,
 'cookies': None,#grab.response.cookies,
+
+Items are stored as binary records, see `grab.spider.cache_backend.record`.
+
+The backend requires PostgreSQL 9.5 or newer.
 """
 from hashlib import sha1
-import zlib
 import logging
 import marshal
+import threading
 import time
+from contextlib import contextmanager
 from weblib.encoding import make_str
 
-from grab.response import Response
-from grab.cookie import CookieManager
+from grab.spider.cache_backend.codec import CacheCodec
+from grab.spider.cache_backend.record import (
+    is_record, pack_record, unpack_record, build_response_item,
+    load_cached_response)
+from grab.spider.cache_backend.sweeper import get_eviction_field
+from grab.spider.error import CacheBodyNotFound
 
 logger = logging.getLogger('grab.spider.cache_backend.postgresql')
+# Statements which are executed for each cache read or write
+# are prepared once per connection
+# FORMAT: name -> (argument types, SQL)
+PREPARED_STATEMENTS = {
+    'grab_cache_get_item': (
+        'bytea, int',
+        'SELECT data, timestamp FROM cache WHERE id = $1 AND timestamp > $2'),
+    'grab_cache_has_item': (
+        'bytea, int',
+        'SELECT 1 FROM cache WHERE id = $1 AND timestamp > $2'),
+    'grab_cache_update_access_time': (
+        'int, bytea',
+        'UPDATE cache SET access_time = $1 WHERE id = $2'),
+    'grab_cache_update_timestamp': (
+        'int, bytea',
+        'UPDATE cache SET timestamp = $1 WHERE id = $2'),
+    'grab_cache_write_item': (
+        'bytea, int, bytea, bytea',
+        '''INSERT INTO cache (id, timestamp, data, body_id, access_time)
+           VALUES ($1, $2, $3, $4, $2)
+           ON CONFLICT (id) DO UPDATE SET
+             timestamp = EXCLUDED.timestamp,
+             data = EXCLUDED.data,
+             body_id = EXCLUDED.body_id,
+             access_time = EXCLUDED.access_time'''),
+    'grab_cache_select_body_id': (
+        'bytea',
+        'SELECT body_id FROM cache WHERE id = $1 FOR UPDATE'),
+    'grab_cache_load_body': (
+        'bytea',
+        'SELECT data FROM cache_body WHERE id = $1'),
+    'grab_cache_acquire_body': (
+        'bytea',
+        'UPDATE cache_body SET refs = refs + 1 WHERE id = $1'),
+    'grab_cache_insert_body': (
+        'bytea, bytea',
+        '''INSERT INTO cache_body (id, refs, data)
+           VALUES ($1, 1, $2)
+           ON CONFLICT (id) DO UPDATE SET refs = cache_body.refs + 1'''),
+    'grab_cache_release_body': (
+        'bytea',
+        'UPDATE cache_body SET refs = refs - 1 WHERE id = $1'),
+    'grab_cache_delete_body': (
+        'bytea',
+        'DELETE FROM cache_body WHERE id = $1 AND refs <= 0'),
+}
+UPSERT_ITEMS_SQL = '''
+    INSERT INTO cache (id, timestamp, data, body_id, access_time)
+    VALUES %s
+    ON CONFLICT (id) DO UPDATE SET
+      timestamp = EXCLUDED.timestamp,
+      data = EXCLUDED.data,
+      body_id = EXCLUDED.body_id,
+      access_time = EXCLUDED.access_time
+'''
+
+
+def decode_digest(value):
+    if value is None:
+        return None
+    else:
+        return bytes(value).decode('ascii')
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of PostgreSQL connections.
+
+    All `size` connections are kept open, `getconn` waits while all of them
+    are busy. `on_close` is called with each connection which has been
+    closed or discarded by the pool.
+    """
+
+    def __init__(self, size, on_close=None, **kwargs):
+        from psycopg2.pool import ThreadedConnectionPool
+
+        self.pool = ThreadedConnectionPool(size, size, **kwargs)
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.on_close = on_close
+
+    def getconn(self):
+        self.semaphore.acquire()
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        try:
+            self.pool.putconn(conn, close=close)
+        finally:
+            if conn.closed and self.on_close is not None:
+                self.on_close(conn)
+            self.semaphore.release()
+
+    def closeall(self):
+        self.pool.closeall()
 
 
 class CacheBackend(object):
-    def __init__(self, database, use_compression=True, spider=None, **kwargs):
-        import psycopg2
-        from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
+    """
+    Cache backend which stores items in PostgreSQL database.
+
+    :param pool_size: number of connections opened by the backend,
+        connections are shared by all threads which use the backend.
+    """
 
+    def __init__(self, database, use_compression=True, spider=None,
+                 compression='zlib', max_items=None,
+                 eviction_policy='oldest', pool_size=4, **kwargs):
         self.spider = spider
-        self.conn = psycopg2.connect(dbname=database, **kwargs)
-        self.conn.set_isolation_level(ISOLATION_LEVEL_READ_COMMITTED)
-        self.cursor = self.conn.cursor()
-        self.cursor.execute("""
-            SELECT
-                TABLE_NAME
-            FROM
-                INFORMATION_SCHEMA.TABLES
-            WHERE
-                TABLE_TYPE = 'BASE TABLE'
-            AND
-                table_schema NOT IN ('pg_catalog', 'information_schema')""")
-        found = False
-        for row in self.cursor:
-            if row[0] == 'cache':
-                found = True
-                break
-        if not found:
+        self.max_items = max_items
+        self.eviction_policy = eviction_policy
+        self.eviction_field = get_eviction_field(eviction_policy)
+        self.codec = CacheCodec(compression if use_compression else None,
+                                backend=self,
+                                stat=spider.stat if spider else None)
+        # FORMAT: connection -> set of names of prepared statements
+        self.prepared_statements = {}
+        # Cursor of the transaction which is open in the current thread
+        self.local = threading.local()
+        self.pool = ConnectionPool(pool_size,
+                                   on_close=self.forget_connection,
+                                   dbname=database, **kwargs)
+        with self.cursor() as cursor:
+            cursor.execute("""
+                SELECT
+                    TABLE_NAME
+                FROM
+                    INFORMATION_SCHEMA.TABLES
+                WHERE
+                    TABLE_TYPE = 'BASE TABLE'
+                AND
+                    table_schema NOT IN ('pg_catalog',
+                                         'information_schema')""")
+            tables = set(row[0] for row in cursor)
+        if 'cache' not in tables:
             self.create_cache_table()
+        else:
+            self.migrate_cache_table()
+        if 'cache_body' not in tables:
+            self.create_body_table()
+        if 'cache_dictionary' not in tables:
+            self.create_dictionary_table()
+
+    def forget_connection(self, conn):
+        self.prepared_statements.pop(conn, None)
+
+    @contextmanager
+    def cursor(self):
+        """
+        Cursor of pooled connection in autocommit mode i.e. each statement
+        is executed in its own transaction.
+
+        Inside of `transaction` (e.g. when the codec saves new dictionary
+        while the response is being saved) the cursor of the transaction is
+        used, so one thread never holds two connections of the pool.
+        """
+
+        current = getattr(self.local, 'cursor', None)
+        if current is not None:
+            yield current
+            return
+        conn = self.pool.getconn()
+        try:
+            conn.autocommit = True
+            yield conn.cursor()
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    @contextmanager
+    def transaction(self):
+        with self.cursor() as cursor:
+            if getattr(self.local, 'cursor', None) is not None:
+                # Nested transaction is a part of the outer one
+                yield cursor
+                return
+            cursor.execute('BEGIN')
+            self.local.cursor = cursor
+            try:
+                yield cursor
+            except Exception:
+                if not cursor.connection.closed:
+                    cursor.execute('ROLLBACK')
+                # Dictionary which has been saved in the transaction is
+                # lost, reload dictionaries from the database
+                self.codec.dictionaries = None
+                raise
+            else:
+                cursor.execute('COMMIT')
+            finally:
+                self.local.cursor = None
+
+    def execute(self, cursor, name, args):
+        """
+        Execute prepared statement. Prepare it if the connection
+        has not prepared it yet.
+        """
+
+        prepared = self.prepared_statements.setdefault(cursor.connection,
+                                                       set())
+        if name not in prepared:
+            arg_types, sql = PREPARED_STATEMENTS[name]
+            cursor.execute('PREPARE %s (%s) AS %s' % (name, arg_types, sql))
+            prepared.add(name)
+        cursor.execute('EXECUTE %s (%s)'
+                       % (name, ', '.join(['%s'] * len(args))), args)
+        return cursor
 
     def create_cache_table(self):
-        self.cursor.execute('BEGIN')
-        self.cursor.execute('''
-            CREATE TABLE cache (
-                id BYTEA NOT NULL CONSTRAINT primary_key PRIMARY KEY,
-                timestamp INT NOT NULL,
-                data BYTEA NOT NULL
-            );
-            CREATE INDEX timestamp_idx ON cache (timestamp);
-        ''')
-        self.cursor.execute('COMMIT')
+        with self.transaction() as cursor:
+            cursor.execute('''
+                CREATE TABLE cache (
+                    id BYTEA NOT NULL CONSTRAINT primary_key PRIMARY KEY,
+                    timestamp INT NOT NULL,
+                    data BYTEA NOT NULL,
+                    body_id BYTEA,
+                    access_time INT NOT NULL DEFAULT 0
+                );
+                CREATE INDEX timestamp_idx ON cache (timestamp);
+                CREATE INDEX access_time_idx ON cache (access_time);
+            ''')
+
+    def migrate_cache_table(self):
+        with self.cursor() as cursor:
+            cursor.execute('''
+                SELECT column_name
+                FROM INFORMATION_SCHEMA.COLUMNS
+                WHERE table_name = 'cache'
+                ''')
+            columns = set(row[0] for row in cursor)
+        if 'body_id' not in columns:
+            with self.transaction() as cursor:
+                cursor.execute('ALTER TABLE cache ADD COLUMN body_id BYTEA')
+        if 'access_time' not in columns:
+            with self.transaction() as cursor:
+                cursor.execute('''
+                    ALTER TABLE cache
+                    ADD COLUMN access_time INT NOT NULL DEFAULT 0;
+                    CREATE INDEX access_time_idx ON cache (access_time);
+                ''')
+
+    def create_body_table(self):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                CREATE TABLE cache_body (
+                    id BYTEA NOT NULL PRIMARY KEY,
+                    refs INT NOT NULL,
+                    data BYTEA NOT NULL
+                );
+            ''')
+
+    def create_dictionary_table(self):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                CREATE TABLE cache_dictionary (
+                    id BIGINT NOT NULL PRIMARY KEY,
+                    domain TEXT NOT NULL,
+                    data BYTEA NOT NULL
+                );
+            ''')
+
+    def load_dictionaries(self):
+        with self.cursor() as cursor:
+            cursor.execute('SELECT id, domain, data FROM cache_dictionary')
+            return cursor.fetchall()
+
+    def save_dictionary(self, dict_id, domain, data):
+        import psycopg2
+
+        with self.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO cache_dictionary (id, domain, data)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (id) DO NOTHING
+                ''', (dict_id, domain, psycopg2.Binary(data)))
 
     def get_item(self, url, timeout=None):
         """
@@ -66,30 +319,81 @@ class CacheBackend(object):
 
         _hash = self.build_hash(url)
         with self.spider.timer.log_time('cache.read.postgresql_query'):
-            self.cursor.execute('BEGIN')
-            if timeout is None:
-                query = ""
-            else:
-                ts = int(time.time()) - timeout
-                query = " AND timestamp > %d" % ts
-            sql = '''
-                  SELECT data
-                  FROM cache
-                  WHERE id = %%s %(query)s
-                  ''' % {'query': query}
-            self.cursor.execute(sql, (_hash,))
-            row = self.cursor.fetchone()
-            self.cursor.execute('COMMIT')
+            with self.cursor() as cursor:
+                row = self.execute(
+                    cursor, 'grab_cache_get_item',
+                    (_hash, self.get_min_timestamp(timeout))).fetchone()
+                if row and self.eviction_policy == 'lru':
+                    self.execute(cursor, 'grab_cache_update_access_time',
+                                 (int(time.time()), _hash))
         if row:
-            data = row[0]
-            return self.unpack_database_value(data)
+            item = self.unpack_database_value(row[0])
+            item['timestamp'] = row[1]
+            return item
         else:
             return None
 
+    def get_items(self, urls, timeout=None):
+        """
+        Load many items with one query.
+
+        Returns dict which maps URL to cache item. URLs which are not found
+        in the cache are not included into the dict.
+        """
+
+        import psycopg2
+
+        hashes = dict((self.build_hash(x), x) for x in urls)
+        if not hashes:
+            return {}
+        with self.spider.timer.log_time('cache.read.postgresql_query'):
+            with self.cursor() as cursor:
+                cursor.execute('''
+                    SELECT id, data, timestamp
+                    FROM cache
+                    WHERE id = ANY(%s) AND timestamp > %s
+                    ''', ([psycopg2.Binary(make_str(x)) for x in hashes],
+                          self.get_min_timestamp(timeout)))
+                rows = cursor.fetchall()
+                if rows and self.eviction_policy == 'lru':
+                    cursor.execute('''
+                        UPDATE cache SET access_time = %s
+                        WHERE id = ANY(%s)
+                        ''', (int(time.time()), [x[0] for x in rows]))
+        result = {}
+        for _hash, data, timestamp in rows:
+            item = self.unpack_database_value(data)
+            item['timestamp'] = timestamp
+            result[hashes[decode_digest(_hash)]] = item
+        return result
+
+    def get_min_timestamp(self, timeout):
+        """
+        Returns timestamp which fresh items are newer than.
+        """
+
+        if timeout is None:
+            return -1
+        else:
+            return int(time.time()) - timeout
+
+    def touch_item(self, url):
+        """
+        Update the timestamp of cache item i.e. mark it as fresh.
+        """
+
+        with self.cursor() as cursor:
+            self.execute(cursor, 'grab_cache_update_timestamp',
+                         (int(time.time()), self.build_hash(url)))
+
     def unpack_database_value(self, val):
         with self.spider.timer.log_time('cache.read.unpack_data'):
-            dump = zlib.decompress(val)
-            return marshal.loads(dump)
+            if is_record(val):
+                return unpack_record(val)
+            else:
+                # Item saved by older version of grab
+                dump = self.codec.decode(val)
+                return marshal.loads(dump)
 
     def build_hash(self, url):
         with self.spider.timer.log_time('cache.read.build_hash'):
@@ -98,71 +402,267 @@ class CacheBackend(object):
 
     def remove_cache_item(self, url):
         _hash = self.build_hash(url)
-        self.cursor.execute('begin')
-        self.cursor.execute('''
-            DELETE FROM cache WHERE id = %s
-        ''', (_hash,))
-        self.cursor.execute('commit')
+        with self.transaction() as cursor:
+            old_digest = self.select_body_digest(cursor, _hash)
+            cursor.execute('DELETE FROM cache WHERE id = %s', (_hash,))
+            if old_digest is not None:
+                self.release_body(cursor, old_digest)
+
+    def select_body_digest(self, cursor, _hash):
+        row = self.execute(cursor, 'grab_cache_select_body_id',
+                           (_hash,)).fetchone()
+        return decode_digest(row[0]) if row else None
+
+    def get_body_digest(self, url):
+        with self.transaction() as cursor:
+            return self.select_body_digest(cursor, self.build_hash(url))
+
+    def iterate_items(self, batch_size=1000):
+        """
+        Iterate over all cache items in primary key order. Items are
+        loaded in batches, bodies of each batch are loaded with one query.
+        The connection is returned to the pool before items of the batch
+        are yielded, so the consumer could modify the cache.
+        """
+
+        import psycopg2
+
+        last_hash = None
+        while True:
+            with self.cursor() as cursor:
+                if last_hash is None:
+                    query, args = '', ()
+                else:
+                    query = 'WHERE id > %s'
+                    args = (psycopg2.Binary(last_hash),)
+                cursor.execute('''
+                    SELECT id, data, timestamp
+                    FROM cache %s
+                    ORDER BY id
+                    LIMIT %d
+                    ''' % (query, batch_size), args)
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                items = []
+                for _hash, data, timestamp in rows:
+                    item = self.unpack_database_value(data)
+                    item['timestamp'] = timestamp
+                    items.append(item)
+                self.preload_bodies(cursor, items)
+            last_hash = bytes(rows[-1][0])
+            for item in items:
+                yield item
+
+    def preload_bodies(self, cursor, items):
+        """
+        Load packed bodies of many items with one query. Body is saved
+        into `packed_body` key of the item.
+        """
+
+        import psycopg2
+
+        digests = set(x['body_digest'] for x in items
+                      if x.get('body_digest'))
+        if digests:
+            cursor.execute('''
+                SELECT id, data FROM cache_body WHERE id = ANY(%s)
+                ''', ([psycopg2.Binary(make_str(x)) for x in digests],))
+            bodies = dict((decode_digest(x[0]), x[1]) for x in cursor)
+            for item in items:
+                if item.get('body_digest') in bodies:
+                    item['packed_body'] = bodies[item['body_digest']]
+
+    def load_body(self, cache_item):
+        if 'packed_body' in cache_item:
+            return self.codec.decode(cache_item['packed_body'])
+        elif cache_item.get('body_digest'):
+            with self.cursor() as cursor:
+                row = self.execute(cursor, 'grab_cache_load_body',
+                                   (cache_item['body_digest'],)).fetchone()
+            if row is None:
+                raise CacheBodyNotFound('Body %s is not found'
+                                        % cache_item['body_digest'])
+            return self.codec.decode(row[0])
+        else:
+            # Cache item saved by older version of grab
+            return cache_item['body']
+
+    def acquire_body(self, cursor, digest, body, url):
+        """
+        Increase reference counter of the body. Save the body if
+        it does not exist yet.
+        """
+
+        import psycopg2
+
+        self.execute(cursor, 'grab_cache_acquire_body', (digest,))
+        if not cursor.rowcount:
+            self.execute(cursor, 'grab_cache_insert_body',
+                         (digest,
+                          psycopg2.Binary(self.codec.encode(body, url))))
+
+    def release_body(self, cursor, digest):
+        """
+        Decrease reference counter of the body. Remove the body if
+        there are no more cache items which use it.
+        """
+
+        self.execute(cursor, 'grab_cache_release_body', (digest,))
+        self.execute(cursor, 'grab_cache_delete_body', (digest,))
 
     def load_response(self, grab, cache_item):
-        grab.setup_document(cache_item['body'])
-
-        body = cache_item['body']
-
-        def custom_prepare_response_func(transport, grab):
-            response = Response()
-            response.head = cache_item['head']
-            response.body = body
-            response.code = cache_item['response_code']
-            response.download_size = len(body)
-            response.upload_size = 0
-            response.download_speed = 0
-            response.url = cache_item['response_url']
-            response.parse(charset=grab.config['document_charset'])
-            response.cookies = CookieManager(transport.extract_cookiejar())
-            response.from_cache = True
-            return response
-
-        grab.process_request_result(custom_prepare_response_func)
+        load_cached_response(grab, cache_item,
+                             lambda: self.load_body(cache_item),
+                             stat=self.codec.stat)
 
     def save_response(self, url, grab):
-        body = grab.response.body
-
-        item = {
-            'url': url,
-            'response_url': grab.response.url,
-            'body': body,
-            'head': grab.response.head,
-            'response_code': grab.response.code,
-            'cookies': None,
-        }
-        self.set_item(url, item)
+        """
+        Save the response into the cache.
+
+        Returns digest of the body which had been saved for same URL
+        before or None.
+        """
+
+        digest = grab.response.body_digest
+        item = build_response_item(url, grab)
+        _hash = self.build_hash(url)
+        with self.transaction() as cursor:
+            old_digest = self.select_body_digest(cursor, _hash)
+            if old_digest != digest:
+                self.acquire_body(cursor, digest, grab.response.body, url)
+            self.write_item(cursor, _hash, item, url, body_digest=digest)
+            if old_digest is not None and old_digest != digest:
+                self.release_body(cursor, old_digest)
+        return old_digest
+
+    def save_responses(self, responses, timestamps=None):
+        """
+        Save many responses in one transaction. Cache items are
+        written with one multi-row INSERT statement.
+
+        :param responses: list of (url, grab) pairs
+        :param timestamps: dict which maps URL to the time when the response
+            has been received, default is current time
+        Returns dict which maps URL to digest of the body which had been
+        saved for the URL before.
+        """
 
-    def set_item(self, url, item):
         import psycopg2
+        from psycopg2.extras import execute_values
 
+        # One statement could not update same row twice
+        responses = dict((self.build_hash(url), (url, grab))
+                         for url, grab in responses)
+        if not responses:
+            return {}
+        now = int(time.time())
+        result = {}
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT id, body_id FROM cache
+                WHERE id = ANY(%s)
+                FOR UPDATE
+                ''', ([psycopg2.Binary(make_str(x)) for x in responses],))
+            old_digests = dict((decode_digest(x[0]), decode_digest(x[1]))
+                               for x in cursor.fetchall())
+            rows = []
+            for _hash, (url, grab) in responses.items():
+                digest = grab.response.body_digest
+                old_digest = old_digests.get(_hash)
+                if old_digest != digest:
+                    self.acquire_body(cursor, digest, grab.response.body,
+                                      url)
+                data = self.pack_database_value(
+                    build_response_item(url, grab), url)
+                ts = timestamps.get(url, now) if timestamps else now
+                rows.append((_hash, ts, psycopg2.Binary(data), digest, ts))
+                result[url] = old_digest
+            execute_values(cursor, UPSERT_ITEMS_SQL, rows)
+            for url, grab in responses.values():
+                old_digest = result[url]
+                if (old_digest is not None
+                        and old_digest != grab.response.body_digest):
+                    self.release_body(cursor, old_digest)
+        return result
+
+    def set_item(self, url, item):
         _hash = self.build_hash(url)
-        data = self.pack_database_value(item)
-        self.cursor.execute('BEGIN')
-        ts = int(time.time())
-        sql = '''
-              UPDATE cache SET timestamp = %s, data = %s WHERE id = %s;
-              INSERT INTO cache (id, timestamp, data)
-              SELECT %s, %s, %s WHERE NOT EXISTS
-                (SELECT 1 FROM cache WHERE id = %s);
-              '''
-        self.cursor.execute(sql, (ts, psycopg2.Binary(data), _hash,
-                            _hash, ts, psycopg2.Binary(data), _hash))
-        self.cursor.execute('COMMIT')
-
-    def pack_database_value(self, val):
-        dump = marshal.dumps(val)
-        return zlib.compress(dump)
+        with self.transaction() as cursor:
+            old_digest = self.select_body_digest(cursor, _hash)
+            self.write_item(cursor, _hash, item, url)
+            if old_digest is not None:
+                self.release_body(cursor, old_digest)
+
+    def write_item(self, cursor, _hash, item, url, body_digest=None):
+        import psycopg2
+
+        data = self.pack_database_value(item, url)
+        self.execute(cursor, 'grab_cache_write_item',
+                     (_hash, int(time.time()), psycopg2.Binary(data),
+                      body_digest))
+
+    def pack_database_value(self, val, url=None):
+        if 'body' in val:
+            packed_body = self.codec.encode(val['body'], url)
+        else:
+            packed_body = None
+        return pack_record(val, packed_body=packed_body)
+
+    def remove_items(self, order_field, limit, max_timestamp=None):
+        """
+        Remove `limit` items with lowest value of `order_field`.
+
+        Returns number of removed items.
+        """
+
+        if max_timestamp is None:
+            query = ''
+        else:
+            query = 'WHERE timestamp < %d' % max_timestamp
+        with self.transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM cache
+                WHERE id IN (
+                    SELECT id FROM cache %(query)s
+                    ORDER BY %(field)s
+                    LIMIT %(limit)d
+                )
+                RETURNING body_id
+                ''' % {'query': query, 'field': order_field,
+                       'limit': limit})
+            rows = cursor.fetchall()
+            for row in rows:
+                if row[0] is not None:
+                    self.release_body(cursor, decode_digest(row[0]))
+        return len(rows)
+
+    def remove_expired_items(self, timeout, batch_size=1000):
+        """
+        Remove batch of items which are older than `timeout` seconds.
+        """
+
+        return self.remove_items('timestamp', batch_size,
+                                 max_timestamp=int(time.time()) - timeout)
+
+    def evict_items(self, batch_size=1000):
+        """
+        Remove batch of items which exceed `max_items` limit.
+        """
+
+        if self.max_items is None:
+            return 0
+        excess = self.size() - self.max_items
+        if excess > 0:
+            return self.remove_items(self.eviction_field,
+                                     min(excess, batch_size))
+        else:
+            return 0
 
     def clear(self):
-        self.cursor.execute('BEGIN')
-        self.cursor.execute('TRUNCATE cache')
-        self.cursor.execute('COMMIT')
+        with self.transaction() as cursor:
+            cursor.execute('TRUNCATE cache')
+            cursor.execute('TRUNCATE cache_body')
 
     def has_item(self, url, timeout=None):
         """
@@ -171,21 +671,17 @@ class CacheBackend(object):
 
         _hash = self.build_hash(url)
         with self.spider.timer.log_time('cache.read.postgresql_query'):
-            if timeout is None:
-                query = ""
-            else:
-                ts = int(time.time()) - timeout
-                query = " AND timestamp > %d" % ts
-            self.cursor.execute('''
-                SELECT id
-                FROM cache
-                WHERE id = %%s %(query)s
-                LIMIT 1
-                ''' % {'query': query},
-                (_hash,))
-            row = self.cursor.fetchone()
-        return True if row else False
+            with self.cursor() as cursor:
+                row = self.execute(
+                    cursor, 'grab_cache_has_item',
+                    (_hash, self.get_min_timestamp(timeout))).fetchone()
+        return bool(row)
 
     def size(self):
-        self.cursor.execute('SELECT COUNT(*) from cache')
-        return self.cursor.fetchone()[0]
+        with self.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) from cache')
+            return cursor.fetchone()[0]
+
+    def close(self):
+        self.pool.closeall()
+        self.prepared_statements.clear()
@@ -0,0 +1,203 @@
+"""
+Binary format of cache records shared by all cache backends.
+
+Record consists of fixed-size header and variable-size sections::
+
+    header: magic, version, flags, response code, timestamp, size of
+            the body, lengths of sections, SHA1 digest of the body
+    sections: key, response URL, charset, BOM, head, packed body
+
+The key of the item starts with the URL, see
+`grab.spider.cache_backend.key`.
+
+The packed body section is empty if the body is stored separately
+(in `cache_body` storage) under its digest. Charset and size of the body
+are saved so the cached document could be loaded without touching the
+body: it is decompressed only on first access to `Document.body`.
+
+Values written by older versions of grab are compressed `marshal` dumps
+of the item dict, they do not start with `RECORD_MAGIC`.
+"""
+from binascii import hexlify, unhexlify
+import struct
+import time
+from weblib.encoding import make_str, make_unicode
+
+from grab.base import Grab
+from grab.cookie import CookieManager
+from grab.document import Document
+from grab.spider.cache_backend.key import get_key_url
+from grab.spider.error import SpiderInternalError
+
+RECORD_MAGIC = b'GRC'
+RECORD_VERSION = 2
+FLAG_BODY_DIGEST = 1
+FLAG_BODY_SIZE = 2
+# FORMAT: magic, version, flags, response code, timestamp, body size,
+# lengths of key, response url, charset, bom, head and packed body,
+# body digest. Size of the body and length of the packed body are 64-bit
+# values, so bodies of 4GB and more could be stored.
+RECORD_HEADER = struct.Struct('>3sBBHIQIIBBIQ20s')
+# Headers of supported versions, version 1 has 32-bit body sizes
+RECORD_HEADERS = {
+    1: struct.Struct('>3sBBHIIIIBBII20s'),
+    2: RECORD_HEADER,
+}
+
+
+def is_record(data):
+    return bytes(data[:len(RECORD_MAGIC)]) == RECORD_MAGIC
+
+
+def pack_record(item, packed_body=None):
+    """
+    Pack cache item into binary record.
+
+    :param packed_body: packed body which is stored inside of the record
+    """
+
+    flags = 0
+    digest = item.get('body_digest')
+    if digest:
+        flags |= FLAG_BODY_DIGEST
+    body_size = item.get('body_size')
+    if body_size is not None:
+        flags |= FLAG_BODY_SIZE
+    key = make_str(item.get('key') or item.get('url') or '')
+    response_url = make_str(item.get('response_url') or '')
+    charset = make_str(item.get('charset') or '')
+    bom = item.get('bom') or b''
+    head = item.get('head') or b''
+    packed_body = packed_body or b''
+    header = RECORD_HEADER.pack(
+        RECORD_MAGIC, RECORD_VERSION, flags, item.get('response_code') or 0,
+        int(item.get('timestamp') or time.time()), body_size or 0,
+        len(key), len(response_url), len(charset), len(bom), len(head),
+        len(packed_body), unhexlify(digest) if digest else b'\x00' * 20)
+    return b''.join((header, key, response_url, charset, bom, head,
+                     packed_body))
+
+
+def unpack_record(data):
+    """
+    Unpack binary record into cache item. Packed body stored inside
+    of the record is saved into `packed_body` key of the item.
+    """
+
+    data = bytes(data)
+    header = RECORD_HEADERS.get(bytearray(data[3:4])[0]
+                                if len(data) > 3 else None)
+    if not is_record(data) or header is None:
+        raise SpiderInternalError('Unsupported cache record: %r'
+                                  % data[:RECORD_HEADER.size])
+    (magic, version, flags, code, timestamp, body_size, key_len,
+     response_url_len, charset_len, bom_len, head_len, packed_body_len,
+     digest) = header.unpack_from(data)
+    pos = header.size
+    sections = []
+    for size in (key_len, response_url_len, charset_len, bom_len, head_len,
+                 packed_body_len):
+        sections.append(data[pos:pos + size])
+        pos += size
+    key, response_url, charset, bom, head, packed_body = sections
+    key = make_unicode(key)
+    item = {
+        'key': key,
+        'url': get_key_url(key),
+        'response_url': make_unicode(response_url),
+        'timestamp': timestamp,
+        'response_code': code or None,
+        'head': head,
+        'charset': make_unicode(charset) if charset else None,
+        'bom': bom or None,
+        'body_digest': (hexlify(digest).decode('ascii')
+                        if flags & FLAG_BODY_DIGEST else None),
+        'body_size': body_size if flags & FLAG_BODY_SIZE else None,
+        'cookies': None,
+    }
+    if packed_body:
+        item['packed_body'] = packed_body
+    return item
+
+
+def build_response_item(url, grab):
+    """
+    Build cache item of the response of Grab instance.
+    """
+
+    return {
+        'key': url,
+        'url': get_key_url(url),
+        'response_url': grab.response.url,
+        'body_digest': grab.response.body_digest,
+        'body_size': len(grab.response.body),
+        'head': grab.response.head,
+        'response_code': grab.response.code,
+        'charset': grab.response.charset,
+        'bom': grab.response.bom,
+        'cookies': None,
+    }
+
+
+def build_grab(cache_item, body):
+    """
+    Build Grab instance with the document of the cache item e.g. to save
+    the document into another cache.
+    """
+
+    grab = Grab()
+    doc = Document(grab=grab)
+    doc.head = cache_item['head']
+    doc.body = body
+    doc.body_digest = cache_item.get('body_digest')
+    doc.code = cache_item['response_code']
+    doc.url = cache_item['response_url']
+    doc.parse(charset=cache_item.get('charset'))
+    if cache_item.get('bom'):
+        doc.bom = cache_item['bom']
+    grab.doc = doc
+    return grab
+
+
+def load_cached_response(grab, cache_item, load_body, stat=None):
+    """
+    Setup the document of Grab instance from the cache item.
+
+    :param load_body: function which loads the body of the cache item,
+        it is called on first access to `Document.body`. Items saved by
+        older versions of grab do not contain charset and size of the
+        body, the body of such item is loaded immediately.
+    :param stat: `Stat` instance, time of body loading is added to
+        "cache.load_body" histogram
+    """
+
+    charset = grab.config['document_charset'] or cache_item.get('charset')
+    if stat is not None:
+        raw_load_body = load_body
+
+        def load_body():
+            with stat.measure_time('cache.load_body'):
+                return raw_load_body()
+
+    def custom_prepare_response_func(transport, grab):
+        response = Document()
+        response.head = cache_item['head']
+        if charset is None or cache_item.get('body_size') is None:
+            response.body = load_body()
+            response.download_size = len(response.body)
+        else:
+            response.set_body_loader(load_body)
+            response.download_size = cache_item['body_size']
+        response.code = cache_item['response_code']
+        response.upload_size = 0
+        response.download_speed = 0
+        response.url = cache_item['response_url']
+        response.body_digest = cache_item.get('body_digest')
+        response.parse(charset=charset)
+        if cache_item.get('bom') and not grab.config['document_charset']:
+            response.bom = cache_item['bom']
+        response.cookies = CookieManager(transport.extract_cookiejar())
+        response.from_cache = True
+        return response
+
+    grab.process_request_result(custom_prepare_response_func)
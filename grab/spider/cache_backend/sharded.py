@@ -0,0 +1,259 @@
+"""
+Cache backend which spreads cache items across several cache backends
+(shards) e.g. across several database servers.
+
+Each key is routed by the prefix of its SHA1 hash with consistent hashing:
+each shard owns many points of the hash ring and the key belongs to the
+shard which owns the nearest point. When a new shard is added only about
+1/N of keys change their shard. Use `rebalance` method to move such items
+into their new shards.
+
+Methods which do not depend on the key (`size`, `clear`, `iterate_items`,
+`remove_expired_items`, `evict_items`) are executed on all shards.
+
+Example::
+
+    bot.setup_cache(backend='sharded', database='cache', shards=[
+        {'name': 'a', 'backend': 'postgresql', 'host': 'db1'},
+        {'name': 'b', 'backend': 'postgresql', 'host': 'db2'},
+    ])
+"""
+from bisect import bisect
+from collections import OrderedDict, defaultdict
+from hashlib import sha1
+import logging
+from weblib.encoding import make_str
+
+from grab.spider.cache_backend.record import build_grab, load_cached_response
+from grab.spider.error import SpiderConfigurationError
+
+DEFAULT_VIRTUAL_NODES = 128
+# Length of the hash prefix which is used as point on the hash ring
+POINT_PREFIX_LENGTH = 8
+logger = logging.getLogger('grab.spider.cache_backend.sharded')
+
+
+def get_point(value):
+    return int(sha1(make_str(value)).hexdigest()[:POINT_PREFIX_LENGTH], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring.
+
+    :param names: names of shards
+    :param virtual_nodes: number of points owned by each shard, more points
+        give more even distribution of keys
+    """
+
+    def __init__(self, names, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        nodes = sorted((get_point('%s-%d' % (name, idx)), name)
+                       for name in names
+                       for idx in range(virtual_nodes))
+        self.points = [x[0] for x in nodes]
+        self.names = [x[1] for x in nodes]
+
+    def get_name(self, _hash):
+        """
+        Return name of the shard which owns the key with given hex hash.
+        """
+
+        point = int(_hash[:POINT_PREFIX_LENGTH], 16)
+        return self.names[bisect(self.points, point) % len(self.points)]
+
+
+class CacheBackend(object):
+    """
+    Cache backend which routes each key to one of shards.
+
+    :param shards: list of configs of shards. Each config is a dict with
+        `backend` key and options of that backend. Options which are not
+        set in the config of the shard are taken from the arguments of
+        sharded backend e.g. `database` or `max_items` (which limits size
+        of each shard). Optional `name` key sets the name of the shard
+        which is used to build the hash ring, default name is the index
+        of the shard. Keep names of existing shards when you add new
+        shards.
+    :param virtual_nodes: number of points of the hash ring owned by each
+        shard
+    """
+
+    def __init__(self, database, shards=None, spider=None,
+                 virtual_nodes=DEFAULT_VIRTUAL_NODES, **kwargs):
+        if not shards:
+            raise SpiderConfigurationError('Sharded cache backend requires '
+                                           'shards option')
+        self.spider = spider
+        self.shards = OrderedDict()
+        for idx, shard_config in enumerate(shards):
+            config = dict(kwargs, database=database)
+            config.update(shard_config)
+            name = str(config.pop('name', idx))
+            if name in self.shards:
+                raise SpiderConfigurationError('Duplicate name of cache '
+                                               'shard: %s' % name)
+            try:
+                backend = config.pop('backend')
+            except KeyError:
+                raise SpiderConfigurationError('Config of cache shard %s '
+                                               'has no backend option'
+                                               % name)
+            mod = __import__('grab.spider.cache_backend.%s' % backend,
+                             globals(), locals(), ['foo'])
+            self.shards[name] = mod.CacheBackend(spider=spider, **config)
+        self.ring = HashRing(list(self.shards), virtual_nodes=virtual_nodes)
+
+    @property
+    def max_items(self):
+        """
+        Total size limit of shards which have `max_items` option, None if
+        no shard is limited. The spider starts the cache sweeper if it
+        is set.
+        """
+
+        limits = [x.max_items for x in self.shards.values()
+                  if getattr(x, 'max_items', None) is not None]
+        return sum(limits) if limits else None
+
+    def build_hash(self, url):
+        utf_url = make_str(url)
+        return sha1(utf_url).hexdigest()
+
+    def get_shard_name(self, url):
+        return self.ring.get_name(self.build_hash(url))
+
+    def get_shard(self, url):
+        return self.shards[self.get_shard_name(url)]
+
+    def group_by_shard(self, urls):
+        """
+        Returns dict which maps name of shard to list of URLs.
+        """
+
+        groups = defaultdict(list)
+        for url in urls:
+            groups[self.get_shard_name(url)].append(url)
+        return groups
+
+    def get_item(self, url, timeout=None):
+        name = self.get_shard_name(url)
+        item = self.shards[name].get_item(url, timeout=timeout)
+        if item is not None:
+            item['shard'] = name
+        return item
+
+    def get_items(self, urls, timeout=None):
+        result = {}
+        for name, shard_urls in self.group_by_shard(urls).items():
+            items = self.shards[name].get_items(shard_urls, timeout=timeout)
+            for item in items.values():
+                item['shard'] = name
+            result.update(items)
+        return result
+
+    def has_item(self, url, timeout=None):
+        return self.get_shard(url).has_item(url, timeout=timeout)
+
+    def touch_item(self, url):
+        self.get_shard(url).touch_item(url)
+
+    def remove_cache_item(self, url):
+        self.get_shard(url).remove_cache_item(url)
+
+    def get_body_digest(self, url):
+        return self.get_shard(url).get_body_digest(url)
+
+    def load_body(self, cache_item):
+        return self.shards[cache_item['shard']].load_body(cache_item)
+
+    def load_response(self, grab, cache_item):
+        load_cached_response(grab, cache_item,
+                             lambda: self.load_body(cache_item),
+                             stat=self.spider.stat if self.spider else None)
+
+    def save_response(self, url, grab):
+        return self.get_shard(url).save_response(url, grab)
+
+    def save_responses(self, responses, timestamps=None):
+        """
+        Save many responses, each shard saves its responses with one
+        `save_responses` call.
+        """
+
+        groups = defaultdict(list)
+        for url, grab in responses:
+            groups[self.get_shard_name(url)].append((url, grab))
+        result = {}
+        for name, shard_responses in groups.items():
+            result.update(self.shards[name].save_responses(
+                shard_responses, timestamps=timestamps))
+        return result
+
+    def iterate_items(self, batch_size=1000):
+        """
+        Iterate over items of all shards, shard after shard.
+        """
+
+        for name, shard in self.shards.items():
+            for item in shard.iterate_items(batch_size=batch_size):
+                item['shard'] = name
+                yield item
+
+    def rebalance(self, batch_size=1000):
+        """
+        Move items which are stored in wrong shards e.g. after new shard
+        has been added. Items are moved in batches of `batch_size` items.
+
+        Returns number of moved items.
+        """
+
+        total = 0
+        for name, shard in self.shards.items():
+            batch = []
+            for item in shard.iterate_items(batch_size=batch_size):
+                key = item.get('key', item['url'])
+                if self.get_shard_name(key) != name:
+                    batch.append((key, item))
+                    if len(batch) >= batch_size:
+                        total += self.move_items(shard, batch)
+                        batch = []
+            if batch:
+                total += self.move_items(shard, batch)
+        return total
+
+    def move_items(self, shard, items):
+        """
+        Move items from the shard into shards which own their keys.
+        Timestamps of items are kept.
+
+        :param items: list of (key, item) pairs
+        """
+
+        self.save_responses(
+            [(key, build_grab(item, shard.load_body(item)))
+             for key, item in items],
+            timestamps=dict((key, item['timestamp']) for key, item in items))
+        for key, item in items:
+            shard.remove_cache_item(key)
+        logger.debug('Moved %d cache items' % len(items))
+        return len(items)
+
+    def remove_expired_items(self, timeout, batch_size=1000):
+        return sum(x.remove_expired_items(timeout, batch_size=batch_size)
+                   for x in self.shards.values())
+
+    def evict_items(self, batch_size=1000):
+        return sum(x.evict_items(batch_size=batch_size)
+                   for x in self.shards.values())
+
+    def clear(self):
+        for shard in self.shards.values():
+            shard.clear()
+
+    def size(self):
+        return sum(x.size() for x in self.shards.values())
+
+    def close(self):
+        for shard in self.shards.values():
+            if hasattr(shard, 'close'):
+                shard.close()
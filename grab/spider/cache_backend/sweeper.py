@@ -0,0 +1,99 @@
+"""
+Background removing of expired and excess cache items.
+
+Cache backend which supports sweeping should implement methods:
+* remove_expired_items(timeout, batch_size) - remove items which are older
+    than `timeout` seconds, return number of removed items
+* evict_items(batch_size) - remove items which exceed `max_items` limit
+    of the backend, return number of removed items
+
+Each call should remove no more than `batch_size` items so the cache
+storage is not locked for long time.
+"""
+import logging
+import threading
+
+from grab.spider.error import SpiderConfigurationError
+
+DEFAULT_SWEEP_INTERVAL = 60
+DEFAULT_SWEEP_BATCH_SIZE = 1000
+# Name of cache item field which is used to order items for eviction
+EVICTION_FIELDS = {
+    # least recently saved items are removed first
+    'oldest': 'timestamp',
+    # least recently used items are removed first
+    'lru': 'access_time',
+}
+logger = logging.getLogger('grab.spider.cache_backend.sweeper')
+
+
+def get_eviction_field(policy):
+    try:
+        return EVICTION_FIELDS[policy]
+    except KeyError:
+        raise SpiderConfigurationError('Unknown cache eviction policy: %s'
+                                       % policy)
+
+
+class CacheSweeperThread(threading.Thread):
+    """
+    Periodically removes expired items and evicts items which exceed
+    size limit of the cache.
+
+    The thread should use its own cache backend instance because
+    connections of backends are not thread-safe.
+    """
+
+    def __init__(self, spider, cache, ttl=None,
+                 interval=DEFAULT_SWEEP_INTERVAL,
+                 batch_size=DEFAULT_SWEEP_BATCH_SIZE, *args, **kwargs):
+        self.spider = spider
+        self.cache = cache
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stop_event = threading.Event()
+        super(CacheSweeperThread, self).__init__(*args, **kwargs)
+        self.daemon = True
+
+    def sweep(self):
+        """
+        Remove batches of expired items and then batches of items
+        which exceed size limit.
+
+        Returns total number of removed items.
+        """
+
+        total = 0
+        if self.ttl is not None:
+            total += self.remove_batches(self.cache.remove_expired_items,
+                                         'spider:cache-expired-removed',
+                                         self.ttl)
+        total += self.remove_batches(self.cache.evict_items,
+                                     'spider:cache-evicted')
+        return total
+
+    def remove_batches(self, func, stat_key, *args):
+        total = 0
+        while not self.stop_event.is_set():
+            count = func(*args, batch_size=self.batch_size)
+            if count:
+                total += count
+                self.spider.stat.inc(stat_key, count)
+            if count < self.batch_size:
+                break
+        return total
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                count = self.sweep()
+            except Exception as ex:
+                logger.error('Cache sweeping failed', exc_info=ex)
+            else:
+                if count:
+                    logger.debug('Removed %d items from cache' % count)
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
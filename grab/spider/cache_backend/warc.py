@@ -0,0 +1,381 @@
+"""
+Export of the spider cache into WARC files and import of WARC files
+into the cache.
+
+Each WARC record is compressed as separate gzip member, so the files
+could be read by any WARC tool and could be concatenated. Export writes
+series of files, each file contains up to `records_per_file` records.
+Records are compressed in `processes` worker processes. Import reads many
+files in parallel: each worker process imports its own file into its own
+connection to the cache storage.
+
+Only "response" records are imported. Transfer and content encodings of
+the HTTP payload are decoded because the cache stores decoded bodies.
+WARC-Date of the record becomes the timestamp of the cache item. The cache
+key is stored percent-encoded in "WARC-Grab-Cache-Key" header if it
+differs from the URL: the key could contain line breaks.
+"""
+from base64 import b32encode
+import calendar
+from datetime import datetime
+from hashlib import sha1
+import gzip
+import logging
+import multiprocessing
+import time
+import uuid
+import zlib
+from six.moves.urllib.parse import quote, unquote
+from weblib.encoding import make_unicode
+
+from grab.base import Grab
+from grab.document import Document
+from grab.util.misc import make_bytes
+
+DEFAULT_RECORDS_PER_FILE = 10000
+DEFAULT_IMPORT_BATCH_SIZE = 100
+# How many records are sent to compression workers at once
+EXPORT_WINDOW_PER_PROCESS = 16
+# Characters of the cache key which are not percent-encoded
+CACHE_KEY_SAFE_CHARS = "/:?&=#;,+@!$'()*[]~"
+# These headers describe encoding of original network payload,
+# the cache stores decoded body
+SKIPPED_EXPORT_HEADERS = (b'transfer-encoding', b'content-encoding',
+                          b'content-length')
+logger = logging.getLogger('grab.spider.cache_backend.warc')
+
+
+def format_warc_date(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_warc_date(value):
+    """
+    Convert WARC-Date value into unix timestamp.
+
+    Returns None if the value is missing or invalid.
+    """
+
+    try:
+        date = datetime.strptime(make_unicode(value)[:19],
+                                 '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    return calendar.timegm(date.utctimetuple())
+
+
+def build_record(warc_type, headers, block):
+    """
+    Build gzip-compressed WARC record.
+
+    :param headers: list of (name, value) pairs, mandatory headers
+        are added automatically
+    """
+
+    lines = [b'WARC/1.0',
+             b'WARC-Type: ' + warc_type,
+             b'WARC-Record-ID: <urn:uuid:' + make_bytes(uuid.uuid4()) +
+             b'>']
+    for name, value in headers:
+        lines.append(make_bytes(name) + b': ' + make_bytes(value))
+    lines.append(b'Content-Length: ' + make_bytes(len(block)))
+    record = b'\r\n'.join(lines) + b'\r\n\r\n' + block + b'\r\n\r\n'
+    cobj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return cobj.compress(record) + cobj.flush()
+
+
+def build_warcinfo_record(filename):
+    block = (b'software: grab\r\n'
+             b'format: WARC File Format 1.0\r\n')
+    return build_record(b'warcinfo', [
+        ('WARC-Date', format_warc_date(datetime.utcnow())),
+        ('WARC-Filename', filename),
+        ('Content-Type', 'application/warc-fields'),
+    ], block)
+
+
+def build_http_head(head, body_size):
+    """
+    Build head of the last HTTP response stored in `head`: there could be
+    many responses in case of redirects.
+    """
+
+    parts = (head or b'').rsplit(b'\nHTTP/', 1)
+    head = b'HTTP/' + parts[1] if len(parts) > 1 else parts[0]
+    lines = head.strip().splitlines()
+    if not lines:
+        # Item without stored head
+        lines = [b'HTTP/1.1 200 OK']
+    result = [lines[0]]
+    for line in lines[1:]:
+        name = line.split(b':', 1)[0].strip().lower()
+        if line.strip() and name not in SKIPPED_EXPORT_HEADERS:
+            result.append(line)
+    result.append(b'Content-Length: ' + make_bytes(body_size))
+    return b'\r\n'.join(result) + b'\r\n\r\n'
+
+
+def build_response_record(args):
+    """
+    Build WARC "response" record.
+
+    :param args: (url, head, body, timestamp) or
+        (url, head, body, timestamp, key) tuple
+    """
+
+    url, head, body, timestamp = args[:4]
+    key = args[4] if len(args) > 4 else None
+    block = build_http_head(head, len(body)) + body
+    payload_digest = b32encode(sha1(body).digest())
+    headers = [
+        ('WARC-Date',
+         format_warc_date(datetime.utcfromtimestamp(timestamp))),
+        ('WARC-Target-URI', url),
+        ('WARC-Payload-Digest', b'sha1:' + payload_digest),
+        ('Content-Type', 'application/http; msgtype=response'),
+    ]
+    if key and key != url:
+        headers.append(('WARC-Grab-Cache-Key',
+                        quote(make_bytes(key), safe=CACHE_KEY_SAFE_CHARS)))
+    return build_record(b'response', headers, block)
+
+
+def iterate_export_windows(cache, window_size):
+    window = []
+    for item in cache.iterate_items():
+        window.append((item['url'], item['head'], cache.load_body(item),
+                       item['timestamp'], item.get('key')))
+        if len(window) >= window_size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def export_warc(spider, path_template,
+                records_per_file=DEFAULT_RECORDS_PER_FILE, processes=None):
+    """
+    Export all items of the cache of the spider into WARC files.
+
+    :param spider: spider with configured cache
+    :param path_template: path of WARC file with "%d" placeholder for the
+        number of file e.g. "/data/crawl-%05d.warc.gz"
+    :param processes: number of processes which compress records,
+        default is number of CPU cores
+
+    Returns list of created files.
+    """
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        build_records = pool.map
+    else:
+        pool = None
+        build_records = map
+    paths = []
+    out = None
+    file_records = 0
+    try:
+        for window in iterate_export_windows(
+                spider.cache, processes * EXPORT_WINDOW_PER_PROCESS):
+            for record in build_records(build_response_record, window):
+                if out is None or file_records >= records_per_file:
+                    if out is not None:
+                        out.close()
+                    path = path_template % len(paths)
+                    logger.debug('Writing WARC file %s' % path)
+                    out = open(path, 'wb')
+                    out.write(build_warcinfo_record(path))
+                    paths.append(path)
+                    file_records = 0
+                out.write(record)
+                file_records += 1
+    finally:
+        if out is not None:
+            out.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return paths
+
+
+def read_warc_records(stream):
+    """
+    Iterate over (headers, block) pairs of records of uncompressed WARC
+    stream. Names of headers are lower-cased.
+    """
+
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        if not line.strip():
+            # Blank lines between records
+            continue
+        if not line.startswith(b'WARC/'):
+            raise ValueError('Invalid WARC record: %r' % line[:100])
+        headers = {}
+        while True:
+            line = stream.readline()
+            if not line.strip():
+                break
+            name, value = line.split(b':', 1)
+            headers[name.strip().lower()] = value.strip()
+        block = stream.read(int(headers.get(b'content-length', 0)))
+        yield headers, block
+
+
+def parse_http_headers(head):
+    headers = {}
+    for line in head.splitlines()[1:]:
+        if b':' in line:
+            name, value = line.split(b':', 1)
+            headers[name.strip().lower()] = value.strip().lower()
+    return headers
+
+
+def decode_chunked(data):
+    parts = []
+    pos = 0
+    while True:
+        end = data.find(b'\r\n', pos)
+        if end == -1:
+            break
+        size = int(data[pos:end].split(b';', 1)[0].strip() or b'0', 16)
+        if not size:
+            break
+        parts.append(data[end + 2:end + 2 + size])
+        pos = end + 2 + size + 2
+    return b''.join(parts)
+
+
+def decode_payload(headers, body):
+    try:
+        if headers.get(b'transfer-encoding') == b'chunked':
+            body = decode_chunked(body)
+        encoding = headers.get(b'content-encoding')
+        if encoding in (b'gzip', b'x-gzip'):
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == b'deflate':
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+    except (ValueError, zlib.error) as ex:
+        logger.debug('Could not decode HTTP payload: %s' % ex)
+    return body
+
+
+def parse_response_record(headers, block):
+    """
+    Build Grab instance with the document stored in WARC "response" record.
+
+    Returns None if the record does not contain HTTP response.
+    """
+
+    if (headers.get(b'warc-type') != b'response'
+            or not headers.get(b'content-type', b'').startswith(
+                b'application/http')):
+        return None
+    url = headers[b'warc-target-uri'].strip(b'<>')
+    while True:
+        head, sep, body = block.partition(b'\r\n\r\n')
+        if not sep:
+            head, sep, body = block.partition(b'\n\n')
+        try:
+            code = int(head.split(None, 2)[1])
+        except (ValueError, IndexError):
+            logger.debug('Invalid HTTP response in WARC record of %s' % url)
+            return None
+        # Skip informational responses e.g. "100 Continue"
+        if 100 <= code < 200 and body.startswith(b'HTTP/'):
+            block = body
+        else:
+            break
+    head += b'\r\n\r\n'
+    grab = Grab()
+    doc = Document(grab=grab)
+    doc.head = head
+    doc.body = decode_payload(parse_http_headers(head), body)
+    doc.code = code
+    doc.url = make_unicode(url)
+    doc.parse()
+    grab.doc = doc
+    return grab
+
+
+def import_warc_file(cache, path, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    """
+    Import response records of the WARC file into the cache.
+
+    Returns number of imported records.
+    """
+
+    logger.debug('Importing WARC file %s' % path)
+    count = 0
+    batch = []
+    timestamps = {}
+    # gzip module reads files which consist of many gzip members
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as stream:
+        for headers, block in read_warc_records(stream):
+            grab = parse_response_record(headers, block)
+            if grab is not None:
+                key = grab.doc.url
+                if headers.get(b'warc-grab-cache-key'):
+                    key = make_unicode(unquote(make_unicode(
+                        headers[b'warc-grab-cache-key'])))
+                batch.append((key, grab))
+                timestamps[key] = (parse_warc_date(headers.get(b'warc-date'))
+                                   or int(time.time()))
+                if len(batch) >= batch_size:
+                    cache.save_responses(batch, timestamps=timestamps)
+                    count += len(batch)
+                    batch = []
+                    timestamps = {}
+    if batch:
+        cache.save_responses(batch, timestamps=timestamps)
+        count += len(batch)
+    return count
+
+
+def import_warc_file_process(args):
+    from grab.spider.base import Spider
+
+    cache_config, path, batch_size = args
+    bot = Spider()
+    bot.setup_cache(**cache_config)
+    return import_warc_file(bot.cache, path, batch_size=batch_size)
+
+
+def import_warc(spider, paths, processes=None,
+                batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    """
+    Import WARC files into the cache of the spider.
+
+    :param spider: spider with configured cache, each worker process
+        opens its own cache backend with the cache config of the spider
+    :param paths: list of WARC files
+    :param processes: number of files which are imported in parallel,
+        default is number of CPU cores
+
+    Returns number of imported records.
+    """
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(paths))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            return sum(pool.imap_unordered(
+                import_warc_file_process,
+                [(spider.cache_config, x, batch_size) for x in paths]))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return sum(import_warc_file(spider.cache, x, batch_size=batch_size)
+                   for x in paths)
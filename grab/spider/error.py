@@ -4,7 +4,7 @@ from grab.error import GrabError
 
 __all__ = ('SpiderError', 'SpiderMisuseError', 'FatalError',
            'SpiderInternalError',
-           'NoTaskHandler', 'NoDataHandler')
+           'NoTaskHandler', 'NoDataHandler', 'CacheBodyNotFound')
 
 
 class SpiderError(GrabError):
@@ -42,3 +42,11 @@ class NoDataHandler(SpiderError):
     Used then it is not possible to find which
     handler should be used to process Data object.
     """
+
+
+class CacheBodyNotFound(SpiderError):
+    """
+    Used then the body of cache item has been removed from the cache
+    storage after the item has been loaded. The spider sends the task
+    to the network again.
+    """
@@ -36,9 +36,13 @@ class ApiHandler(SimpleHTTPRequestHandler):
             'counters': self.spider.stat.counters,
             'collections': dict((x, len(y)) for (x, y)
                                 in self.spider.stat.collections.items()),
+            'histograms': dict((x, y.to_dict()) for (x, y)
+                               in list(self.spider.stat.histograms.items())),
             'thread_number': self.spider.thread_number,
             'parser_pool_size': self.spider.parser_pool_size,
         }
+        if self.spider.cache_enabled:
+            info['cache'] = self.spider.get_cache_stats()
         content = make_str(json.dumps(info))
         self.response(content=content)
 
@@ -23,6 +23,7 @@ class Task(BaseTask):
                  raw=False, callback=None,
                  fallback_name=None,
                  error_callback=None,
+                 cache_key=None, parser_profile=None,
                  **kwargs):
         """
         Create `Task` object.
@@ -87,6 +88,12 @@ class Task(BaseTask):
                 gives up to do the task (due to multiple network errors)
             :param error_callback: if request was failed then will execute
                 'error_callback' function.
+            :param cache_key: `CacheKeyBuilder` instance which builds the key
+                of cache item for this task instead of the builder
+                configured in `Spider.setup_cache`
+            :param parser_profile: profile of lxml parser which is used to
+                build DOM tree of the response, see `parser_profile` option
+                of Grab
 
             Any non-standard named arguments passed to `Task` constructor will
             be saved as attributes of the object. You can get their values
@@ -143,6 +150,8 @@ class Task(BaseTask):
         self.valid_status = valid_status
         self.use_proxylist = use_proxylist
         self.cache_timeout = cache_timeout
+        self.cache_key = cache_key
+        self.parser_profile = parser_profile
         self.raw = raw
         self.origin_task_generator = None
         self.callback = callback
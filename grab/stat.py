@@ -4,6 +4,7 @@ Grab::Spider to collect statistics about events happening
 during the scraping session.
 """
 import logging
+from bisect import bisect_left
 from collections import defaultdict
 import time
 from contextlib import contextmanager
@@ -12,6 +13,65 @@ from grab.util.warning import warn
 
 DEFAULT_SPEED_KEY = 'spider:request-processed'
 DEFAULT_LOGGING_PERIOD = 1
+# Upper bounds (in seconds) of buckets of latency histograms
+DEFAULT_HISTOGRAM_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                             0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """
+    Counts values in buckets with fixed upper bounds. Percentiles are
+    estimated with upper bound of the bucket which contains the
+    percentile, so the error is not larger than the width of the bucket.
+    """
+
+    def __init__(self, buckets=DEFAULT_HISTOGRAM_BUCKETS):
+        self.buckets = sorted(buckets)
+        # The last bucket counts values larger than all bounds
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if idx < len(self.buckets):
+                    return min(self.buckets[idx], self.max)
+                else:
+                    return self.max
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': list(zip(self.buckets + ['inf'], self.counts)),
+        }
 
 
 class Stat(object):
@@ -39,6 +99,7 @@ class Stat(object):
     def reset(self):
         self.counters = defaultdict(int)
         self.collections = defaultdict(list)
+        self.histograms = {}
         self.counters_prev = defaultdict(int)
 
     def setup_logging_file(self, log_file):
@@ -94,6 +155,29 @@ class Stat(object):
     def collect(self, key, val):
         self.collections[key].append(val)
 
+    def observe(self, key, val):
+        """
+        Add the value to the histogram.
+        """
+
+        try:
+            hist = self.histograms[key]
+        except KeyError:
+            hist = self.histograms.setdefault(key, Histogram())
+        hist.add(val)
+
+    @contextmanager
+    def measure_time(self, key):
+        """
+        Add the time spent in the block to the histogram.
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(key, time.time() - start)
+
     def append(self, key, val):
         warn('Method `Stat::append` is deprecated. '
              'Use `Stat::collect` method instead.')
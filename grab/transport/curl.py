@@ -15,6 +15,7 @@ except ImportError:
 import pycurl
 import tempfile
 import os
+from hashlib import sha1
 from weblib.http import (encode_cookies, normalize_http_values,
                         normalize_post_data, normalize_url)
 from weblib.encoding import make_str, decode_pairs, make_unicode
@@ -23,9 +24,11 @@ from six.moves.http_cookiejar import CookieJar
 import sys
 from user_agent import generate_user_agent
 
+from grab.charset import get_charset_memo
 from grab.cookie import create_cookie, CookieManager
 from grab import error
 from grab.error import GrabMisuseError
+from grab.document import IncrementalTreeBuilder
 from grab.response import Response
 from grab.upload import UploadFile, UploadContent
 from grab.transport.base import BaseTransport
@@ -101,6 +104,8 @@ class CurlTransport(BaseTransport):
         self.response_header_chunks = []
         self.response_body_chunks = []
         self.response_body_bytes_read = 0
+        self.response_body_hash = sha1()
+        self.tree_builder = None
         self.verbose_logging = False
 
         # Maybe move to super-class???
@@ -129,10 +134,17 @@ class CurlTransport(BaseTransport):
         bytes_read = len(chunk)
 
         self.response_body_bytes_read += bytes_read
+        self.response_body_hash.update(chunk)
         if self.body_file:
             self.body_file.write(chunk)
         else:
             self.response_body_chunks.append(chunk)
+            if self.config_incremental_dom:
+                if self.tree_builder is None:
+                    self.tree_builder = IncrementalTreeBuilder(
+                        b''.join(self.response_header_chunks),
+                        **self.tree_builder_options)
+                self.tree_builder.feed(chunk)
         if self.config_body_maxsize is not None:
             if self.response_body_bytes_read > self.config_body_maxsize:
                 logger.debug('Response body max size limit reached: %s' %
@@ -196,6 +208,17 @@ class CurlTransport(BaseTransport):
         # Copy some config for future usage
         self.config_nobody = grab.config['nobody']
         self.config_body_maxsize = grab.config['body_maxsize']
+        self.config_incremental_dom = (
+            grab.config['incremental_dom']
+            and grab.config['body_inmemory']
+            and grab.config['content_type'] == 'html'
+            and not grab.config['lowercased_tree'])
+        self.tree_builder_options = {
+            'charset': grab.config['document_charset'],
+            'strip_null_bytes': grab.config['strip_null_bytes'],
+            'fix_special_entities': grab.config['fix_special_entities'],
+            'parser_profile': grab.config['parser_profile'],
+        }
 
         try:
             request_url = normalize_url(grab.config['url'])
@@ -510,10 +533,22 @@ class CurlTransport(BaseTransport):
 
         response.head = b''.join(self.response_header_chunks)
 
+        charset = grab.config['document_charset']
+        tree = None
         if self.body_path:
             response.body_path = self.body_path
+        elif self.tree_builder is not None:
+            tree = self.tree_builder.close()
+            if charset is None:
+                charset = self.tree_builder.charset
+                response.bom = self.tree_builder.bom
+            # Body is joined only if it is accessed
+            chunks = self.response_body_chunks
+            response.set_body_loader(lambda: b''.join(chunks))
+            self.tree_builder = None
         else:
             response.body = b''.join(self.response_body_chunks)
+        response.body_digest = self.response_body_hash.hexdigest()
 
         # Clear memory
         self.response_header_chunks = []
@@ -530,7 +565,11 @@ class CurlTransport(BaseTransport):
 
         response.url = self.curl.getinfo(pycurl.EFFECTIVE_URL)
 
-        response.parse(charset=grab.config['document_charset'])
+        response.parse(charset=charset,
+                       charset_memo=get_charset_memo(
+                           grab.config['charset_memo']))
+        if tree is not None:
+            response.set_tree(tree)
 
         response.cookies = CookieManager(self.extract_cookiejar())
 
@@ -589,6 +628,8 @@ class CurlTransport(BaseTransport):
         """
         state = self.__dict__.copy()
         state['curl'] = None
+        state['response_body_hash'] = None
+        state['tree_builder'] = None
         return state
 
     def __setstate__(self, state):
@@ -598,6 +639,7 @@ class CurlTransport(BaseTransport):
         """
 
         state['curl'] = pycurl.Curl()
+        state['response_body_hash'] = sha1()
         self.__dict__ = state
 
 
@@ -19,7 +19,9 @@ from six.moves.urllib.parse import urlparse
 
 from grab import error
 from grab.error import GrabMisuseError
+from grab.charset import get_charset_memo
 from grab.cookie import CookieManager, MockRequest, MockResponse
+from grab.headers import HeaderDict
 from grab.response import Response
 from grab.upload import UploadFile, UploadContent
 from grab.transport.base import BaseTransport
@@ -308,12 +310,10 @@ class Urllib3Transport(BaseTransport):
 
         response.url = self._response.get_redirect_location() or self._request.url
 
-        import email.message
-        hdr = email.message.Message() 
-        for key, val in self._response.getheaders().items():
-            hdr[key] = val
+        hdr = HeaderDict(items=self._response.getheaders().items())
         response.parse(charset=grab.config['document_charset'],
-                       headers=hdr)
+                       headers=hdr, charset_memo=get_charset_memo(
+                           grab.config['charset_memo']))
 
         jar = self.extract_cookiejar(self._response, self._request)
         response.cookies = CookieManager(jar)
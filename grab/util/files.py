@@ -0,0 +1,87 @@
+"""
+Copying of files without passing the data through python.
+
+`copy_file` tries (in this order):
+
+* hard link, if it is allowed with `link` argument
+* `os.copy_file_range` (python 3.8+, Linux): the data is copied inside
+  the kernel, file system could share the blocks of files
+* `os.sendfile` (python 3.3+): the data is copied inside the kernel
+* `shutil.copyfileobj`
+"""
+import errno
+import os
+import shutil
+
+__all__ = ('copy_file',)
+COPY_CHUNK_SIZE = 1024 * 1024
+# Errors which mean that the system call is not supported for given files
+UNSUPPORTED_ERRORS = set(getattr(errno, x) for x in (
+    'EXDEV', 'ENOSYS', 'EINVAL', 'ENOTSUP', 'EOPNOTSUPP', 'EBADF')
+    if hasattr(errno, x))
+
+
+def _copy_fd(func, inp_fd, out_fd, size):
+    """
+    Copy `size` bytes with `func(inp_fd, out_fd, offset, count)` function.
+
+    :returns: True if the data was copied, False if the function is not
+        supported and nothing was written
+    """
+
+    offset = 0
+    while offset < size:
+        try:
+            sent = func(inp_fd, out_fd, offset, size - offset)
+        except OSError as ex:
+            if offset == 0 and ex.errno in UNSUPPORTED_ERRORS:
+                return False
+            raise
+        if sent == 0:
+            # The source file has been truncated
+            break
+        offset += sent
+    return True
+
+
+def _copy_file_range(inp_fd, out_fd, offset, count):
+    return os.copy_file_range(inp_fd, out_fd, count, offset, offset)
+
+
+def _sendfile(inp_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, inp_fd, offset, count)
+
+
+def copy_file(src, dst, link=False):
+    """
+    Copy content of `src` file into `dst` file.
+
+    :param link: create hard link instead of copying if it is possible.
+        Note that the linked files share the content: if one of them is
+        rewritten in place, the other is changed too.
+    :returns: the name of method which has been used: "link",
+        "copy_file_range", "sendfile" or "copyfileobj"
+    """
+
+    if link and hasattr(os, 'link'):
+        try:
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.link(src, dst)
+        except OSError:
+            pass
+        else:
+            return 'link'
+    with open(src, 'rb') as inp:
+        with open(dst, 'wb') as out:
+            size = os.fstat(inp.fileno()).st_size
+            if size:
+                for name, func in (
+                        ('copy_file_range', _copy_file_range),
+                        ('sendfile', _sendfile)):
+                    if (hasattr(os, name)
+                            and _copy_fd(func, inp.fileno(), out.fileno(),
+                                         size)):
+                        return name
+            shutil.copyfileobj(inp, out, COPY_CHUNK_SIZE)
+    return 'copyfileobj'
@@ -0,0 +1,161 @@
+"""
+Incremental reading of items of JSON array.
+
+`iter_json_items` reads the document from the binary file object in chunks,
+walks through the keys of objects down to the array and decodes items of the
+array one by one with `json.JSONDecoder.raw_decode`. Only the current item
+(or the value of the key which is skipped) is kept in memory.
+"""
+import codecs
+import json
+import re
+
+import six
+
+from grab.error import DataNotFound
+
+__all__ = ('iter_json_items',)
+DEFAULT_CHUNK_SIZE = 64 * 1024
+RE_NOT_SPACE = re.compile(r'[^ \t\n\r]')
+# Characters which could continue the number e.g. "2." or "2.5e"
+NUMBER_CHARS = frozenset(u'0123456789+-.eE')
+
+
+def is_number(value):
+    return (isinstance(value, six.integer_types + (float,))
+            and not isinstance(value, bool))
+
+
+class JsonStreamReader(object):
+    """
+    Buffer of decoded text of JSON document which is read in chunks.
+    """
+
+    def __init__(self, inp, charset='utf-8', chunk_size=DEFAULT_CHUNK_SIZE):
+        self.inp = inp
+        self.decoder = codecs.getincrementaldecoder(charset)()
+        self.chunk_size = chunk_size
+        self.json_decoder = json.JSONDecoder()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+        self.started = False
+
+    def read_chunk(self):
+        """
+        Append next chunk of the document to the buffer.
+
+        :returns: False if the end of the document has been reached
+        """
+
+        if self.eof:
+            return False
+        data = self.inp.read(self.chunk_size)
+        if data:
+            text = self.decoder.decode(data)
+        else:
+            text = self.decoder.decode(b'', True)
+            self.eof = True
+        if not self.started and text:
+            self.started = True
+            if text.startswith(u'\ufeff'):
+                text = text[1:]
+        # Drop processed part of the buffer
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return next character, empty string at the end
+        of the document.
+        """
+
+        while True:
+            match = RE_NOT_SPACE.search(self.buf, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self.read_chunk():
+                return u''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of %r at position %d, found %r'
+                             % (chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        """
+        Decode next JSON value.
+        """
+
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                # Number could be cut by the end of the buffer, it is
+                # complete only if it is followed by other character
+                if (self.eof
+                        or (end < len(self.buf)
+                            and (not is_number(value)
+                                 or self.buf[end] not in NUMBER_CHARS))):
+                    self.pos = end
+                    return value
+            # Read until size of the buffer is doubled to not decode long
+            # value again and again
+            size = len(self.buf) - self.pos
+            while len(self.buf) - self.pos < size * 2:
+                if not self.read_chunk():
+                    break
+
+
+def iter_json_items(inp, path=None, charset='utf-8',
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield items of JSON array.
+
+    :param inp: binary file object
+    :param path: keys of nested objects which lead to the array: list of
+        keys or string of keys separated by dot, None if the document is
+        the array
+    :param charset: charset of the document
+    """
+
+    if path is None:
+        path = []
+    elif isinstance(path, six.string_types):
+        path = path.split('.')
+    reader = JsonStreamReader(inp, charset=charset, chunk_size=chunk_size)
+    for key in path:
+        reader.expect(u'{')
+        while True:
+            if reader.peek() == u'}':
+                raise DataNotFound('Key not found in JSON document: %s'
+                                   % key)
+            current_key = reader.read_value()
+            reader.expect(u':')
+            if current_key == key:
+                break
+            # Decode and drop the value of other key
+            reader.read_value()
+            if reader.expect(u',}') == u'}':
+                raise DataNotFound('Key not found in JSON document: %s'
+                                   % key)
+    if reader.peek() != u'[':
+        raise DataNotFound('JSON value is not an array: %s'
+                           % '.'.join(path))
+    reader.expect(u'[')
+    if reader.peek() == u']':
+        return
+    while True:
+        yield reader.read_value()
+        if reader.expect(u',]') == u']':
+            break
@@ -1,7 +1,21 @@
 import re
 
+import six
+
 
 def camel_case_to_underscore(name):
     """Converts camel_case into CamelCase"""
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
+
+
+def make_bytes(value, encoding='utf-8'):
+    """
+    Convert value into byte string, byte strings are returned unchanged.
+    """
+
+    if isinstance(value, six.binary_type):
+        return value
+    elif not isinstance(value, six.text_type):
+        value = six.text_type(value)
+    return value.encode(encoding)
@@ -0,0 +1,28 @@
+"""
+Cache of compiled regular expressions.
+
+`re` module keeps only few hundreds of compiled patterns and `weblib.rex`
+cache grows without limit. `compile_regexp` keeps at most `maxsize` least
+recently used patterns in `REGEXP_CACHE`.
+"""
+import re
+
+import six
+
+from grab.util.xpath import ExpressionCache
+
+__all__ = ('compile_regexp',)
+REGEXP_CACHE = ExpressionCache()
+
+
+def compile_regexp(regexp, flags=0):
+    """
+    Accept string, byte string or compiled regular expression object.
+    Return compiled regular expression object.
+    """
+
+    if isinstance(regexp, (six.text_type, six.binary_type)):
+        return REGEXP_CACHE.get((type(regexp), regexp, flags),
+                                lambda: re.compile(regexp, flags))
+    else:
+        return regexp
@@ -0,0 +1,165 @@
+"""
+Caches of compiled XPath expressions and of CSS to XPath translations.
+
+lxml compiles the expression each time `element.xpath(query)` is called and
+pyquery translates CSS selector into XPath on each call of `find` method.
+Handlers of the spider execute same few dozens of expressions again and
+again, so compiled `lxml.etree.XPath` objects and results of translations
+are cached. The caches are shared by all threads of the process, each cache
+keeps at most `maxsize` least recently used items.
+"""
+from collections import OrderedDict
+import threading
+
+from selection import XpathSelector
+import six
+
+__all__ = ('ExpressionCache', 'CachedXpathSelector', 'CachedCssTranslator',
+           'compile_xpath', 'css_to_xpath', 'get_cache_stats')
+REGEXP_NS = 'http://exslt.org/regular-expressions'
+DEFAULT_CACHE_SIZE = 1000
+
+
+class ExpressionCache(object):
+    """
+    Thread-safe LRU cache with counters of hits and misses.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, factory):
+        """
+        Return cached value of the key, call `factory` to build the value
+        if the key is not in the cache.
+        """
+
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.items[key] = value
+                self.hits += 1
+                return value
+        value = factory()
+        with self.lock:
+            self.misses += 1
+            self.items[key] = value
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.items),
+            'maxsize': self.maxsize,
+        }
+
+
+XPATH_CACHE = ExpressionCache()
+CSS_CACHE = ExpressionCache()
+
+
+def compile_xpath(query, namespaces=None):
+    """
+    Return compiled `lxml.etree.XPath` object of the query. Prefix "re"
+    of EXSLT regular expressions is always available.
+    """
+
+    from lxml.etree import XPath
+
+    if namespaces:
+        key = (query, tuple(sorted(namespaces.items())))
+    else:
+        key = (query, None)
+
+    def factory():
+        all_namespaces = {'re': REGEXP_NS}
+        all_namespaces.update(namespaces or {})
+        return XPath(query, namespaces=all_namespaces)
+
+    return XPATH_CACHE.get(key, factory)
+
+
+def css_to_xpath(css, prefix='descendant-or-self::'):
+    """
+    Translate CSS selector into XPath query with cssselect HTML translator.
+    """
+
+    def factory():
+        from cssselect import HTMLTranslator
+
+        return HTMLTranslator().css_to_xpath(css, prefix)
+
+    return CSS_CACHE.get((css, prefix, 'html'), factory)
+
+
+def get_cache_stats():
+    """
+    Return counters of XPath and CSS caches.
+    """
+
+    return {
+        'xpath': XPATH_CACHE.get_stats(),
+        'css': CSS_CACHE.get_stats(),
+    }
+
+
+class CachedXpathSelector(XpathSelector):
+    """
+    `XpathSelector` which takes compiled queries from `XPATH_CACHE`.
+    """
+
+    __slots__ = ()
+
+    def process_query(self, query):
+        result = compile_xpath(query)(self.node())
+
+        # If you query XPATH like //some/crap/@foo="bar" then xpath function
+        # returns boolean value instead of list of something.
+        # To work around this problem I just returns empty list.
+        if isinstance(result, bool):
+            result = []
+
+        if isinstance(result, six.string_types):
+            result = [result]
+
+        return result
+
+
+class CachedCssTranslator(object):
+    """
+    Wrapper of pyquery CSS translator which caches translations in
+    `CSS_CACHE`. Pass it to PyQuery with `css_translator` argument.
+    """
+
+    def __init__(self, xhtml=False):
+        self.xhtml = xhtml
+        self._translator = None
+
+    @property
+    def translator(self):
+        if self._translator is None:
+            from pyquery.cssselectpatch import JQueryTranslator
+
+            self._translator = JQueryTranslator(xhtml=self.xhtml)
+        return self._translator
+
+    def css_to_xpath(self, css, prefix='descendant-or-self::'):
+        return CSS_CACHE.get(
+            (css, prefix, self.xhtml),
+            lambda: self.translator.css_to_xpath(css, prefix))
@@ -54,6 +54,8 @@ GRAB_TEST_LIST = (
     # *** util.module
     'test.util_module',
     'test.util_log',
+    'test.util_xpath',
+    'test.util_jsonstream',
     # *** grab.export
     'test.util_config',
     'test.script_crawl',
@@ -78,6 +80,10 @@ SPIDER_TEST_LIST = (
     'test.spider_meta',
     'test.spider_error',
     'test.spider_cache',
+    'test.spider_cache_codec',
+    'test.spider_cache_warc',
+    'test.spider_cache_key',
+    'test.spider_cache_record',
     'test.spider_data',
     'test.spider_stat',
     'test.spider_multiprocess',
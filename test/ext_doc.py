@@ -22,3 +22,33 @@ class DocExtensionTest(TestCase):
 
     def test_select_method(self):
         self.assertEqual('test', self.g.doc.select('//h1').text())
+
+    def test_schema(self):
+        from grab import DataNotFound
+        from grab.document import Schema, Field
+
+        g = build_grab(document_body=b"""
+            <h1> Foo </h1>
+            <div class="offer"><b>A</b><a href="/a">1.5</a></div>
+            <div class="offer"><b>B</b><a href="/b">2</a></div>
+        """)
+        schema = Schema(
+            title='//h1',
+            count=Field('count(//div)', converter=int),
+            shops=Field(css='div.offer b', many=True),
+            offers=Field('//div[@class="offer"]', many=True, schema=Schema(
+                url=Field('./a', attr='href'),
+                price=Field('./a', converter=float),
+                note=Field('./i', default=None),
+            )),
+        )
+        self.assertEqual({
+            'title': 'Foo',
+            'count': 2,
+            'shops': ['A', 'B'],
+            'offers': [
+                {'url': '/a', 'price': 1.5, 'note': None},
+                {'url': '/b', 'price': 2.0, 'note': None},
+            ],
+        }, schema.extract(g.doc))
+        self.assertRaises(DataNotFound, Schema(foo='//i').extract, g.doc)
@@ -187,3 +187,94 @@ class LXMLExtensionTest(BaseGrabTestCase):
         g = build_grab()
         g.go(self.server.get_url())
         g.xpath_exists('//anytag')
+
+    def test_tree_from_bytes(self):
+        g = build_grab()
+        g.setup_document(b'\xef\xbb\xbf' +
+                         u'<p>фу\x00у&#151;</p>'.encode('utf-8'))
+        self.assertEqual('utf-8', g.doc.charset)
+        self.assertEqual(u'фуу\u2014', g.doc.select('//p').text())
+
+        g = build_grab(lowercased_tree=True)
+        g.setup_document(u'<P>ФУУ</P>'.encode('cp1251'),
+                         document_charset='cp1251')
+        self.assertEqual(u'фуу', g.doc.select('//p').text())
+
+        g = build_grab()
+        g.setup_document(u'<p>фуу</p>'.encode('utf-16-le'),
+                         document_charset='utf-16-le')
+        self.assertEqual(u'фуу', g.doc.select('//p').text())
+
+    def test_incremental_dom(self):
+        html = (u'<html><head><meta charset="cp1251"></head><body>' +
+                u'<p>фуу&#151;</p>' * 10000 + u'</body></html>')
+        self.server.response['get.data'] = html.encode('cp1251')
+        g = build_grab(incremental_dom=True)
+        g.go(self.server.get_url())
+        self.assertEqual('cp1251', g.doc.charset)
+        self.assertEqual(10000, len(g.doc.select('//p')))
+        self.assertEqual(u'фуу\u2014', g.doc.select('//p').text())
+        self.assertEqual(html.encode('cp1251'), g.doc.body)
+
+    def test_incremental_tree_builder(self):
+        from grab.document import IncrementalTreeBuilder
+
+        body = u'<p>фу\x00у&#151;</p>'.encode('utf-8') * 1000
+        builder = IncrementalTreeBuilder(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n')
+        for pos in range(0, len(body), 7):
+            builder.feed(body[pos:pos + 7])
+        tree = builder.close()
+        self.assertEqual('utf-8', builder.charset)
+        self.assertEqual([u'фуу\u2014'] * 1000,
+                         [x.text for x in tree.xpath('//p')])
+
+    def test_parser_profile(self):
+        from grab import GrabMisuseError
+
+        body = b'<html><!-- foo --><body><p id="x">bar</p></body></html>'
+        g = build_grab(document_body=body)
+        self.assertEqual(1, len(g.doc.select('//comment()')))
+        g = build_grab(document_body=body, parser_profile='lean')
+        self.assertEqual(0, len(g.doc.select('//comment()')))
+        self.assertEqual('bar', g.doc.select('//p[@id="x"]').text())
+        g = build_grab(document_body=body,
+                       parser_profile={'remove_comments': True})
+        self.assertEqual(0, len(g.doc.select('//comment()')))
+        g = build_grab(document_body=body, parser_profile='foo')
+        self.assertRaises(GrabMisuseError, lambda: g.doc.tree)
+
+    def test_dispose(self):
+        g = build_grab(document_body=b'<p>foo</p>')
+        tree = g.doc.tree
+        self.assertTrue(tree is g.doc.tree)
+        g.doc.unicode_body()
+        g.doc.dispose()
+        self.assertEqual(None, g.doc._lxml_tree)
+        self.assertEqual(None, g.doc._unicode_body)
+        self.assertFalse(tree is g.doc.tree)
+        self.assertEqual('foo', g.doc.select('//p').text())
+
+    def test_iter_elements(self):
+        import gzip
+        from six import BytesIO
+
+        body = (b'<?xml version="1.0" encoding="UTF-8"?>'
+                b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                + u''.join(u'<url><loc>http://example.com/%d</loc></url>'
+                           % x for x in range(100)).encode('utf-8')
+                + b'</urlset>')
+        g = build_grab(document_body=body)
+        urls = []
+        for elem in g.doc.iter_elements(tag='{*}url'):
+            urls.append(elem.findtext('{*}loc'))
+            self.assertEqual(None, elem.getprevious())
+        self.assertEqual(100, len(urls))
+        self.assertEqual('http://example.com/99', urls[-1])
+
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as out:
+            out.write(body)
+        g = build_grab(document_body=buf.getvalue())
+        locs = [x.text for x in g.doc.iter_elements(tag='{*}loc')]
+        self.assertEqual(urls, locs)
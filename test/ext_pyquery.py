@@ -13,3 +13,17 @@ class ExtensionPyqueryTestCase(BaseGrabTestCase):
         g.go(self.server.get_url())
 
         self.assertEqual(g.doc.pyquery('h1').text(), 'Hello world')
+
+    def test_css_cache(self):
+        from grab.util.xpath import CSS_CACHE
+
+        self.server.response['get.data'] =\
+            '<body><h1>Hello world</h1><footer>2014</footer>'
+        g = build_grab()
+        g.go(self.server.get_url())
+        CSS_CACHE.clear()
+        self.assertEqual(g.doc.pyquery('footer').text(), '2014')
+        g.go(self.server.get_url())
+        self.assertEqual(g.doc.pyquery('footer').text(), '2014')
+        self.assertEqual(1, CSS_CACHE.misses)
+        self.assertEqual(1, CSS_CACHE.hits)
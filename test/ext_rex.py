@@ -75,3 +75,17 @@ class ExtensionRexTestCase(BaseGrabTestCase):
 
     def test_assert_rex_text(self):
         self.assertEqual(u'ха', self.g.rex_text('<em id="fly-em">([^<]+)'))
+
+    def test_regexp_cache(self):
+        from grab.util.rex import REGEXP_CACHE, compile_regexp
+
+        REGEXP_CACHE.clear()
+        self.assertEqual(u'ха', self.g.rex_text('<em id="fly-em">([^<]+)'))
+        self.assertEqual(u'ха', self.g.rex_text('<em id="fly-em">([^<]+)'))
+        self.assertEqual(1, REGEXP_CACHE.get_stats()['misses'])
+        self.assertEqual(1, REGEXP_CACHE.get_stats()['hits'])
+        self.assertTrue(compile_regexp(b'em', re.I)
+                        is compile_regexp(b'em', re.I))
+        self.assertFalse(compile_regexp(b'em') is compile_regexp(b'em', re.I))
+        rex = re.compile('em')
+        self.assertTrue(compile_regexp(rex) is rex)
@@ -67,3 +67,17 @@ class TextExtensionTest(BaseGrabTestCase):
                                  byte=True)
         self.assertRaises(DataNotFound, self.g.assert_substrings,
                           (u'фыва, вернись', u'фыва-а-а-а'))
+
+    def test_search_ascii_in_bytes(self):
+        self.assertTrue(self.g.doc.can_search_ascii_bytes(u'mozilla = 777'))
+        self.assertFalse(self.g.doc.can_search_ascii_bytes(u'фыва'))
+        self.assertFalse(self.g.doc.can_search_ascii_bytes(u' mozilla'))
+        self.assertFalse(self.g.doc.can_search_ascii_bytes(u'&#151;'))
+        self.assertTrue(self.g.search(u'mozilla = 777'))
+        self.assertFalse(self.g.search(u'mozilla = 778'))
+        self.assertEqual(None, self.g.doc._unicode_body)
+
+        self.g.doc.charset = 'utf-16'
+        self.assertFalse(self.g.doc.can_search_ascii_bytes(u'mozilla'))
+        self.g.doc.charset = 'shift_jis'
+        self.assertFalse(self.g.doc.can_search_ascii_bytes(u'mozilla'))
@@ -4,6 +4,7 @@ This test fails in py3.3 environment because `grab.response.body`
 contains <str>, but it should contains <bytes>
 """
 import six
+from six.moves.urllib.parse import urlsplit
 
 from test.util import build_grab
 from test.util import BaseGrabTestCase
@@ -72,3 +73,46 @@ class GrabCharsetDetectionTestCase(BaseGrabTestCase):
         g = build_grab()
         g.go(self.server.get_url())
         #print(g.doc.charset)
+
+    def test_html5_meta_charset(self):
+        self.server.response['get.data'] = (
+            u'<html><head><meta charset="windows-1251"></head>'
+            u'<body>фуу</body></html>'.encode('cp1251'))
+        g = build_grab()
+        g.go(self.server.get_url())
+        self.assertEqual('windows-1251', g.doc.charset)
+        self.assertEqual(u'фуу', g.doc.select('//body').text())
+
+    def test_detect_charset(self):
+        from grab.charset import detect_charset
+
+        self.assertEqual(('utf-8', None), detect_charset(
+            b'<?xml version="1.0" encoding="koi8-r"?><html>'
+            b'<meta http-equiv="Content-Type" '
+            b'content="text/html; charset=UTF-8">'))
+        self.assertEqual(('koi8-r', None), detect_charset(
+            b'<?xml version="1.0" encoding="koi8-r"?><root/>'))
+        self.assertEqual(('utf-8', b'\xef\xbb\xbf'), detect_charset(
+            b'\xef\xbb\xbf<meta charset="cp1251">'))
+        self.assertEqual(('iso-8859-1', None), detect_charset(
+            b'<p>foo</p>', 'text/html; charset="ISO-8859-1"'))
+        self.assertEqual((None, None), detect_charset(b'<p>foo</p>'))
+
+    def test_charset_memo(self):
+        from grab.charset import CharsetMemo
+
+        memo = CharsetMemo(min_confidence=2, verify_interval=3)
+        self.server.response['get.data'] = (
+            u'<meta charset="cp1251"><p>фуу</p>'.encode('cp1251'))
+        g = build_grab(charset_memo=memo)
+        for _ in range(2):
+            g.go(self.server.get_url())
+            self.assertEqual('cp1251', g.doc.charset)
+        host = urlsplit(self.server.get_url()).netloc
+        self.assertEqual(2, memo.get_confidence(host))
+
+        # Charset is taken from the memo
+        self.server.response['get.data'] = u'<p>фуу</p>'.encode('cp1251')
+        g.go(self.server.get_url())
+        self.assertEqual('cp1251', g.doc.charset)
+        self.assertEqual(u'фуу', g.doc.select('//p').text())
@@ -13,3 +13,16 @@ class GrabStatTestCase(BaseGrabTestCase):
     def test_zero_division_error(self):
         stat = Stat()
         stat.get_speed_line(stat.time)
+
+    def test_histogram(self):
+        stat = Stat()
+        for val in (0.0001, 0.003, 0.003, 0.2, 20):
+            stat.observe('foo', val)
+        with stat.measure_time('foo'):
+            pass
+        hist = stat.histograms['foo']
+        self.assertEqual(6, hist.count)
+        self.assertEqual(20, hist.max)
+        self.assertEqual(0.005, hist.percentile(50))
+        self.assertEqual(20, hist.percentile(100))
+        self.assertEqual(6, sum(x[1] for x in hist.to_dict()['buckets']))
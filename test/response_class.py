@@ -63,3 +63,125 @@ class TestResponse(BaseGrabTestCase):
         ubody = g.response.unicode_body()
         self.assertTrue(u'тест' in ubody)
         self.assertTrue('<?xml' in ubody)
+
+    def test_body_digest(self):
+        from hashlib import sha1
+
+        self.server.response['get.data'] = b'foo' * 10000
+        g = build_grab()
+        g.go(self.server.get_url())
+        self.assertEqual(sha1(b'foo' * 10000).hexdigest(),
+                         g.doc.body_digest)
+        self.assertFalse(g.doc.body_unchanged)
+        g.doc.previous_body_digest = sha1(b'foo' * 10000).hexdigest()
+        self.assertTrue(g.doc.body_unchanged)
+        g.doc.body = b'bar'
+        self.assertEqual(sha1(b'bar').hexdigest(), g.doc.body_digest)
+        self.assertFalse(g.doc.body_unchanged)
+
+    def test_body_loader(self):
+        import pickle
+        from grab.document import Document
+
+        calls = []
+
+        def load_body():
+            calls.append(1)
+            return b'<b>foo</b>'
+
+        doc = Document()
+        doc.set_body_loader(load_body)
+        doc.body_digest = 'x'
+        self.assertEqual([], calls)
+        self.assertEqual('x', doc.body_digest)
+        self.assertEqual(b'<b>foo</b>', doc.body)
+        self.assertEqual(b'<b>foo</b>', doc.body)
+        self.assertEqual([1], calls)
+
+        doc.set_body_loader(load_body)
+        doc = pickle.loads(pickle.dumps(doc))
+        self.assertEqual(b'<b>foo</b>', doc.body)
+
+    def test_lazy_headers(self):
+        from copy import copy
+        from grab.document import Document
+
+        doc = Document()
+        doc.head = (b'HTTP/1.1 302 Found\r\nLocation: /foo\r\n\r\n'
+                    b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n'
+                    b'Set-Cookie: a=1\r\nX-Long: foo\r\n bar\r\n'
+                    b'set-cookie: b=2\r\n\r\n')
+        doc.parse(charset='utf-8')
+        self.assertEqual(None, doc.headers._items)
+        self.assertEqual('text/html', doc.headers['content-type'])
+        self.assertEqual('text/html', doc.headers.get('Content-Type'))
+        self.assertTrue('CONTENT-TYPE' in doc.headers)
+        self.assertFalse('Location' in doc.headers)
+        self.assertEqual(None, doc.headers['Location'])
+        self.assertEqual('x', doc.headers.get('Location', 'x'))
+        self.assertEqual(['a=1', 'b=2'], doc.headers.get_all('Set-Cookie'))
+        self.assertEqual('foo bar', doc.headers['X-Long'])
+        self.assertEqual(['Content-Type', 'Set-Cookie', 'X-Long',
+                          'set-cookie'], doc.headers.keys())
+
+        headers = copy(doc.headers)
+        headers['Set-Cookie'] = 'c=3'
+        self.assertEqual(['c=3'], headers.get_all('set-cookie'))
+        self.assertEqual(['a=1', 'b=2'], doc.headers.get_all('Set-Cookie'))
+
+    def test_body_mmap(self):
+        import re
+
+        with temp_dir() as tmp_dir:
+            g = build_grab()
+            g.doc.body_path = os.path.join(tmp_dir, 'body.html')
+            g.doc.body = (b'<html><body><h1>Hello</h1>'
+                          b'<b>{"a": 1}</b></body></html>')
+            g.doc.charset = 'utf-8'
+            buf = g.doc.get_body_buffer()
+            self.assertTrue(buf is g.doc.get_body_buffer())
+            self.assertEqual(b'<html>', buf[:6])
+            self.assertTrue(g.doc.text_search(b'Hello', byte=True))
+            self.assertFalse(g.doc.text_search(b'World', byte=True))
+            self.assertEqual(b'1', g.doc.rex_search(re.compile(b'"a": (\\d)'),
+                                                    byte=True).group(1))
+            self.assertEqual('Hello', g.doc.select('//h1').text())
+
+            g.doc.body = b'<b>a&#151;b\x00</b>'
+            g.doc.dispose()
+            self.assertEqual(None, g.doc._body_mmap)
+            self.assertEqual(u'a—b', g.doc.select('//b').text())
+
+            g.doc.body = b'{"a": 1}'
+            self.assertEqual({'a': 1}, g.doc.json)
+            g.doc.body = b''
+            self.assertEqual(b'', g.doc.get_body_buffer())
+            g.doc.close_body_buffer()
+
+    def test_save_body_file(self):
+        from grab.util.files import copy_file
+
+        with temp_dir() as tmp_dir:
+            g = build_grab()
+            g.doc.body_path = os.path.join(tmp_dir, 'body.bin')
+            g.doc.body = b'foo' * 100000
+
+            path = os.path.join(tmp_dir, 'copy', 'file.bin')
+            g.doc.save(path)
+            self.assertEqual(b'foo' * 100000, open(path, 'rb').read())
+            g.doc.save(g.doc.body_path)
+            self.assertEqual(b'foo' * 100000,
+                             open(g.doc.body_path, 'rb').read())
+
+            rel_path = g.doc.save_hash('http://example.com/', tmp_dir,
+                                       link=True)
+            path = os.path.join(tmp_dir, rel_path)
+            self.assertEqual(b'foo' * 100000, open(path, 'rb').read())
+            if hasattr(os, 'link'):
+                self.assertTrue(os.path.samefile(g.doc.body_path, path))
+
+            empty_path = os.path.join(tmp_dir, 'empty.bin')
+            open(empty_path, 'wb').close()
+            self.assertEqual('copyfileobj',
+                             copy_file(empty_path, path + '.copy'))
+            self.assertEqual(b'', open(path + '.copy', 'rb').read())
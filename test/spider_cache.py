@@ -1,11 +1,14 @@
 # coding: utf-8
 from grab.spider import Spider, Task
-import mock
 from copy import deepcopy
+import os
+import time
 
-from test.util import BaseGrabTestCase, build_spider
+from test.util import BaseGrabTestCase, build_spider, build_grab, temp_dir
 from test_settings import (MONGODB_CONNECTION, MYSQL_CONNECTION,
                            POSTGRESQL_CONNECTION)
+from grab.spider.cache_backend.warc import export_warc, import_warc
+from grab.spider.cache_backend.key import CacheKeyBuilder
 
 
 class ContentGenerator(object):
@@ -217,6 +220,350 @@ class SpiderCacheMixin(object):
         self.assertTrue(bot.cache.has_item(self.server.get_url('/foo')))
         self.assertFalse(bot.cache.has_item(self.server.get_url('/bar')))
 
+    def test_body_deduplication(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.collect('unchanged', grab.doc.body_unchanged)
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        self.server.response['get.data'] = b'same body'
+        bot.add_task(Task('page', url=self.server.get_url()))
+        bot.add_task(Task('page', url=self.server.get_url('/foo')))
+        bot.add_task(Task('page', url=self.server.get_url('/foo'),
+                          refresh_cache=True, delay=1))
+        bot.run()
+        self.assertEqual(2, bot.cache.size())
+        self.assertEqual(bot.cache.get_body_digest(self.server.get_url()),
+                         bot.cache.get_body_digest(
+                             self.server.get_url('/foo')))
+        self.assertEqual([False, False, True],
+                         bot.stat.collections['unchanged'])
+        self.assertEqual(1, bot.stat.counters['spider:cache-body-unchanged'])
+
+    def test_revalidation(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.collect('points', (grab.doc.code, grab.doc.body))
+
+        def callback(handler):
+            if handler.request.headers.get('If-None-Match') == '"foo"':
+                handler.set_status(304)
+            else:
+                handler.add_header('ETag', '"foo"')
+                handler.write(b'content')
+            handler.finish()
+
+        self.server.response['callback'] = callback
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url()))
+        bot.add_task(Task('page', url=self.server.get_url(),
+                          delay=3, cache_timeout=1))
+        bot.run()
+        self.assertEqual([(200, b'content'), (200, b'content')],
+                         bot.stat.collections['points'])
+        self.assertEqual(
+            1, bot.stat.counters['spider:request-cache-revalidated'])
+        self.assertTrue(bot.cache.has_item(self.server.get_url(),
+                                           timeout=2))
+
+    def test_revalidation_missing_item(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.collect('points', (grab.doc.code, grab.doc.body))
+
+        def callback(handler):
+            if handler.request.headers.get('If-None-Match') == '"foo"':
+                # The item is removed (e.g. evicted) before the response
+                # to conditional request is received
+                bot.cache.clear()
+                handler.set_status(304)
+            else:
+                handler.add_header('ETag', '"foo"')
+                handler.write(b'content')
+            handler.finish()
+
+        self.server.response['callback'] = callback
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url()))
+        bot.add_task(Task('page', url=self.server.get_url(),
+                          delay=3, cache_timeout=1))
+        bot.run()
+        self.assertEqual([(200, b'content'), (200, b'content')],
+                         bot.stat.collections['points'])
+        self.assertEqual(
+            1, bot.stat.counters['spider:request-cache-revalidation-miss'])
+        self.assertTrue(bot.cache.has_item(self.server.get_url(),
+                                           timeout=2))
+
+    def test_body_removed_before_handler(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                if grab.doc.from_cache:
+                    # The body is released (e.g. by the sweeper) before
+                    # the handler reads it
+                    self.cache.clear()
+                self.stat.collect('points', (grab.doc.from_cache,
+                                             grab.doc.body))
+
+        self.server.response['get.data'] = b'content'
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url()))
+        bot.run()
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url()))
+        bot.run()
+        self.assertEqual([(False, b'content')],
+                         bot.stat.collections['points'])
+        self.assertEqual(1, bot.stat.counters['spider:cache-body-missing'])
+        self.assertTrue(bot.cache.has_item(self.server.get_url()))
+
+    def test_remove_expired_items(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url('/1')))
+        bot.add_task(Task('page', url=self.server.get_url('/2')))
+        bot.add_task(Task('page', url=self.server.get_url('/3'), delay=2))
+        bot.run()
+        self.assertEqual(3, bot.cache.size())
+        self.assertEqual(1, bot.cache.remove_expired_items(1, batch_size=1))
+        self.assertEqual(1, bot.cache.remove_expired_items(1))
+        self.assertEqual(0, bot.cache.remove_expired_items(1))
+        self.assertTrue(bot.cache.has_item(self.server.get_url('/3')))
+
+    def test_evict_items(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot, max_items=1)
+        bot.cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url('/1')))
+        bot.add_task(Task('page', url=self.server.get_url('/2'), delay=2))
+        bot.run()
+        # Sweeper thread checks the cache only on start of the spider
+        bot.cache.evict_items()
+        self.assertEqual(1, bot.cache.size())
+        self.assertTrue(bot.cache.has_item(self.server.get_url('/2')))
+
+    def test_evict_items_lru(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot, max_items=1, eviction_policy='lru')
+        bot.cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url('/1')))
+        bot.add_task(Task('page', url=self.server.get_url('/2'), delay=2))
+        bot.add_task(Task('page', url=self.server.get_url('/1'), delay=3))
+        bot.run()
+        bot.cache.evict_items()
+        self.assertEqual(1, bot.cache.size())
+        self.assertTrue(bot.cache.has_item(self.server.get_url('/1')))
+
+    def test_cache_sweeper(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url('/1')))
+        bot.run()
+
+        time.sleep(2)
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot, ttl=1)
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url('/2'), delay=1))
+        bot.run()
+        self.assertEqual(1, bot.stat.counters['spider:cache-expired-removed'])
+        self.assertEqual(1, bot.cache.size())
+
+    def test_bulk_operations(self):
+        class TestSpider(Spider):
+            pass
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        urls = [self.server.get_url('/%d' % x) for x in range(3)]
+        responses = []
+        for url in urls[:2]:
+            grab = build_grab()
+            grab.go(url)
+            responses.append((url, grab))
+        self.assertEqual({urls[0]: None, urls[1]: None},
+                         bot.cache.save_responses(responses))
+        self.assertEqual(
+            dict((url, grab.doc.body_digest) for url, grab in responses),
+            bot.cache.save_responses(responses))
+        self.assertEqual(2, bot.cache.size())
+
+        items = bot.cache.get_items(urls)
+        self.assertEqual(set(urls[:2]), set(items))
+        self.assertEqual(urls[0], items[urls[0]]['url'])
+        self.assertEqual({}, bot.cache.get_items(urls, timeout=-1))
+
+    def test_replay(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.collect('urls', task.url)
+
+        class ReplaySpider(TestSpider):
+            def task_page(self, grab, task):
+                self.stat.collect('urls', task.url)
+                yield Task('page', url=grab.make_url_absolute('/next'))
+
+        urls = [self.server.get_url('/1'), self.server.get_url('/2')]
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        for url in urls:
+            bot.add_task(Task('page', url=url))
+        bot.run()
+
+        bot = build_spider(ReplaySpider)
+        self.setup_cache(bot)
+        bot.run_replay(task_name='page', batch_size=1)
+        self.assertEqual(set(urls), set(bot.stat.collections['urls']))
+        self.assertEqual(2, bot.stat.counters['spider:task-page-cache'])
+        self.assertEqual(2, bot.stat.counters['spider:replay-task-ignored'])
+        self.assertFalse('spider:request-network' in bot.stat.counters)
+
+    def test_post_cache_key(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.collect('resp_counters',
+                                  int(grab.doc.select('//span[@id="counter"]')
+                                      .text()))
+
+        self.server.response['get.data'] = ContentGenerator(self.server)
+        self.server.response['post.data'] = ContentGenerator(self.server)
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot, cache_key=CacheKeyBuilder(
+            methods=('GET', 'POST')))
+        bot.cache.clear()
+        bot.setup_queue()
+        url = self.server.get_url()
+        for delay, post in ((0, {'a': '1'}), (0, {'a': '2'}),
+                            (1, {'a': '1'})):
+            bot.add_task(Task('page', grab=build_grab(url=url, post=post),
+                              delay=delay))
+        bot.run()
+        self.assertEqual(2, bot.stat.counters['spider:request-network'])
+        self.assertEqual(1, bot.stat.counters['spider:task-page-cache'])
+        self.assertEqual(2, bot.cache.size())
+
+    def test_lazy_body(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        url = self.server.get_url()
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=url))
+        bot.run()
+
+        item = bot.cache.get_item(url)
+        body = bot.cache.load_body(item)
+        self.assertEqual(len(body), item['body_size'])
+        self.assertEqual('utf-8', item['charset'])
+        calls = []
+        load_body = bot.cache.load_body
+        bot.cache.load_body = lambda x: calls.append(1) or load_body(x)
+        grab = build_grab(url=url)
+        grab.prepare_request()
+        bot.cache.load_response(grab, item)
+        self.assertEqual([], calls)
+        self.assertEqual(len(body), grab.doc.download_size)
+        self.assertEqual('utf-8', grab.doc.charset)
+        self.assertEqual(body, grab.doc.body)
+        self.assertEqual([1], calls)
+
+    def test_cache_stats(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.collect('sizes', len(grab.doc.body))
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url()))
+        bot.add_task(Task('page', url=self.server.get_url(), delay=1))
+        bot.run()
+        info = bot.get_cache_stats()
+        self.assertEqual(1, info['hits'])
+        self.assertEqual(1, info['misses'])
+        self.assertEqual({'hits': 1, 'misses': 1, 'hit_ratio': 0.5},
+                         info['tasks']['page'])
+        self.assertTrue(info['bytes_written'] > 0)
+        self.assertTrue(info['bytes_written_packed'] > 0)
+        self.assertEqual(info['bytes_read'], info['traffic_saved'])
+        self.assertEqual(2, bot.stat.histograms['cache.get_item'].count)
+        self.assertEqual(1, bot.stat.histograms['cache.load_body'].count)
+        self.assertTrue('Cache:' in bot.render_stats())
+
+    def test_warc_export_import(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        urls = [self.server.get_url('/%d' % x) for x in range(3)]
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        for url in urls:
+            bot.add_task(Task('page', url=url))
+        bot.run()
+        item = bot.cache.get_item(urls[0])
+        body = bot.cache.load_body(item)
+        timestamp = item['timestamp']
+
+        with temp_dir() as tmp_dir:
+            paths = export_warc(bot, os.path.join(tmp_dir, '%d.warc.gz'),
+                                records_per_file=2, processes=1)
+            self.assertEqual(2, len(paths))
+            bot.cache.clear()
+            self.assertEqual(3, import_warc(bot, paths, processes=1))
+        self.assertEqual(3, bot.cache.size())
+        item = bot.cache.get_item(urls[0])
+        self.assertEqual(body, bot.cache.load_body(item))
+        self.assertEqual(200, item['response_code'])
+        self.assertEqual(timestamp, item['timestamp'])
+
 
 class SpiderMongoCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
     _backend = 'mongo'
@@ -229,20 +576,27 @@ class SpiderMongoCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
     def test_too_large_document(self):
         class TestSpider(Spider):
             def task_page(self, grab, task):
-                pass
+                self.stat.collect('body_size', len(grab.doc.body))
 
         # The maximum BSON document size is 16 megabytes.
+        # Such body is stored in GridFS.
         self.server.response['get.data'] = 'x' * (1024 * 1024 * 17)
         bot = build_spider(TestSpider)
         self.setup_cache(bot, use_compression=False)
         bot.cache.clear()
         bot.setup_queue()
         bot.add_task(Task('page', url=self.server.get_url()))
-        patch = mock.Mock()
-        with mock.patch('logging.error', patch):
-            bot.run()
-        self.assertEqual(bot.cache.size(), 0)
-        self.assertTrue('Document too large' in patch.call_args[0][0])
+        bot.run()
+        self.assertEqual(bot.cache.size(), 1)
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot, use_compression=False)
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url()))
+        bot.run()
+        self.assertEqual(1, bot.stat.counters['spider:request-cache'])
+        self.assertEqual([1024 * 1024 * 17],
+                         bot.stat.collections['body_size'])
 
     def test_connection_kwargs(self):
         class TestSpider(Spider):
@@ -271,9 +625,8 @@ class SpiderMysqlCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
 
         bot = build_spider(TestSpider)
         self.setup_cache(bot)
-        bot.cache.cursor.execute('begin')
-        bot.cache.cursor.execute('DROP TABLE cache')
-        bot.cache.cursor.execute('commit')
+        with bot.cache.transaction() as cursor:
+            cursor.execute('DROP TABLE cache')
         self.setup_cache(bot)
         bot.cache.clear()
         self.assertEqual(0, bot.cache.size())
@@ -294,9 +647,97 @@ class SpiderPostgresqlCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
 
         bot = build_spider(TestSpider)
         self.setup_cache(bot)
-        bot.cache.cursor.execute('begin')
-        bot.cache.cursor.execute('DROP TABLE cache')
-        bot.cache.cursor.execute('commit')
+        with bot.cache.transaction() as cursor:
+            cursor.execute('DROP TABLE cache')
         self.setup_cache(bot)
         bot.cache.clear()
         self.assertEqual(0, bot.cache.size())
+
+
+class SpiderShardedCacheTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def setup_cache(self, bot, shard_count=2, **kwargs):
+        config = deepcopy(MONGODB_CONNECTION)
+        database = config.pop('database')
+        shards = [{'backend': 'mongo',
+                   'database': '%s_shard%d' % (database, x)}
+                  for x in range(shard_count)]
+        config.update(kwargs)
+        bot.setup_cache(backend='sharded', database=database,
+                        shards=shards, **config)
+
+    def test_hash_ring(self):
+        from hashlib import sha1
+        from grab.spider.cache_backend.sharded import HashRing
+
+        hashes = [sha1(str(x).encode()).hexdigest() for x in range(1000)]
+        ring = HashRing(['0', '1'])
+        new_ring = HashRing(['0', '1', '2'])
+        moved = 0
+        for _hash in hashes:
+            if ring.get_name(_hash) != new_ring.get_name(_hash):
+                self.assertEqual('2', new_ring.get_name(_hash))
+                moved += 1
+        self.assertTrue(0 < moved < 600)
+
+    def test_routing(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        urls = [self.server.get_url('/%d' % x) for x in range(20)]
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache.clear()
+        bot.setup_queue()
+        for url in urls:
+            bot.add_task(Task('page', url=url))
+        bot.run()
+        self.assertEqual(20, bot.cache.size())
+        for shard in bot.cache.shards.values():
+            self.assertTrue(shard.size() > 0)
+        for url in urls:
+            item = bot.cache.get_item(url)
+            self.assertEqual(url, item['url'])
+            self.assertTrue(bot.cache.get_shard(url).has_item(url))
+        self.assertEqual(set(urls), set(bot.cache.get_items(urls)))
+
+    def test_rebalance(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        urls = [self.server.get_url('/%d' % x) for x in range(20)]
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot, shard_count=2)
+        bot.cache.clear()
+        self.setup_cache(bot, shard_count=1)
+        bot.setup_queue()
+        for url in urls:
+            bot.add_task(Task('page', url=url))
+        bot.run()
+        body = bot.cache.load_body(bot.cache.get_item(urls[0]))
+        timestamps = dict((x['url'], x['timestamp'])
+                          for x in bot.cache.iterate_items())
+
+        self.setup_cache(bot, shard_count=2)
+        moved = bot.cache.rebalance(batch_size=3)
+        self.assertEqual(bot.cache.shards['1'].size(), moved)
+        self.assertEqual(20, bot.cache.size())
+        self.assertEqual(0, bot.cache.rebalance())
+        for url in urls:
+            self.assertTrue(bot.cache.has_item(url))
+        self.assertEqual(body,
+                         bot.cache.load_body(bot.cache.get_item(urls[0])))
+        self.assertEqual(timestamps,
+                         dict((x['url'], x['timestamp'])
+                              for x in bot.cache.iterate_items()))
+
+    def test_max_items(self):
+        bot = build_spider(Spider)
+        self.setup_cache(bot)
+        self.assertEqual(None, bot.cache.max_items)
+        self.setup_cache(bot, max_items=10)
+        self.assertEqual(20, bot.cache.max_items)
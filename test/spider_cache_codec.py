@@ -0,0 +1,112 @@
+import zlib
+from unittest import TestCase
+from six import BytesIO
+
+from grab.spider.cache_backend.codec import (CacheCodec, DictionaryTrainer,
+                                             ZDICT_SUPPORTED, lzma)
+from grab.spider.error import SpiderConfigurationError
+
+
+class DictionaryStorage(object):
+    def __init__(self):
+        self.items = {}
+
+    def load_dictionaries(self):
+        for dict_id, (domain, data) in self.items.items():
+            yield dict_id, domain, data
+
+    def save_dictionary(self, dict_id, domain, data):
+        self.items[dict_id] = (domain, data)
+
+
+def build_page(num):
+    return (b'<html><head><title>Page</title>\n'
+            b'<link rel="stylesheet" href="/static/style.css">\n'
+            b'</head><body><div class="menu">Home | About | Contact</div>\n'
+            b'<p>Article #' + str(num).encode('ascii') + b'</p>\n'
+            b'<div class="footer">Copyright, Example Inc.</div>\n'
+            b'</body></html>\n')
+
+
+class CacheCodecTestCase(TestCase):
+    def test_zlib(self):
+        codec = CacheCodec('zlib')
+        data = build_page(1)
+        packed = codec.encode(data)
+        self.assertTrue(len(packed) < len(data))
+        self.assertEqual(data, codec.decode(packed))
+
+    def test_no_compression(self):
+        codec = CacheCodec(None)
+        self.assertEqual(b'foo', codec.decode(codec.encode(b'foo')))
+
+    def test_legacy_value(self):
+        codec = CacheCodec('zlib')
+        self.assertEqual(b'foo', codec.decode(zlib.compress(b'foo')))
+        codec = CacheCodec(None, legacy_compression=False)
+        self.assertEqual(b'<html>', codec.decode(b'<html>'))
+
+    def test_unknown_compression(self):
+        self.assertRaises(SpiderConfigurationError, CacheCodec, 'foo')
+
+    def test_lzma(self):
+        if lzma is None:
+            return
+        codec = CacheCodec('lzma')
+        data = build_page(1)
+        self.assertEqual(data, codec.decode(codec.encode(data)))
+
+    def test_decode_stream(self):
+        data = build_page(1) * 100
+        compressions = [None, 'zlib']
+        if lzma is not None:
+            compressions.append('lzma')
+        for compression in compressions:
+            codec = CacheCodec(compression)
+            stream = BytesIO(codec.encode(data))
+            self.assertEqual(data, codec.decode_stream(stream, chunk_size=7))
+        codec = CacheCodec('zlib')
+        stream = BytesIO(zlib.compress(data))
+        self.assertEqual(data, codec.decode_stream(stream))
+
+    def test_dictionary_trainer(self):
+        trainer = DictionaryTrainer(sample_limit=3)
+        self.assertEqual(None, trainer.add_sample('foo.com', build_page(1)))
+        self.assertEqual(None, trainer.add_sample('foo.com', build_page(2)))
+        dictionary = trainer.add_sample('foo.com', build_page(3))
+        self.assertTrue(b'class="footer"' in dictionary)
+        self.assertFalse(b'Article' in dictionary)
+
+    def test_dictionary_trainer_limits(self):
+        trainer = DictionaryTrainer(sample_limit=3, sample_size=100,
+                                    max_domains=2)
+        trainer.add_sample('foo.com', b'a' * 1000)
+        trainer.add_sample('bar.com', b'b')
+        trainer.add_sample('foo.com', b'c')
+        trainer.add_sample('baz.com', b'd')
+        # bar.com is least recently seen domain
+        self.assertEqual(['foo.com', 'baz.com'], list(trainer.samples))
+        self.assertEqual(100, len(trainer.samples['foo.com'][0]))
+
+    def test_zlib_dict(self):
+        if not ZDICT_SUPPORTED:
+            return
+        storage = DictionaryStorage()
+        codec = CacheCodec('zlib_dict', backend=storage,
+                           trainer=DictionaryTrainer(sample_limit=2))
+        url = 'http://example.com/page'
+        plain = codec.encode(build_page(1), url)
+        codec.encode(build_page(2), url)
+        self.assertEqual(1, len(storage.items))
+        packed = codec.encode(build_page(3), url)
+        self.assertTrue(len(packed) < len(plain))
+
+        # Another codec instance loads the dictionary from the backend
+        codec2 = CacheCodec('zlib_dict', backend=storage)
+        self.assertEqual(build_page(3), codec2.decode(packed))
+        self.assertEqual(build_page(1), codec2.decode(plain))
+
+    def test_zlib_dict_requires_backend(self):
+        if not ZDICT_SUPPORTED:
+            return
+        self.assertRaises(SpiderConfigurationError, CacheCodec, 'zlib_dict')
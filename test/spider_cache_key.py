@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+from grab import Grab, UploadContent
+from grab.spider.cache_backend.key import CacheKeyBuilder, get_key_url
+
+
+def build_config(url, **kwargs):
+    return Grab(url=url, **kwargs).dump_config()
+
+
+class CacheKeyTestCase(TestCase):
+    def test_get_key(self):
+        builder = CacheKeyBuilder()
+        config = build_config('http://example.com/?a=1')
+        self.assertEqual('http://example.com/?a=1', builder.build_key(config))
+        self.assertTrue(builder.is_cacheable(config))
+
+    def test_post_key(self):
+        builder = CacheKeyBuilder(methods=('GET', 'POST'))
+        key = builder.build_key(build_config('http://example.com/',
+                                             post={'a': '1', 'b': '2'}))
+        self.assertEqual('http://example.com/', get_key_url(key))
+        self.assertEqual('POST', key.split('\n')[1])
+        self.assertTrue(key.split('\n')[2].startswith('body:'))
+        key2 = builder.build_key(build_config('http://example.com/',
+                                              post=[('b', '2'), ('a', '1')]))
+        self.assertEqual(key, key2)
+        key3 = builder.build_key(build_config('http://example.com/',
+                                              post={'a': '1', 'b': '3'}))
+        self.assertNotEqual(key, key3)
+
+    def test_post_bytes_key(self):
+        builder = CacheKeyBuilder(methods=('GET', 'POST'))
+        key = builder.build_key(build_config('http://example.com/',
+                                             post=b'a=1'))
+        self.assertEqual('POST', key.split('\n')[1])
+        self.assertNotEqual(key, builder.build_key(
+            build_config('http://example.com/', post=b'a=2')))
+        key = builder.build_key(build_config('http://example.com/',
+                                             post={'a': b'1', b'b': '2'}))
+        self.assertEqual(key, builder.build_key(
+            build_config('http://example.com/', post={'a': '1', 'b': '2'})))
+
+    def test_upload_content_key(self):
+        builder = CacheKeyBuilder(methods=('GET', 'POST'))
+
+        def build_key(content):
+            return builder.build_key(build_config(
+                'http://example.com/',
+                multipart_post={'file': UploadContent(content)}))
+
+        self.assertEqual(build_key(b'foo'), build_key(b'foo'))
+        self.assertEqual(build_key(b'foo'), build_key(u'foo'))
+        self.assertNotEqual(build_key(b'foo'), build_key(b'bar'))
+
+    def test_is_cacheable(self):
+        config = build_config('http://example.com/', post={'a': '1'})
+        self.assertFalse(CacheKeyBuilder().is_cacheable(config))
+        self.assertTrue(CacheKeyBuilder(methods=('post',))
+                        .is_cacheable(config))
+        config = build_config('http://example.com/', method='head')
+        self.assertFalse(CacheKeyBuilder().is_cacheable(config))
+
+    def test_ignore_query_params(self):
+        builder = CacheKeyBuilder(ignore_query_params=['sid'])
+        self.assertEqual(
+            'http://example.com/?a=1',
+            builder.build_key(build_config('http://example.com/?sid=x&a=1')))
+
+    def test_headers(self):
+        builder = CacheKeyBuilder(headers=['Accept-Language'])
+        key = builder.build_key(build_config(
+            'http://example.com/', headers={'accept-language': 'ru'}))
+        self.assertEqual('http://example.com/\naccept-language: ru', key)
+        self.assertEqual(
+            'http://example.com/',
+            builder.build_key(build_config('http://example.com/')))
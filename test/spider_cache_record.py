@@ -0,0 +1,53 @@
+import marshal
+from hashlib import sha1
+from unittest import TestCase
+
+from grab.spider.cache_backend.record import (is_record, pack_record,
+                                              unpack_record, RECORD_HEADERS)
+
+
+class CacheRecordTestCase(TestCase):
+    def test_pack_unpack(self):
+        item = {
+            'key': 'http://example.com/\nPOST',
+            'url': 'http://example.com/',
+            'response_url': 'http://example.com/foo',
+            'timestamp': 1000000000,
+            'body_digest': sha1(b'foo').hexdigest(),
+            'body_size': 3,
+            'head': b'HTTP/1.1 200 OK\r\n\r\n',
+            'response_code': 200,
+            'charset': 'cp1251',
+            'bom': None,
+            'cookies': None,
+        }
+        data = pack_record(item)
+        self.assertTrue(is_record(data))
+        self.assertEqual(item, unpack_record(data))
+
+    def test_packed_body(self):
+        data = pack_record({'url': 'http://example.com/',
+                            'head': b'HTTP/1.1 200 OK\r\n\r\n',
+                            'response_code': 200}, packed_body=b'\x01foo')
+        item = unpack_record(data)
+        self.assertEqual(b'\x01foo', item['packed_body'])
+        self.assertEqual(None, item['body_digest'])
+        self.assertEqual(None, item['body_size'])
+        self.assertEqual(None, item['charset'])
+
+    def test_huge_body_size(self):
+        item = unpack_record(pack_record({'url': 'http://example.com/',
+                                          'body_size': 5 * 2 ** 30}))
+        self.assertEqual(5 * 2 ** 30, item['body_size'])
+
+    def test_version_1(self):
+        data = RECORD_HEADERS[1].pack(
+            b'GRC', 1, 2, 200, 1000000000, 3, 19, 0, 0, 0, 0, 0,
+            b'\x00' * 20) + b'http://example.com/'
+        item = unpack_record(data)
+        self.assertEqual('http://example.com/', item['url'])
+        self.assertEqual(3, item['body_size'])
+        self.assertEqual(200, item['response_code'])
+
+    def test_legacy_value(self):
+        self.assertFalse(is_record(marshal.dumps({'url': 'foo'})))
@@ -0,0 +1,103 @@
+import gzip
+import os
+import zlib
+from unittest import TestCase
+from six import BytesIO
+
+from grab.spider.cache_backend.warc import (build_response_record,
+                                            import_warc_file,
+                                            parse_response_record,
+                                            read_warc_records)
+from test.util import temp_dir
+
+
+def build_gzip(data):
+    cobj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return cobj.compress(data) + cobj.flush()
+
+
+def read_records(data):
+    return list(read_warc_records(gzip.GzipFile(fileobj=BytesIO(data))))
+
+
+class SavedResponses(object):
+    def __init__(self):
+        self.responses = []
+        self.timestamps = {}
+
+    def save_responses(self, responses, timestamps=None):
+        self.responses.extend(responses)
+        self.timestamps.update(timestamps or {})
+
+
+class CacheWarcTestCase(TestCase):
+    def test_export_record(self):
+        head = (b'HTTP/1.1 302 Found\r\nLocation: /foo\r\n\r\n'
+                b'HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n'
+                b'Content-Type: text/html\r\n\r\n')
+        data = build_response_record(('http://example.com/foo', head,
+                                      b'<html>foo</html>', 1000000000))
+        records = read_records(data)
+        self.assertEqual(1, len(records))
+        headers, block = records[0]
+        self.assertEqual(b'2001-09-09T01:46:40Z', headers[b'warc-date'])
+
+        grab = parse_response_record(headers, block)
+        self.assertEqual('http://example.com/foo', grab.doc.url)
+        self.assertEqual(200, grab.doc.code)
+        self.assertEqual(b'<html>foo</html>', grab.doc.body)
+        self.assertEqual(b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n'
+                         b'Content-Length: 16\r\n\r\n', grab.doc.head)
+
+    def test_export_record_without_head(self):
+        data = build_response_record(('http://example.com/', b'', b'foo',
+                                      1000000000))
+        grab = parse_response_record(*read_records(data)[0])
+        self.assertEqual(200, grab.doc.code)
+        self.assertEqual(b'foo', grab.doc.body)
+
+    def test_import_cache_key_and_date(self):
+        url = 'http://example.com/foo'
+        key = url + '\nPOST\nbody:%s' % ('0' * 40)
+        head = b'HTTP/1.1 200 OK\r\n\r\n'
+        data = build_response_record((url, head, b'foo', 1000000000, key))
+        data += build_response_record((url, head, b'bar', 1000000001, url))
+        records = read_records(data)
+        self.assertNotIn(b'warc-grab-cache-key', records[1][0])
+
+        cache = SavedResponses()
+        with temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'test.warc.gz')
+            with open(path, 'wb') as out:
+                out.write(data)
+            self.assertEqual(2, import_warc_file(cache, path))
+        self.assertEqual([key, url], [x[0] for x in cache.responses])
+        self.assertEqual(b'foo', cache.responses[0][1].doc.body)
+        self.assertEqual({key: 1000000000, url: 1000000001},
+                         cache.timestamps)
+
+    def test_import_encoded_payload(self):
+        body = build_gzip(b'<html>foo</html>')
+        block = (b'HTTP/1.1 100 Continue\r\n\r\n'
+                 b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n'
+                 b'Content-Encoding: gzip\r\n\r\n' +
+                 b'%x\r\n' % 4 + body[:4] + b'\r\n' +
+                 b'%x\r\n' % (len(body) - 4) + body[4:] + b'\r\n0\r\n\r\n')
+        data = build_gzip(
+            b'WARC/1.0\r\nWARC-Type: request\r\n'
+            b'WARC-Target-URI: http://example.com/\r\n'
+            b'Content-Type: application/http; msgtype=request\r\n'
+            b'Content-Length: 4\r\n\r\nGET \r\n\r\n')
+        data += build_gzip(
+            b'WARC/1.0\r\nWARC-Type: response\r\n'
+            b'WARC-Target-URI: <http://example.com/>\r\n'
+            b'Content-Type: application/http; msgtype=response\r\n'
+            b'Content-Length: ' + str(len(block)).encode('ascii') +
+            b'\r\n\r\n' + block + b'\r\n\r\n')
+        records = read_records(data)
+        self.assertEqual(2, len(records))
+        self.assertEqual(None, parse_response_record(*records[0]))
+        grab = parse_response_record(*records[1])
+        self.assertEqual('http://example.com/', grab.doc.url)
+        self.assertEqual(200, grab.doc.code)
+        self.assertEqual(b'<html>foo</html>', grab.doc.body)
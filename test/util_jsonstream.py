@@ -0,0 +1,61 @@
+# coding: utf-8
+from unittest import TestCase
+import json
+
+from six import BytesIO
+
+from grab.error import DataNotFound
+from grab.util.jsonstream import iter_json_items
+from test.util import build_grab
+
+
+class JsonStreamTestCase(TestCase):
+    def test_iter_json_items(self):
+        data = {
+            'meta': {'tags': [1, 2, {'a': 'b'}]},
+            'data': {
+                'total': 3,
+                'items': [{'id': 1, 'name': u'тест'}, 12345, None, 'x]'],
+            },
+        }
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        for chunk_size in (1, 3, 1024):
+            self.assertEqual(data['data']['items'], list(iter_json_items(
+                BytesIO(body), 'data.items', chunk_size=chunk_size)))
+        self.assertEqual([1, 22, 333], list(iter_json_items(
+            BytesIO(b'\xef\xbb\xbf [ 1 , 22 ,333 ] '), chunk_size=2)))
+        self.assertEqual([], list(iter_json_items(BytesIO(b'{"a": []}'),
+                                                  ['a'])))
+
+    def test_iter_json_numbers(self):
+        # Numbers are cut by chunk boundaries at any position
+        body = b'[2.5, -10.125e3, 1E-2,7e+10, 0.5e1 , 123456789.75]'
+        for chunk_size in (1, 2, 3):
+            self.assertEqual([2.5, -10125.0, 0.01, 7e10, 5.0, 123456789.75],
+                             list(iter_json_items(BytesIO(body),
+                                                  chunk_size=chunk_size)))
+        for chunk_size in (1, 2, 3):
+            self.assertEqual([2.25e-3], list(iter_json_items(
+                BytesIO(b'{"a": 1.5e2, "b": [2.25e-3]}'), 'b',
+                chunk_size=chunk_size)))
+
+    def test_iter_json_items_errors(self):
+        self.assertRaises(DataNotFound, lambda: list(iter_json_items(
+            BytesIO(b'{"a": 1}'), 'b')))
+        self.assertRaises(DataNotFound, lambda: list(iter_json_items(
+            BytesIO(b'{"a": 1}'), 'a')))
+        self.assertRaises(ValueError, lambda: list(iter_json_items(
+            BytesIO(b'[1, 2'))))
+
+    def test_document_iter_json(self):
+        import gzip
+
+        body = json.dumps({'items': list(range(1000))}).encode('utf-8')
+        g = build_grab(document_body=body)
+        self.assertEqual(list(range(1000)), list(g.doc.iter_json('items')))
+
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as out:
+            out.write(body)
+        g = build_grab(document_body=buf.getvalue())
+        self.assertEqual(list(range(1000)), list(g.doc.iter_json('items')))
@@ -0,0 +1,44 @@
+# coding: utf-8
+from unittest import TestCase
+
+from grab.util.xpath import (ExpressionCache, CachedXpathSelector,
+                             compile_xpath, XPATH_CACHE)
+
+
+class XpathCacheTestCase(TestCase):
+    def test_expression_cache(self):
+        cache = ExpressionCache(maxsize=2)
+        calls = []
+
+        def factory(value):
+            calls.append(value)
+            return value
+
+        self.assertEqual('a', cache.get('a', lambda: factory('a')))
+        self.assertEqual('a', cache.get('a', lambda: factory('a')))
+        self.assertEqual('b', cache.get('b', lambda: factory('b')))
+        # "a" is used recently so "b" is evicted
+        cache.get('a', lambda: factory('a'))
+        cache.get('c', lambda: factory('c'))
+        self.assertEqual(['a', 'b', 'c'], calls)
+        self.assertEqual(['a', 'c'], list(cache.items))
+        self.assertEqual({'hits': 2, 'misses': 3, 'size': 2, 'maxsize': 2},
+                         cache.get_stats())
+
+    def test_compile_xpath(self):
+        from lxml.html import fromstring
+
+        XPATH_CACHE.clear()
+        tree = fromstring('<div><p>foo</p><p class="x">bar</p></div>')
+        xpath = compile_xpath('//p[re:test(@class, "^x")]/text()')
+        self.assertEqual(['bar'], xpath(tree))
+        self.assertTrue(xpath is compile_xpath(
+            '//p[re:test(@class, "^x")]/text()'))
+        self.assertEqual(1, XPATH_CACHE.hits)
+        ns_xpath = compile_xpath('//p', namespaces={'x': 'http://x'})
+        self.assertFalse(ns_xpath is compile_xpath('//p'))
+
+        sel = CachedXpathSelector(tree)
+        self.assertEqual(u'bar', sel.select('//p')[1].text())
+        self.assertEqual(u'x', sel.select('//p')[1].select('@class').text())
+        self.assertEqual(0, sel.select('//p/@class="x"').count())